@@ -22,6 +22,18 @@ django_port = 8000
 redis_ip = os.environ.get("REDIS_IP", "redis")
 redis_port = 6379
 
+# Retention of each event_gen:{topic}:cache stream.  A count limit and an age limit in
+# seconds (0 disables either) apply to every topic unless overridden per topic with
+# JSON, e.g. EVENT_GEN_CACHE_RETENTION='{"node_states": {"maxlen": 0, "max_age": 600}}'
+cache_maxlen = int(os.environ.get("EVENT_GEN_CACHE_MAXLEN", 10000))
+cache_max_age = float(os.environ.get("EVENT_GEN_CACHE_MAX_AGE", 0))
+cache_retention = json.loads(os.environ.get("EVENT_GEN_CACHE_RETENTION", "{}"))
+
+# Messages are cached in batches of up to batch_size, waiting at most batch_wait_ms
+# after the first message of a batch arrives
+batch_size = int(os.environ.get("EVENT_GEN_BATCH_SIZE", 500))
+batch_wait_ms = int(os.environ.get("EVENT_GEN_BATCH_WAIT_MS", 50))
+
 logger = logging.getLogger(__name__)
 
 
@@ -95,8 +107,10 @@ class MessageProcesser(object):
         self.consumer = self.client.subscribe(
             topic=list_of_topics,
             subscription_name=f"event_generator_{random_suffix}",
-            message_listener=self.cache_message,
         )
+        # last stream id millisecond used per topic, ids must never go backwards
+        self.last_id_ms = {}
+        self.cumulative_ack = True
 
         body = {
             "fqfn": "public/default/_simple_event_gen",
@@ -112,18 +126,47 @@ class MessageProcesser(object):
             f"http://{pulsar_ip}:{pulsar_http_port}/admin/v3/functions/{body['fqfn']}"
         )
 
-        # Make sure the function doesn't exist yet
+        # The function's inputs are the trigger topics plus _trigger_log, which tells it
+        # to reload triggers when they change.  Topics are only read here, so a trigger
+        # on a topic no trigger used before needs a message cacher restart: that
+        # subscribes to the topic and adds it to the function's inputs.
+        inputs = [
+            "".join(["public/default/", x])
+            for x in self.redis_client.smembers("event_gen:all_topics")
+        ]
+        if inputs:
+            inputs.append("public/default/_trigger_log")
+
         r = requests.get(function_url)
         if r.ok:
-            # skip creating the pulsar function
-            print(f"Pulsar function already exists, skipping creation: {function_url}")
+            existing = set(r.json().get("inputs") or [])
+            missing = [
+                x
+                for x in inputs
+                if x not in existing and f"persistent://{x}" not in existing
+            ]
+            if not missing:
+                print(f"Pulsar function already exists, skipping creation: {function_url}")
+            else:
+                # created before these topics or _trigger_log were inputs, update it
+                print(f"Pulsar function missing inputs {missing}, updating: {body['fqfn']}")
+                body["inputs"] = sorted(existing.union(missing))
+                self.submit_function(requests.put, function_url, body)
         else:
             print(f"Pulsar function does not exist, creating now...: {body['fqfn']}")
+            body["inputs"] = inputs
+            if not body["inputs"]:
+                print("no inputs detected, skipping event gen function creation")
+            else:
+                self.submit_function(requests.post, function_url, body)
 
-            body["inputs"] = [
-                "".join(["public/default/", x])
-                for x in self.redis_client.smembers("event_gen:all_topics")
-            ]
+    def submit_function(self, method, function_url, body):
+        """
+        Create (requests.post) or update (requests.put) the function, retrying until
+        Pulsar accepts it.
+        """
+        while True:
+            print(f"submitting function: {body['fqfn']}")
             mp_encoder = MultipartEncoder(
                 fields={
                     "url": f"file://{body['py']}",
@@ -131,62 +174,122 @@ class MessageProcesser(object):
                 }
             )
             headers = {"Content-Type": mp_encoder.content_type}
+            r = method(function_url, data=mp_encoder, headers=headers)
+            if r.ok:
+                print(f"Successfully submitted: {body['fqfn']}")
+                break
+            print(r.status_code, r.content)
+            time.sleep(1)
 
-            while True:
-                print(f"posting function: {body['fqfn']}")
-                if not body["inputs"]:
-                    print("no inputs detected, skipping event gen function creation")
-                    break
-                r = requests.post(function_url, data=mp_encoder, headers=headers)
-                if r.ok:
-                    print(f"Successfully posted: {body['fqfn']}")
-                    break
-                print(r.status_code, r.content)
-                time.sleep(1)
+    def retention(self, topic):
+        """
+        (maxlen, max_age) for the topic's stream, where 0 means unlimited.
+        """
+        topic_retention = cache_retention.get(topic, {})
+        return (
+            int(topic_retention.get("maxlen", cache_maxlen)),
+            float(topic_retention.get("max_age", cache_max_age)),
+        )
 
-    def cache_message(self, consumer, message):
-        logger.info(message.value())
-        # topic_name() returns tenant/namespace/topic
-        # We want just the topic
-        topic = message.topic_name().split("/")[-1]
-        my_message_dict = json.loads(message.value())
-        # publish timestamp is in milliseconds
-        my_message_dict["published_datetime_stamp"] = message.publish_timestamp()
-        my_message_dict["published_datetime"] = datetime.datetime.fromtimestamp(
-            message.publish_timestamp() / 1000.0, tz=datetime.timezone.utc
-        ).isoformat()
-
-        logger.info(f"Message is: {my_message_dict}")
-        logger.info(f"Topic is: {topic}")
-        # print(json.dumps(my_message_dict, sort_keys=True, indent=4))
-
-        n = 0
-        while True:
+    def cache_messages(self, messages):
+        """
+        Append a batch of messages to their topics' streams, trim the streams and update
+        the latest message hash, all in one pipelined round-trip.
+        """
+        pipe = self.redis_client.pipeline(transaction=False)
+        latest = {}
+        min_ids = {}
+        for message in messages:
+            # topic_name() returns tenant/namespace/topic
+            # We want just the topic
+            topic = message.topic_name().split("/")[-1]
+            my_message_dict = json.loads(message.value())
+            # publish timestamp is in milliseconds
+            publish_timestamp = message.publish_timestamp()
+            my_message_dict["published_datetime_stamp"] = publish_timestamp
+            my_message_dict["published_datetime"] = datetime.datetime.fromtimestamp(
+                publish_timestamp / 1000.0, tz=datetime.timezone.utc
+            ).isoformat()
+            logger.debug(f"Topic: {topic} Message: {my_message_dict}")
+            encoded = json.dumps(my_message_dict)
+
+            # Stream ids are publish timestamps so triggers can look messages up as of a
+            # time.  Redis assigns the sequence part, which deconflicts messages within
+            # the same millisecond.
+            id_ms = max(publish_timestamp, self.last_id_ms.get(topic, 0))
+            self.last_id_ms[topic] = id_ms
+            maxlen, max_age = self.retention(topic)
+            name = f"event_gen:{topic}:cache"
+            args = ["XADD", name]
+            if maxlen:
+                args += ["MAXLEN", "~", maxlen]
+            args += [f"{id_ms}-*", "encoded", encoded]
+            pipe.execute_command(*args)
+            if max_age:
+                min_ids[name] = max(id_ms - int(max_age * 1000), 0)
+            # the hash holds each topic's latest message so triggers can read all
+            # their topics at once
+            latest[topic] = encoded
+
+        for name, min_id in min_ids.items():
+            pipe.execute_command("XTRIM", name, "MINID", "~", min_id)
+        pipe.hset("event_gen:latest", mapping=latest)
+        pipe.execute()
+
+    def receive_batch(self):
+        """
+        Block for a message, then collect more until the batch is full or
+        batch_wait_ms has passed.
+        """
+        messages = [self.consumer.receive()]
+        deadline = time.monotonic() + batch_wait_ms / 1000.0
+        while len(messages) < batch_size:
+            remaining = int((deadline - time.monotonic()) * 1000)
+            if remaining <= 0:
+                break
             try:
-                self.redis_client.xadd(
-                    name=f"event_gen:{topic}:cache",
-                    fields={"encoded": json.dumps(my_message_dict)},
-                    id=f"{message.publish_timestamp()}-{n}",
-                )
+                messages.append(self.consumer.receive(timeout_millis=remaining))
+            except Exception:  # Pulsar raises a plain Exception on timeout
                 break
-            except redis.exceptions.ResponseError:
-                # This error happens if there are multiple messages
-                # within the same millisecond, increment
-                # the secondary id to deconflict
-                n += 1
+        return messages
 
-        consumer.acknowledge(message)
+    def acknowledge(self, messages):
+        """
+        Acknowledge a batch with one cumulative ack per topic, falling back to
+        individual acks if the consumer does not support them.
+        """
+        if self.cumulative_ack:
+            last = {}
+            for message in messages:
+                last[message.topic_name()] = message
+            try:
+                for message in last.values():
+                    self.consumer.acknowledge_cumulative(message)
+                return
+            except Exception as e:  # Pulsar doesn't provide a subtype of Exception
+                logger.warning(f"Cumulative acknowledgement unavailable: {e}")
+                self.cumulative_ack = False
+        for message in messages:
+            self.consumer.acknowledge(message)
 
     def start(self):
-        self.consumer.resume_message_listener()
+        while True:
+            messages = self.receive_batch()
+            try:
+                self.cache_messages(messages)
+            except redis.exceptions.RedisError as e:
+                logger.warning(f"Failed to cache {len(messages)} messages: {e}")
+                for message in messages:
+                    self.consumer.negative_acknowledge(message)
+                time.sleep(1)
+                continue
+            self.acknowledge(messages)
 
 
 if __name__ == "__main__":
     message_processor = MessageProcesser()
     print("Finished initializing message processor")
-    message_processor.start()
     try:
-        while True:
-            time.sleep(1)
+        message_processor.start()
     except KeyboardInterrupt:
         print("Interrupted.")
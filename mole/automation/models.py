@@ -1,5 +1,9 @@
 from django.contrib.gis.db import models
-from django.db.models import JSONField
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import JSONField, signals
+
+from data_collection import models as dcm
 
 class ScriptedEvent(models.Model):
     name = models.CharField(max_length=100, blank=False, null=False, unique=False)
@@ -110,4 +114,36 @@ class Script(models.Model):
     )
 
     def __str__(self):
-        return self.name
\ No newline at end of file
+        return self.name
+
+
+# Scenario scripts are compiled into cached plans (see ScenarioScripts), tagged with
+# this version so a change made through any worker recompiles them everywhere
+SCRIPT_PLAN_VERSION_KEY = "automation_script_plan_version"
+
+
+def script_configuration_changed(sender, **kwargs):
+    def bump():
+        try:
+            cache.incr(SCRIPT_PLAN_VERSION_KEY)
+        except ValueError:
+            cache.set(SCRIPT_PLAN_VERSION_KEY, 1, None)
+        except Exception:  # cache backend unavailable, nothing shared to invalidate
+            pass
+
+    bump()
+    transaction.on_commit(bump)
+
+
+for _script_model in (Script, ScriptedEvent, ScriptCondition, dcm.EventType):
+    signals.post_save.connect(script_configuration_changed, sender=_script_model)
+    signals.post_delete.connect(script_configuration_changed, sender=_script_model)
+for _script_relation in (
+    Script.conditions,
+    Script.initiating_event_types,
+    ScriptedEvent.conditions,
+    dcm.Scenario.scripts,
+):
+    signals.m2m_changed.connect(
+        script_configuration_changed, sender=_script_relation.through
+    )
@@ -1,197 +1,355 @@
 import os
 import json
-import automation.factories.factories as factories
-from django.shortcuts import get_object_or_404
-from django.http import Http404
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import BooleanField, Case, Count, Q, Value, When
 import redis
-import pulsar
 
-import sys
 import uuid
 
+from automation import models as am
 from data_collection.models import Event
+from data_collection.producers import producers
+
+
+class PlanCondition:
+    """
+    A ScriptCondition as plain values.  The trial_has_event and trial_missing_event checks
+    are answered for a whole trial at once by ScriptPlan.trial_condition_counts.
+    """
+
+    def __init__(self, condition):
+        self.id = condition.id
+        self.trial_has_event = condition.trial_has_event_id
+        self.trial_missing_event = condition.trial_missing_event_id
+        self.event_metadata_contains = condition.event_metadata_contains
+        self.event_metadata_excludes = condition.event_metadata_excludes
+        self.trigger_metadata_contains = condition.trigger_metadata_contains
+        self.trigger_metadata_excludes = condition.trigger_metadata_excludes
+
+    def passed(self, trial_counts, meta_str):
+        passed = False
+        if self.trial_has_event and trial_counts[f"has_{self.id}"] > 0:
+            passed = True
+        if self.trial_missing_event and trial_counts[f"missing_{self.id}"] == 0:
+            passed = True
+        # check if the triggering metadata contains/excludes specified substring
+        if self.trigger_metadata_contains and self.trigger_metadata_contains in meta_str:
+            passed = True
+        if (
+            self.trigger_metadata_excludes
+            and self.trigger_metadata_excludes not in meta_str
+        ):
+            passed = True
+        return passed
+
+
+class PlanStep:
+    # A scripted event in a script's chain
+    def __init__(self, scripted_event):
+        self.event_type = scripted_event.event_type.name
+        self.delay_seconds = scripted_event.delay_seconds or 0
+        self.add_event_metadata = scripted_event.add_event_metadata
+        self.copy_trigger_metadata = scripted_event.copy_trigger_metadata
+        self.conditions = [c.id for c in scripted_event.conditions.all()]
+        self.conditions_pass_if_any = scripted_event.conditions_pass_if_any
+
+
+class PlanScript:
+    # A script with its scripted event chain flattened into steps
+    def __init__(self, script, steps):
+        self.id = script.id
+        self.initiating_event_types = set(x.id for x in script.initiating_event_types.all())
+        self.cancelling_event_type = script.cancelling_event_type_id
+        self.run_limit = script.run_limit
+        self.auto_repeat_count = script.auto_repeat_count
+        self.conditions = [c.id for c in script.conditions.all()]
+        self.conditions_pass_if_any = script.conditions_pass_if_any
+        self.steps = steps
+
+
+class ScriptPlan:
+    """
+    A scenario's scripts compiled once into plain data: each script's chain of scripted
+    events as a list of steps, and every condition they use.  Plans are cached by
+    ScenarioScripts until an automation model changes.
+    """
+
+    def __init__(self, scenario_id):
+        scripts = list(
+            am.Script.objects.filter(scenarios__id=scenario_id)
+            .prefetch_related("initiating_event_types", "conditions")
+            .order_by("id")
+        )
+
+        # load every scripted event reachable from the heads, a level of the chains at a time
+        scripted_events = {}
+        to_load = set(s.scripted_event_head_id for s in scripts)
+        to_load.discard(None)
+        while to_load:
+            loaded = (
+                am.ScriptedEvent.objects.filter(id__in=to_load)
+                .select_related("event_type")
+                .prefetch_related("conditions")
+            )
+            scripted_events.update((x.id, x) for x in loaded)
+            to_load = set(x.next_scripted_event_id for x in loaded)
+            to_load.difference_update(scripted_events)
+            to_load.discard(None)
+
+        conditions = {}
+        self.scripts = []
+        for script in scripts:
+            conditions.update((c.id, c) for c in script.conditions.all())
+            steps = []
+            visited = set()
+            scripted_event_id = script.scripted_event_head_id
+            # a chain that loops back on itself ends where it first repeats
+            while scripted_event_id is not None and scripted_event_id not in visited:
+                visited.add(scripted_event_id)
+                scripted_event = scripted_events[scripted_event_id]
+                conditions.update((c.id, c) for c in scripted_event.conditions.all())
+                steps.append(PlanStep(scripted_event))
+                scripted_event_id = scripted_event.next_scripted_event_id
+            self.scripts.append(PlanScript(script, steps))
+        self.conditions = {k: PlanCondition(v) for k, v in conditions.items()}
+
+    def condition_filters(self):
+        """
+        The Q each trial_has_event and trial_missing_event condition of the plan counts
+        events with, by trial_condition_counts key, and the event types they cover.
+        """
+        filters = {}
+        event_types = set()
+        for condition in self.conditions.values():
+            if condition.trial_has_event:
+                # check if the event contains/excludes required metadata (if described)
+                match = Q(event_type_id=condition.trial_has_event)
+                if condition.event_metadata_contains:
+                    match &= Q(metadata__icontains=condition.event_metadata_contains)
+                if condition.event_metadata_excludes:
+                    match &= ~Q(metadata__icontains=condition.event_metadata_excludes)
+                filters[f"has_{condition.id}"] = match
+                event_types.add(condition.trial_has_event)
+            if condition.trial_missing_event:
+                filters[f"missing_{condition.id}"] = Q(
+                    event_type_id=condition.trial_missing_event
+                )
+                event_types.add(condition.trial_missing_event)
+        return filters, event_types
+
+    def trial_condition_counts(self, trial_id, exclude_ids=()):
+        """
+        Matching event counts in the trial for every trial_has_event and
+        trial_missing_event condition of the plan, leaving out the excluded events, in
+        one query.
+        """
+        filters, event_types = self.condition_filters()
+        if not filters:
+            return {}
+        return (
+            Event.objects.filter(trial_id=trial_id, event_type__in=event_types)
+            .exclude(id__in=exclude_ids)
+            .aggregate(**{k: Count("id", filter=v) for k, v in filters.items()})
+        )
+
+    def events_counted_keys(self, event_ids):
+        """
+        The trial_condition_counts keys each of the events counts towards by event id,
+        matched by the database with the same filters, in one query.
+        """
+        filters, event_types = self.condition_filters()
+        if not filters or not event_ids:
+            return {}
+        rows = (
+            Event.objects.filter(id__in=event_ids, event_type__in=event_types)
+            .annotate(
+                **{
+                    k: Case(
+                        When(v, then=Value(True)),
+                        default=Value(False),
+                        output_field=BooleanField(),
+                    )
+                    for k, v in filters.items()
+                }
+            )
+            .values("id", *filters)
+        )
+        return {row.pop("id"): [k for k, v in row.items() if v] for row in rows}
+
+    def conditions_passed(self, condition_ids, pass_if_any, trial_counts, meta_str):
+        # no conditions always pass
+        if not condition_ids:
+            return True
+        results = (
+            self.conditions[x].passed(trial_counts, meta_str) for x in condition_ids
+        )
+        return any(results) if pass_if_any else all(results)
 
 
 class ScenarioScripts:
+    version_key = am.SCRIPT_PLAN_VERSION_KEY
+
     def __init__(self):
         redis_ip = os.environ.get("REDIS_IP", "redis")
         redis_port = os.environ.get("REDIS_PORT", "6379")
         self.redis_client = redis.Redis(host=redis_ip, port=redis_port, decode_responses=True)
-        self.pulsar_client = pulsar.Client("pulsar://pulsar:6650")
-        self.delay_seconds = 0
+        self._version = None
+        self._plans = {}
 
-    def schedule_events(self, event):
-        scripts = event.trial.scenario.scripts
-        if len(scripts.all()) == 0:
-            return
+    def get_plan(self, scenario_id):
+        """
+        The compiled plan for a scenario, compiled again after any automation model change.
+        """
+        try:
+            version = cache.get(self.version_key)
+        except Exception:  # cache backend unavailable, compile every time
+            return ScriptPlan(scenario_id)
+
+        if version != self._version:
+            self._plans = {}
+            self._version = version
+        plan = self._plans.get(scenario_id)
+        if plan is None:
+            plan = ScriptPlan(scenario_id)
+            self._plans[scenario_id] = plan
+        return plan
 
-        if len(event.trial.script_run_count.all()) == 0:
-            self.init_trial_script_run_count(event.trial, scripts)
+    def schedule_events(self, event):
+        self.schedule_event_batch([event])
+
+    def schedule_event_batch(self, events):
+        # Plans, run counts and trial conditions are looked up once per trial rather than
+        # per event, then each event is run through the scripts in the order given.
+        events_by_trial = {}
+        for event in events:
+            events_by_trial.setdefault(event.trial_id, []).append(event)
+
+        producer = None
+        for trial_id, trial_events in events_by_trial.items():
+            plan = self.get_plan(trial_events[0].trial.scenario_id)
+            if not plan.scripts:
+                continue
+
+            if producer is None:
+                try:
+                    # unbatched, scheduled message ids are kept in redis for cancellation
+                    producer = producers.get(
+                        "public/default/_create_script_event", batching_enabled=False
+                    )
+                except Exception:  # Pulsar doesn't provide a subtype of Exception
+                    # abort the pulsar message if pulsar is not available
+                    return
+
+            # the run counts stay locked until they are written back, so batches for the
+            # same trial in other workers wait instead of running scripts past run_limit
+            with transaction.atomic():
+                run_counts = self.get_run_counts(trial_id, plan)
+                self.schedule_trial_events(
+                    producer, plan, trial_id, trial_events, run_counts
+                )
 
-        try:
-            producer = self.pulsar_client.create_producer("public/default/_create_script_event")
-        except Exception:  # Pulsar doesn't provide a subtype of Exception
-            # abort the pulsar message if pulsar is not available
-            return
-
-        self.delay_seconds = 0
-        
-        for script in scripts.all():
+    def get_run_counts(self, trial_id, plan):
+        """
+        The trial's ScriptRunCount of each script in the plan by script id, creating any
+        that are missing.  The rows are locked, so call inside a transaction.
+        """
+        run_counts = {
+            x.script_id: x
+            for x in am.ScriptRunCount.objects.select_for_update().filter(trial_id=trial_id)
+        }
+        missing = [
+            am.ScriptRunCount(trial_id=trial_id, script_id=s.id, count=0)
+            for s in plan.scripts
+            if s.id not in run_counts
+        ]
+        if missing:
+            am.ScriptRunCount.objects.bulk_create(missing, ignore_conflicts=True)
+            run_counts = {
+                x.script_id: x
+                for x in am.ScriptRunCount.objects.select_for_update().filter(
+                    trial_id=trial_id
+                )
+            }
+        return run_counts
+
+    def schedule_trial_events(self, producer, plan, trial_id, events, run_counts):
+        # The events are committed before they are scheduled, so the batch is left out of
+        # the counts and each event is added back as it is reached.  An event's conditions
+        # see the events before it and itself, as if each had been scheduled on its own.
+        batch_ids = [event.id for event in events]
+        trial_counts = plan.trial_condition_counts(trial_id, exclude_ids=batch_ids)
+        counted_keys = plan.events_counted_keys(batch_ids)
+        run_counts_before = {k: v.count for k, v in run_counts.items()}
+        for event in events:
+            for key in counted_keys.get(event.id, ()):
+                trial_counts[key] += 1
+            self.run_scripts(producer, plan, trial_counts, run_counts, event)
+        changed = [x for k, x in run_counts.items() if x.count != run_counts_before[k]]
+        if changed:
+            am.ScriptRunCount.objects.bulk_update(changed, ["count"])
+
+    def run_scripts(self, producer, plan, trial_counts, run_counts, event):
+        delay_seconds = 0
+        meta_str = json.dumps(event.metadata)
+
+        for script in plan.scripts:
+            run_count = run_counts[script.id]
             if (
-                event.event_type in script.initiating_event_types.all()
-                and script.scripted_event_head
-                and self.check_script_condition(script, event)
+                event.event_type_id in script.initiating_event_types
+                and script.steps
+                # check if the script's run limit has been met
+                and run_count.count != script.run_limit
+                and plan.conditions_passed(
+                    script.conditions, script.conditions_pass_if_any, trial_counts, meta_str
+                )
             ):
-                # because of the recursive algorithm, we need to set python's recursion 
-                # limit to the depth of the script
-                self.set_recursion_limit(script)
-
-                cond_passed = self.check_script_condition(script.scripted_event_head, event)
-                self.schedule_scripted_event(producer, script.scripted_event_head, event, cond_passed)
-                self.increment_script_run_count(event.trial, script)
-                
-                if script.auto_repeat_count:
-                    self.schedule_script_repeat(script, event, producer, cond_passed, script.auto_repeat_count)
-                else:
-                    self.delay_seconds = 0 # reset delay
-            elif event.event_type == script.cancelling_event_type:
+                steps_passed = [
+                    plan.conditions_passed(
+                        step.conditions, step.conditions_pass_if_any, trial_counts, meta_str
+                    )
+                    for step in script.steps
+                ]
+                # the chain repeats auto_repeat_count more times if its head passed
+                runs = 1 + (script.auto_repeat_count if steps_passed[0] else 0)
+                for _ in range(runs):
+                    for step, passed in zip(script.steps, steps_passed):
+                        if passed:
+                            delay_seconds += step.delay_seconds
+                            self.schedule_scripted_event(
+                                producer, step, event, delay_seconds
+                            )
+                    run_count.count += 1
+
+                if not script.auto_repeat_count:
+                    delay_seconds = 0  # reset delay
+            elif event.event_type_id == script.cancelling_event_type:
                 self.cancel_scheduled_events(producer)
-        
-        producer.close()
-        return
 
-    def schedule_script_repeat(self, script, event, producer, condition_passed, repeat_count):
-        if condition_passed and repeat_count > 0:
-            repeat_count = repeat_count - 1
-            cond_passed = self.check_script_condition(script.scripted_event_head, event)
-            self.schedule_scripted_event(producer, script.scripted_event_head, event, cond_passed)
-            self.increment_script_run_count(event.trial, script)
+    def schedule_scripted_event(self, producer, step, event, delay_seconds):
+        metadata = dict(step.add_event_metadata)
+        if step.copy_trigger_metadata:
+            metadata.update(event.metadata)
 
-            self.schedule_script_repeat(script, event, producer, cond_passed, repeat_count)
-        return
+        event_data = {
+            "trial": f"/api/trials/{event.trial_id}/",
+            "event_type": step.event_type,
+            "metadata": metadata
+        }
 
-    def init_trial_script_run_count(self, trial, scripts):
-        for script in scripts.all():
-            factories.ScriptRunCountFactory(
-                trial = trial,
-                script = script,
-                count = 0,
+        if delay_seconds == 0:
+            producer.send_async(
+                json.dumps(event_data).encode("utf-8"),
+                None
             )
-
-        return
-
-    def increment_script_run_count(self, trial, script):
-        count = trial.script_run_count.get(script__id=script.id)
-        count.count = count.count + 1
-        count.save()
-        return
-
-    def check_script_condition(self, script, event):
-        cond_passed = False
-
-        # check if the script's run limit has been met
-        try:
-            run_count = get_object_or_404(event.trial.script_run_count.all(), script__id=script.id)
-            if run_count and run_count.count == script.run_limit:
-                return False
-        except (Http404, AttributeError):
-            pass # do nothing because it's evaluating a scripted event, not a script
-
-        # if scripted event has no conditions, set true
-        if len(script.conditions.all()) == 0:
-            cond_passed = True
         else:
-            cond_passed_list = []
-            for cond in script.conditions.all():
-                temp_passed = False
-
-                # check if trial contains event in condition
-                if cond.trial_has_event:
-                    qry = Event.objects.filter(
-                        trial__id=event.trial.id,
-                        event_type__id=cond.trial_has_event.id
-                    )
-
-                    # check if the event contains/excludes required metadata (if described)
-                    if cond.event_metadata_contains:
-                        qry = qry.filter(
-                            metadata__icontains=cond.event_metadata_contains
-                        )
-                    if cond.event_metadata_excludes:
-                        qry = qry.exclude(
-                            metadata__icontains=cond.event_metadata_excludes
-                        )
-
-                    events = qry.values_list(*["id"])
-                    if len(events) > 0:
-                        temp_passed = True
-
-                # check if trial is missing event in condition
-                if cond.trial_missing_event:
-                    qry = Event.objects.filter(
-                        trial__id=event.trial.id,
-                        event_type__id=cond.trial_has_event.id
-                    ).values_list(*["id"])
-                    if len(qry) == 0:
-                        temp_passed = True
-
-                # check if the triggering metadata contains/excludes specified substring
-                meta_str = json.dumps(event.metadata)
-                if cond.trigger_metadata_contains:
-                    if cond.trigger_metadata_contains in meta_str:
-                        temp_passed = True
-                if cond.trigger_metadata_excludes:
-                    if cond.trigger_metadata_excludes not in meta_str:
-                        temp_passed = True
-
-                cond_passed_list.append(temp_passed)
-            
-            if script.conditions_pass_if_any:
-                cond_passed = any(cond_passed_list)
-            else:
-                cond_passed = all(cond_passed_list)
-
-        return cond_passed
-
-
-    def schedule_scripted_event(self, producer, script, event, condition_passed):
-
-        if condition_passed:
-
-            metadata = script.add_event_metadata
-
-            if script.copy_trigger_metadata:
-                for key, val in event.metadata.items():
-                    metadata[key] = val
-
-            event_data = {
-                "trial": f"/api/trials/{event.trial.id}/",
-                "event_type": script.event_type.name,
-                "metadata": metadata
-            }
-
-            self.delay_seconds = self.delay_seconds + script.delay_seconds
-
-            if self.delay_seconds == 0 and script.delay_seconds == 0:
-                producer.send_async(
-                    json.dumps(event_data).encode("utf-8"), 
-                    None
-                )
-            else:
-                deliver_time = int(event.modified_datetime.timestamp() + self.delay_seconds) * 1000
-                event_data["deliver_at"] = deliver_time
-                producer.send_async(
-                    json.dumps(event_data).encode("utf-8"),
-                    self.scheduled_message_callback,
-                    deliver_at=deliver_time
-                )
-
-        if script.next_scripted_event:
-            cond_passed = self.check_script_condition(script.next_scripted_event, event)
-            self.schedule_scripted_event(producer, script.next_scripted_event, event, cond_passed)
-
-        return
-
+            deliver_time = int(event.modified_datetime.timestamp() + delay_seconds) * 1000
+            event_data["deliver_at"] = deliver_time
+            producer.send_async(
+                json.dumps(event_data).encode("utf-8"),
+                self.scheduled_message_callback,
+                deliver_at=deliver_time
+            )
 
     def cancel_scheduled_events(self, producer):
         # scheduled_events = self.redis_client.hgetall("scheduled_message_map")
@@ -209,21 +367,3 @@ class ScenarioScripts:
         self.redis_client.lpush("scheduled_message_keys", unique_id)
         print(unique_id+" scheduled.")
         return
-
-    def set_recursion_limit(self, script):
-        # get depth of script
-        script_depth = self.get_script_depth(script)
-        recursion_count = script_depth * (script.auto_repeat_count+1)
-
-        if recursion_count > sys.getrecursionlimit():
-            sys.setrecursionlimit(recursion_count)
-
-    def get_script_depth(self, script):
-        scripted_event = script.scripted_event_head
-        
-        depth = 1
-        while scripted_event.next_scripted_event:
-            depth = depth + 1
-            scripted_event = scripted_event.next_scripted_event
-        
-        return depth
\ No newline at end of file
@@ -47,7 +47,7 @@ if [ ! -d mole/static ]; then
 fi
 
 if [[ $DEBUG_DJANGO == "true" ]]; then
-  exec gunicorn mole.wsgi --bind :8000 --workers 1 --timeout 3600 --log-level="debug" --capture-output --log-config _logs/gunicorn_log.conf --access-logformat '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s"'
+  exec gunicorn mole.wsgi --config gunicorn.conf.py --bind :8000 --workers 1 --timeout 3600 --log-level="debug" --capture-output --log-config _logs/gunicorn_log.conf --access-logformat '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s"'
 else
-  exec gunicorn mole.wsgi --bind :8000 --workers 5 --timeout 3600 --capture-output --log-config _logs/gunicorn_log.conf --access-logformat '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s"'
+  exec gunicorn mole.wsgi --config gunicorn.conf.py --bind :8000 --workers 5 --timeout 3600 --capture-output --log-config _logs/gunicorn_log.conf --access-logformat '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s"'
 fi
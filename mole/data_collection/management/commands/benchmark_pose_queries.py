@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+import datetime
+
+from django.contrib.gis.geos import Polygon
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from data_collection import models as dcm
+from data_collection.factories import factories
+
+POSE_INDEXES = [index.name for index in dcm.Pose._meta.indexes]
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Load synthetic poses and print query plans for the hot pose queries with and "
+        "without the pose indexes.  Everything runs in a transaction that is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--poses", type=int, default=1000000)
+        parser.add_argument("--entities", type=int, default=200)
+        parser.add_argument("--trials", type=int, default=10)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.load(options["poses"], options["entities"], options["trials"])
+                self.stdout.write("==== with pose indexes ====")
+                self.explain_all()
+                with connection.cursor() as cursor:
+                    for name in POSE_INDEXES:
+                        cursor.execute(f"DROP INDEX {name}")
+                    # restore the single column FK indexes these replaced
+                    cursor.execute(
+                        "CREATE INDEX bench_pose_entity ON data_collection_pose (entity_id)"
+                    )
+                    cursor.execute(
+                        "CREATE INDEX bench_pose_trial ON data_collection_pose (trial_id)"
+                    )
+                    cursor.execute("ANALYZE data_collection_pose")
+                self.stdout.write("==== without pose indexes ====")
+                self.explain_all()
+                raise _Rollback
+        except _Rollback:
+            pass
+
+    def load(self, poses, entities, trials):
+        pose_source = factories.PoseSourceFactory(name="benchmark_pose_source")
+        trial_ids = [
+            factories.TrialFactory(id_major=9000 + i, id_minor=0, id_micro=0).id
+            for i in range(trials)
+        ]
+        dcm.Entity.objects.bulk_create(
+            [dcm.Entity(name=f"benchmark_entity_{i}") for i in range(entities)]
+        )
+        self.trial_id = trial_ids[len(trial_ids) // 2]
+        self.entity_name = "benchmark_entity_0"
+        self.start = timezone.now() - datetime.timedelta(seconds=poses)
+
+        self.stdout.write(f"Loading {poses} poses...")
+        with connection.cursor() as cursor:
+            # one pose per second, round robin over entities, trials in consecutive blocks
+            cursor.execute(
+                'INSERT INTO data_collection_pose (point, entity_id, pose_source_id, "timestamp", trial_id, velocity) '
+                "SELECT ST_SetSRID(ST_MakePoint(-117.25 + random() * 0.1, 32.70 + random() * 0.1), 4326), "
+                "'benchmark_entity_' || (n %% %s), %s, %s + n * interval '1 second', "
+                "(%s::int[])[1 + (n * %s / %s)], '{}' "
+                "FROM generate_series(0, %s - 1) AS n",
+                [entities, pose_source.id, self.start, trial_ids, trials, poses, poses],
+            )
+            cursor.execute("ANALYZE data_collection_pose")
+
+    def explain_all(self):
+        window_start = self.start + datetime.timedelta(hours=1)
+        window_end = window_start + datetime.timedelta(minutes=10)
+        region = Polygon.from_bbox((-117.23, 32.72, -117.22, 32.73))
+        region.srid = 4326
+        poses = dcm.Pose.objects.all()
+        queries = {
+            "entity track": poses.filter(entity=self.entity_name).order_by("-timestamp")[:50],
+            "trial window": poses.filter(
+                trial=self.trial_id, timestamp__range=(window_start, window_end)
+            ),
+            "latest per entity in trial": poses.filter(trial=self.trial_id)
+            .order_by("entity", "-timestamp")
+            .distinct("entity"),
+            "time range": poses.filter(timestamp__range=(window_start, window_end)),
+            "default list page": poses.order_by("-timestamp")[:50],
+            "within region": poses.filter(point__within=region)
+            .order_by("entity")
+            .distinct("entity")
+            .values_list("entity"),
+        }
+        for label, queryset in queries.items():
+            self.stdout.write(f"--- {label}")
+            self.stdout.write(queryset.explain(analyze=True))
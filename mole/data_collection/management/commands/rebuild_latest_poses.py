@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from data_collection import models as dcm
+
+
+class Command(BaseCommand):
+    help = (
+        "Repopulate the latest pose store for every entity and the region visit history "
+        "from the pose table."
+    )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            dcm.rebuild_latest_poses()
+        count = dcm.LatestPose.objects.count()
+        visits = dcm.RegionVisit.objects.count()
+        self.stdout.write(f"Rebuilt latest poses for {count} entities and {visits} region visits")
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+import json
+import logging
+import time
+
+import pulsar
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, close_old_connections, connection, transaction
+from django.utils import timezone
+
+from data_collection import models as dcm
+from data_collection.producers import producers
+
+log = logging.getLogger("mole")
+
+# Postgres advisory lock held for each batch.  Only one relay publishes at a time, so
+# messages on a topic are published in order even with several relays running.
+RELAY_LOCK_ID = 7_301_001
+
+
+class Command(BaseCommand):
+    help = "Publish queued outbox messages to Pulsar in batches, retrying failures."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=0.2,
+            help="Seconds to wait when the outbox is empty.",
+        )
+        parser.add_argument(
+            "--retry-delay",
+            type=float,
+            default=2.0,
+            help="Seconds to wait after a batch with failed sends.",
+        )
+        parser.add_argument(
+            "--max-attempts",
+            type=int,
+            default=50,
+            help="Failed sends before a message is dead lettered and skipped.",
+        )
+        parser.add_argument(
+            "--once", action="store_true", help="Drain the outbox once and exit."
+        )
+
+    def handle(self, *args, **options):
+        try:
+            while True:
+                try:
+                    sent, failed = self.relay_batch(
+                        options["batch_size"], options["max_attempts"]
+                    )
+                except OperationalError as e:
+                    # database restarting; drop the connection and try again
+                    log.warning("Outbox relay database error: %s", e)
+                    close_old_connections()
+                    sent, failed = 0, 1
+
+                if options["once"] and (sent == 0 or failed):
+                    break
+                if failed:
+                    time.sleep(options["retry_delay"])
+                elif sent < options["batch_size"]:
+                    time.sleep(options["interval"])
+        finally:
+            producers.close()
+
+    def relay_batch(self, batch_size, max_attempts):
+        """
+        Publish one batch in id order and delete what was delivered.  A batch holds the
+        relay advisory lock, so a second relay waits rather than publishing out of order.
+        Once a message on a topic fails, later messages on that topic are kept and sent
+        again with it, even if they were delivered, so consumers may see duplicates but
+        never a gap.  Messages failing max_attempts times are dead lettered and no longer
+        hold up their topic.  Returns (sent, failed).
+        """
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_try_advisory_xact_lock(%s)", [RELAY_LOCK_ID])
+                if not cursor.fetchone()[0]:
+                    return 0, 0
+
+            messages = list(
+                dcm.OutboxMessage.objects.filter(dead_lettered_datetime__isnull=True)
+                .select_for_update()
+                .order_by("id")[:batch_size]
+            )
+            if not messages:
+                return 0, 0
+
+            results = {}
+            used = {}
+            blocked = set()
+            skipped = set()
+            for message in messages:
+                if message.topic in blocked:
+                    # keep per-topic order, retry behind the message that failed
+                    skipped.add(message.id)
+                    continue
+                try:
+                    producer = producers.get(message.topic)
+                    used[message.topic] = producer
+                    producer.send_async(
+                        json.dumps(message.payload).encode("utf-8"),
+                        self.make_callback(results, message.id),
+                    )
+                except Exception as e:  # Pulsar doesn't provide a subtype of Exception
+                    results[message.id] = str(e)
+                    blocked.add(message.topic)
+                    producers.discard(message.topic)
+
+            for topic, producer in used.items():
+                try:
+                    producer.flush()
+                except Exception as e:  # Pulsar doesn't provide a subtype of Exception
+                    log.warning("Outbox relay flush to %s failed: %s", topic, e)
+
+            # Receipts arrive asynchronously, so a later message can be delivered after
+            # an earlier one on its topic failed.  Walk the batch in order and keep
+            # everything on a topic from its first failure on.
+            delivered = set()
+            failed = []
+            failed_topics = set()
+            now = timezone.now()
+            for message in messages:
+                error = results.get(message.id, "No delivery receipt")
+                if message.id in skipped or (
+                    error is None and message.topic in failed_topics
+                ):
+                    # not a failure of its own, so it doesn't count as an attempt
+                    message.last_error = "Earlier message on topic failed"
+                    failed.append(message)
+                    continue
+                if error is None:
+                    delivered.add(message.id)
+                    continue
+                failed_topics.add(message.topic)
+                message.attempts += 1
+                message.last_error = error
+                if message.attempts >= max_attempts:
+                    message.dead_lettered_datetime = now
+                    log.error(
+                        "Outbox message %d to %s dead lettered after %d attempts: %s",
+                        message.id,
+                        message.topic,
+                        message.attempts,
+                        error,
+                    )
+                failed.append(message)
+
+            dcm.OutboxMessage.objects.filter(id__in=delivered).delete()
+            dcm.OutboxMessage.objects.bulk_update(
+                failed, ["attempts", "last_error", "dead_lettered_datetime"]
+            )
+
+        if failed:
+            log.warning(
+                "Outbox relay failed to publish %d of %d messages", len(failed), len(messages)
+            )
+        return len(delivered), len(failed)
+
+    def make_callback(self, results, message_id):
+        # Maps a message id to None on success or an error string
+        def callback(result, pulsar_message_id):
+            results[message_id] = None if result == pulsar.Result.Ok else str(result)
+
+        return callback
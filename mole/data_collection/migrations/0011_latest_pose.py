@@ -0,0 +1,34 @@
+# Generated by Django 3.2.13 on 2026-10-18 09:12
+
+import django.contrib.gis.db.models.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_collection', '0010_create_metadata_keys_values'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LatestPose',
+            fields=[
+                ('entity', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='latest_pose_entry', serialize=False, to='data_collection.entity')),
+                ('point', django.contrib.gis.db.models.fields.PointField(srid=4326)),
+                ('timestamp', models.DateTimeField()),
+                ('pose', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='data_collection.pose')),
+                ('trial', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='data_collection.trial')),
+            ],
+        ),
+        # Backfill the store from existing poses
+        migrations.RunSQL(
+            sql=(
+                'INSERT INTO data_collection_latestpose (entity_id, pose_id, point, "timestamp", trial_id) '
+                'SELECT DISTINCT ON (entity_id) entity_id, id, point, "timestamp", trial_id '
+                'FROM data_collection_pose ORDER BY entity_id, "timestamp" DESC, id DESC'
+            ),
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 3.2.13 on 2026-10-18 10:41
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    # Indexes are built concurrently so pose ingest is not blocked on large tables
+    atomic = False
+
+    dependencies = [
+        ('data_collection', '0011_latest_pose'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='pose',
+            index=models.Index(fields=['entity', '-timestamp'], name='pose_entity_ts_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='pose',
+            index=models.Index(fields=['trial', '-timestamp'], name='pose_trial_ts_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='pose',
+            index=models.Index(fields=['trial', 'entity', '-timestamp'], name='pose_trial_entity_ts_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='pose',
+            index=models.Index(fields=['-timestamp'], name='pose_ts_idx'),
+        ),
+        migrations.AlterField(
+            model_name='pose',
+            name='entity',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='poses', to='data_collection.entity'),
+        ),
+        migrations.AlterField(
+            model_name='pose',
+            name='trial',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='poses', to='data_collection.trial'),
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 3.2.13 on 2026-10-18 15:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_collection', '0013_outbox_message'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RegionVisit',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('entered', models.DateTimeField()),
+                ('exited', models.DateTimeField(blank=True, null=True)),
+                ('entity', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='region_visits', to='data_collection.entity')),
+                ('entry_pose', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='data_collection.pose')),
+                ('exit_pose', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='data_collection.pose')),
+                ('region', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='visits', to='data_collection.region')),
+                ('trial', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='region_visits', to='data_collection.trial')),
+            ],
+            options={
+                'ordering': ['entered', 'id'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='regionvisit',
+            index=models.Index(fields=['trial', 'region', 'entered'], name='region_visit_trial_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='regionvisit',
+            index=models.Index(fields=['entity', 'entered'], name='region_visit_entity_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='regionvisit',
+            constraint=models.UniqueConstraint(condition=models.Q(('exited__isnull', True)), fields=('region', 'entity'), name='region_visit_one_open'),
+        ),
+        migrations.RunSQL(
+            # backfill visit history from poses already recorded
+            sql="""
+            WITH ordered AS (
+                SELECT id, entity_id, trial_id, point, "timestamp",
+                    row_number() OVER w AS n,
+                    lead(id) OVER w AS next_id,
+                    lead("timestamp") OVER w AS next_timestamp
+                FROM data_collection_pose
+                WINDOW w AS (PARTITION BY entity_id ORDER BY "timestamp", id)
+            ), inside AS (
+                SELECT o.*, r.name AS region_id, o.n - row_number() OVER (
+                    PARTITION BY o.entity_id, r.name, o.trial_id ORDER BY o."timestamp", o.id
+                ) AS run
+                FROM ordered AS o JOIN data_collection_region AS r ON ST_Contains(r.geom, o.point)
+            )
+            INSERT INTO data_collection_regionvisit
+                (region_id, entity_id, trial_id, entered, entry_pose_id, exited, exit_pose_id)
+            SELECT region_id, entity_id, trial_id, min("timestamp"),
+                (array_agg(id ORDER BY n))[1],
+                (array_agg(next_timestamp ORDER BY n DESC))[1],
+                (array_agg(next_id ORDER BY n DESC))[1]
+            FROM inside GROUP BY entity_id, region_id, trial_id, run;
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.13 on 2026-10-18 19:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_collection', '0014_region_visit'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='dead_lettered_datetime',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.2.13 on 2026-10-18 21:05
+
+import django.contrib.gis.db.models.fields
+from django.contrib.postgres.operations import AddIndexConcurrently
+import django.contrib.postgres.indexes
+from django.db import migrations
+import django.db.models.functions.comparison
+
+
+class Migration(migrations.Migration):
+
+    # Built concurrently so pose ingest, which upserts latest poses, is not blocked
+    atomic = False
+
+    dependencies = [
+        ('data_collection', '0015_outbox_dead_letter'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='latestpose',
+            index=django.contrib.postgres.indexes.GistIndex(django.db.models.functions.comparison.Cast('point', output_field=django.contrib.gis.db.models.fields.GeographyField(srid=4326)), name='latestpose_point_geog_idx'),
+        ),
+    ]
@@ -6,15 +6,19 @@ from django.utils import timezone
 import pytz
 
 from django.contrib.gis.db import models
+from django.contrib.gis.geos import GEOSGeometry
 from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GistIndex
 from django.db.models import JSONField
 from django.db.models import signals, Q
+from django.db.models.functions import Cast
 from easy_thumbnails.fields import ThumbnailerImageField
 
 from django.conf import settings
 from django.db.models import signals
 from django.utils.text import get_text_list
-from django.db import connection, IntegrityError
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connection, IntegrityError, transaction
 from django.utils.translation import ugettext as _
 
 # Set up image thumbnail pre-generation
@@ -447,15 +451,23 @@ class Trial(models.Model):
         return performers_str
 
     def __str__(self):
-        scenario = self.scenario
         #        performers = self.get_performers()
-        system_configuration = self.system_configuration.name
+        return self.format_name(
+            self.id_major,
+            self.id_minor,
+            self.id_micro,
+            self.system_configuration.name,
+            self.scenario,
+        )
 
-        major = self.id_major if self.id_major is not None else ""
-        minor_separator = "." if self.id_minor is not None else ""
-        minor = self.id_minor if self.id_minor is not None else ""
-        micro_separator = "." if self.id_micro is not None else ""
-        micro = self.id_micro if self.id_micro is not None else ""
+    @staticmethod
+    def format_name(id_major, id_minor, id_micro, system_configuration, scenario):
+        # Shared with exports that build trial names from values() rows
+        major = id_major if id_major is not None else ""
+        minor_separator = "." if id_minor is not None else ""
+        minor = id_minor if id_minor is not None else ""
+        micro_separator = "." if id_micro is not None else ""
+        micro = id_micro if id_micro is not None else ""
 
         return "{}{}{}{}{} ({}: {})".format(
             major,
@@ -597,9 +609,17 @@ class ClockConfig(models.Model):
         return self.name
 
 
-def set_clock_phase_start_end_times(clock_phases, trial):
+def set_clock_phase_start_end_times(clock_phases, trial, anchor_times=None):
+    """
+    Resolve each phase's start and end datetimes for the trial on the given phase instances.
+    Nothing is saved; anchor_times maps event type ids to the trial's most recent event of
+    that type and is queried if not provided.
+    """
+    clock_phases = list(clock_phases)
+    if anchor_times is None:
+        anchor_times = get_clock_anchor_times(clock_phases, trial)
 
-    for phase in clock_phases.all():
+    for phase in clock_phases:
 
         # SET START ANCHORS
         # rule: if multiple start times, select the most recent
@@ -619,14 +639,8 @@ def set_clock_phase_start_end_times(clock_phases, trial):
                 phase.starts_with_datetime = None
 
         # starts with event type:
-        if phase.starts_with_event_type:
-            event = Event.objects.filter(
-                trial__id=trial.id, event_type__id=phase.starts_with_event_type.id
-            ).first()
-            if event:
-                phase.starts_with_datetime = event.start_datetime
-            else:
-                phase.starts_with_datetime = None
+        if phase.starts_with_event_type_id:
+            phase.starts_with_datetime = anchor_times.get(phase.starts_with_event_type_id)
 
         # SET END ANCHORS
         # rule: if multiple end times, select the most recent
@@ -659,18 +673,16 @@ def set_clock_phase_start_end_times(clock_phases, trial):
 
         # ends with event type:
         ended_with_event_type = False
-        if phase.ends_with_event_type:
-            event = Event.objects.filter(
-                trial__id=trial.id, event_type__id=phase.ends_with_event_type.id
-            ).first()
-            if event:
+        if phase.ends_with_event_type_id:
+            event_datetime = anchor_times.get(phase.ends_with_event_type_id)
+            if event_datetime:
                 # if phase has start time, verify ending event occurs after the start time
                 if phase.starts_with_datetime:
-                    if event.start_datetime > phase.starts_with_datetime:
-                        phase.ends_with_datetime = event.start_datetime
+                    if event_datetime > phase.starts_with_datetime:
+                        phase.ends_with_datetime = event_datetime
                         ended_with_event_type = True
                 else:
-                    phase.ends_with_datetime = event.start_datetime
+                    phase.ends_with_datetime = event_datetime
                     ended_with_event_type = True
             else:
                 phase.ends_with_datetime = None
@@ -684,73 +696,205 @@ def set_clock_phase_start_end_times(clock_phases, trial):
             else:
                 phase.ends_with_datetime = None
 
-        phase.save()
-
     return clock_phases
 
 
-def get_next_clock_calltime(phases, trial):
+def get_clock_anchor_times(clock_phases, trial):
+    """
+    Map each event type anchoring one of the phases to the start of the trial's most recent
+    event of that type, in one query.
+    """
+    event_type_ids = set()
+    for phase in clock_phases:
+        event_type_ids.update(
+            [phase.starts_with_event_type_id, phase.ends_with_event_type_id]
+        )
+    event_type_ids.discard(None)
+    if not event_type_ids:
+        return {}
+    return dict(
+        Event.objects.filter(trial_id=trial.id, event_type_id__in=event_type_ids)
+        .order_by()
+        .values("event_type_id")
+        .annotate(latest=models.Max("start_datetime"))
+        .values_list("event_type_id", "latest")
+    )
+
+
+CLOCK_TIMELINE_VERSION_KEY = "data_collection_clock_timeline_version"
+CLOCK_TIMELINE_TIMEOUT = 60 * 60
 
-    tz = pytz.timezone(trial.clock_config.timezone)
-    now = datetime.now(tz)
+
+def _clock_timeline_key(trial_id):
+    version = cache.get(CLOCK_TIMELINE_VERSION_KEY, 0)
+    return "data_collection_clock_timeline:{}:{}".format(version, trial_id)
+
+
+def get_clock_timeline(trial):
+    """
+    The trial's clock phases with start and end datetimes resolved, from the shared cache
+    when available.  Computed at most once per change to the trial, its clock config or
+    the events anchoring its phases; reading it never writes to the database.
+    """
+    if not trial or not trial.clock_config_id:
+        return []
+
+    def compute():
+        phases = list(ClockPhase.objects.filter(clock_configs__id=trial.clock_config_id))
+        return set_clock_phase_start_end_times(phases, trial)
 
     try:
-        phase = phases.filter(
-            starts_with_datetime__isnull=False, starts_with_datetime__gte=now
-        ).earliest("starts_with_datetime")
+        key = _clock_timeline_key(trial.id)
+        timeline = cache.get(key)
+    except Exception:  # cache backend unavailable, fall back to the database
+        return compute()
+    if timeline is None:
+        timeline = compute()
+        try:
+            cache.set(key, timeline, CLOCK_TIMELINE_TIMEOUT)
+        except Exception:
+            pass
+    return timeline
 
-    except ClockPhase.DoesNotExist:
-        return None
 
-    if phase.starts_with_datetime:
-        return phase.starts_with_datetime
-    else:
-        return None
+def get_current_clock_times():
+    """
+    The current trial's resolved (starts_with_datetime, ends_with_datetime) of each of its
+    clock phases by phase id, from its cached timeline.
+    """
+    trial = Trial.objects.filter(current=True).first()
+    return {
+        phase.id: (phase.starts_with_datetime, phase.ends_with_datetime)
+        for phase in get_clock_timeline(trial)
+    }
 
 
-def get_clock_phase(trial):
+def clock_timelines_changed(trial_ids):
+    """
+    Drop the cached timelines of the given trials, now and again once the transaction
+    commits so a concurrent reader cannot re-cache the state from before the change.
+    """
+    keys = set(trial_ids)
+    if not keys:
+        return
 
-    # verify trial
-    if not trial:
-        return None, None
+    def delete():
+        try:
+            cache.delete_many([_clock_timeline_key(trial_id) for trial_id in keys])
+        except Exception:  # cache backend unavailable, nothing shared to invalidate
+            pass
+
+    delete()
+    transaction.on_commit(delete)
+
+
+def clock_events_changed(events):
+    """
+    Invalidate the timelines of trials whose phases may be anchored by the given events.
+    """
+    anchors = get_clock_anchor_event_types()
+    clock_timelines_changed(
+        set(event.trial_id for event in events if event.event_type_id in anchors)
+    )
+
+
+def get_clock_anchor_event_types():
+    """
+    Ids of every event type that starts or ends a clock phase, cached with the timelines.
+    """
+
+    def compute():
+        anchors = set()
+        for start, end in ClockPhase.objects.values_list(
+            "starts_with_event_type_id", "ends_with_event_type_id"
+        ):
+            anchors.update([start, end])
+        anchors.discard(None)
+        return anchors
+
+    try:
+        key = _clock_timeline_key("anchors")
+        anchors = cache.get(key)
+    except Exception:  # cache backend unavailable, fall back to the database
+        return compute()
+    if anchors is None:
+        anchors = compute()
+        try:
+            cache.set(key, anchors, CLOCK_TIMELINE_TIMEOUT)
+        except Exception:
+            pass
+    return anchors
+
+
+def clock_configuration_changed(sender, **kwargs):
+    # phases are shared between configs, so start every trial's timeline over
+    def bump():
+        try:
+            cache.incr(CLOCK_TIMELINE_VERSION_KEY)
+        except ValueError:
+            cache.set(CLOCK_TIMELINE_VERSION_KEY, 1, None)
+        except Exception:  # cache backend unavailable, nothing shared to invalidate
+            pass
+
+    bump()
+    transaction.on_commit(bump)
+
+
+def get_next_clock_calltime(phases, trial):
+
+    tz = pytz.timezone(trial.clock_config.timezone)
+    now = datetime.now(tz)
+
+    upcoming = [
+        phase.starts_with_datetime
+        for phase in phases
+        if phase.starts_with_datetime is not None and phase.starts_with_datetime >= now
+    ]
+    return min(upcoming) if upcoming else None
+
+
+def get_clock_phase(trial):
 
     # verify trial has clock phases
-    if not trial.clock_config:
-        return None, None
-    if trial.clock_config.phases.count == 0:
+    phases = get_clock_timeline(trial)
+    if not phases:
         return None, None
 
     # get current time
     tz = pytz.timezone(trial.clock_config.timezone)
     now = datetime.now(tz)
 
-    raw_phases = trial.clock_config.phases
-
-    # set the phase start and end times
-    phases = set_clock_phase_start_end_times(raw_phases, trial)
-
     # request phase based on current time
-    selected_phase = (
-        phases.filter(starts_with_datetime__lt=now, ends_with_datetime__gt=now)
-        .order_by("-starts_with_datetime")
-        .first()
-    )
+    candidates = [
+        phase
+        for phase in phases
+        if phase.starts_with_datetime is not None
+        and phase.ends_with_datetime is not None
+        and phase.starts_with_datetime < now < phase.ends_with_datetime
+    ]
+    selected_phase = max(candidates, key=lambda phase: phase.starts_with_datetime, default=None)
 
     # a phase may not have a start time, but might count down to an end time
     if not selected_phase:
-        selected_phase = (
-            phases.filter(starts_with_datetime__isnull=True, ends_with_datetime__gt=now)
-            .order_by("ends_with_datetime")
-            .first()
-        )
+        candidates = [
+            phase
+            for phase in phases
+            if phase.starts_with_datetime is None
+            and phase.ends_with_datetime is not None
+            and phase.ends_with_datetime > now
+        ]
+        selected_phase = min(candidates, key=lambda phase: phase.ends_with_datetime, default=None)
 
     # a phase may not have an end time, but counts up from a start time
     if not selected_phase:
-        selected_phase = (
-            phases.filter(ends_with_datetime__isnull=True, starts_with_datetime__lt=now)
-            .order_by("-starts_with_datetime")
-            .first()
-        )
+        candidates = [
+            phase
+            for phase in phases
+            if phase.ends_with_datetime is None
+            and phase.starts_with_datetime is not None
+            and phase.starts_with_datetime < now
+        ]
+        selected_phase = max(candidates, key=lambda phase: phase.starts_with_datetime, default=None)
 
     return selected_phase, get_next_clock_calltime(phases, trial)
 
@@ -786,24 +930,507 @@ class Pose(models.Model):
     point = models.PointField(blank=True, null=False, srid=4326)
     elevation = models.FloatField(blank=True, null=True)
     heading = models.FloatField(blank=True, null=True)
+    # entity and trial are covered by the leading columns of the composite indexes below
     entity = models.ForeignKey(
-        Entity, blank=False, null=False, related_name="poses", on_delete=models.CASCADE
+        Entity,
+        blank=False,
+        null=False,
+        related_name="poses",
+        on_delete=models.CASCADE,
+        db_index=False,
     )
     pose_source = models.ForeignKey(
         PoseSource, blank=False, null=False, on_delete=models.CASCADE
     )
     timestamp = models.DateTimeField(blank=True, null=False)
     trial = models.ForeignKey(
-        Trial, blank=True, null=True, related_name="poses", on_delete=models.CASCADE
+        Trial,
+        blank=True,
+        null=True,
+        related_name="poses",
+        on_delete=models.CASCADE,
+        db_index=False,
     )
     speed = models.FloatField(blank=True, null=True)
     velocity = ArrayField(
         models.FloatField(), blank=True, null=False, default=list
     )
+
+    class Meta:
+        indexes = [
+            # per-entity tracks and newest-pose lookups
+            models.Index(fields=["entity", "-timestamp"], name="pose_entity_ts_idx"),
+            # per-trial time windows
+            models.Index(fields=["trial", "-timestamp"], name="pose_trial_ts_idx"),
+            # DISTINCT ON (entity) within a trial, see PoseViewSet.latest
+            models.Index(
+                fields=["trial", "entity", "-timestamp"], name="pose_trial_entity_ts_idx"
+            ),
+            # unfiltered min/max_datetime ranges and default list ordering
+            models.Index(fields=["-timestamp"], name="pose_ts_idx"),
+        ]
+
     def __str__(self):
         return "{}/{} ({})".format(self.entity, self.pose_source, self.timestamp)
 
 
+def as_geography(expression):
+    # Distance lookups on a 4326 geometry compile to ST_DistanceSphere, which cannot use an
+    # index.  On geography ST_DWithin can, given an index on this same cast.
+    return Cast(expression, output_field=models.GeographyField(srid=4326))
+
+
+class LatestPose(models.Model):
+    # Maintained copy of the most recent pose for each entity.  Entity listing and proximity
+    # queries read from here so they scale with the number of entities rather than poses.
+    entity = models.OneToOneField(
+        Entity,
+        primary_key=True,
+        related_name="latest_pose_entry",
+        on_delete=models.CASCADE,
+    )
+    pose = models.ForeignKey(Pose, related_name="+", on_delete=models.CASCADE)
+    point = models.PointField(srid=4326)
+    timestamp = models.DateTimeField()
+    trial = models.ForeignKey(
+        Trial, blank=True, null=True, related_name="+", on_delete=models.SET_NULL
+    )
+
+    class Meta:
+        indexes = [
+            # geography ST_DWithin for the entity around and radius endpoints
+            GistIndex(as_geography("point"), name="latestpose_point_geog_idx"),
+        ]
+
+    def __str__(self):
+        return "{} ({})".format(self.entity_id, self.timestamp)
+
+
+def update_latest_poses(poses):
+    """
+    Upsert the latest pose store from an iterable of saved poses.  A stored entry is only
+    replaced by a pose that is at least as recent (or by a new version of the same pose).
+    Returns the ids of the entities whose entry changed.
+    """
+    latest = {}
+    for pose in poses:
+        if pose.pk is None:
+            continue
+        current = latest.get(pose.entity_id)
+        if current is None or pose.timestamp >= current.timestamp:
+            latest[pose.entity_id] = pose
+
+    if not latest:
+        return set()
+
+    srid = LatestPose._meta.get_field("point").srid
+    values = []
+    params = []
+    for pose in latest.values():
+        values.append(
+            "(%s, %s, ST_Transform(ST_GeomFromText(%s, %s), {}), %s, %s)".format(srid)
+        )
+        params.extend(
+            [
+                pose.entity_id,
+                pose.pk,
+                pose.point.wkt,
+                pose.point.srid or srid,
+                pose.timestamp,
+                pose.trial_id,
+            ]
+        )
+
+    table = LatestPose._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'INSERT INTO {table} (entity_id, pose_id, point, "timestamp", trial_id) '
+            "VALUES {values} "
+            "ON CONFLICT (entity_id) DO UPDATE SET "
+            "pose_id = EXCLUDED.pose_id, point = EXCLUDED.point, "
+            '"timestamp" = EXCLUDED."timestamp", trial_id = EXCLUDED.trial_id '
+            'WHERE EXCLUDED."timestamp" >= {table}."timestamp" '
+            "OR EXCLUDED.pose_id = {table}.pose_id "
+            "RETURNING entity_id".format(table=table, values=", ".join(values)),
+            params,
+        )
+        return set(entity_id for entity_id, in cursor.fetchall())
+
+
+def refresh_latest_pose(entity_id):
+    """
+    Recompute the latest pose store entry for a single entity from the pose table.
+    """
+    # raw delete, so latest_pose_deleted isn't sent for an entry about to be replaced
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "DELETE FROM {} WHERE entity_id = %s".format(LatestPose._meta.db_table),
+            [entity_id],
+        )
+    pose = Pose.objects.filter(entity_id=entity_id).order_by("-timestamp", "-id").first()
+    if pose is not None:
+        update_latest_poses([pose])
+
+
+def rebuild_latest_poses():
+    """
+    Repopulate the whole latest pose store from the pose table, and the region visits
+    that follow from it.
+    """
+    table = LatestPose._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM {}".format(table))
+        cursor.execute(
+            'INSERT INTO {table} (entity_id, pose_id, point, "timestamp", trial_id) '
+            'SELECT DISTINCT ON (entity_id) entity_id, id, point, "timestamp", trial_id '
+            'FROM {pose_table} ORDER BY entity_id, "timestamp" DESC, id DESC'.format(
+                table=table, pose_table=Pose._meta.db_table
+            )
+        )
+    rebuild_region_visits()
+
+
+class RegionVisit(models.Model):
+    # One stay of an entity inside a region during a trial.  Visits with no exit are the
+    # region's current occupants.  Maintained from the latest pose store as poses arrive.
+    region = models.ForeignKey(Region, related_name="visits", on_delete=models.CASCADE)
+    entity = models.ForeignKey(Entity, related_name="region_visits", on_delete=models.CASCADE)
+    trial = models.ForeignKey(
+        Trial,
+        blank=True,
+        null=True,
+        related_name="region_visits",
+        on_delete=models.CASCADE,
+    )
+    entered = models.DateTimeField()
+    exited = models.DateTimeField(blank=True, null=True)
+    entry_pose = models.ForeignKey(
+        Pose, blank=True, null=True, related_name="+", on_delete=models.SET_NULL
+    )
+    exit_pose = models.ForeignKey(
+        Pose, blank=True, null=True, related_name="+", on_delete=models.SET_NULL
+    )
+
+    class Meta:
+        ordering = ["entered", "id"]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["region", "entity"],
+                condition=Q(exited__isnull=True),
+                name="region_visit_one_open",
+            )
+        ]
+        indexes = [
+            models.Index(fields=["trial", "region", "entered"], name="region_visit_trial_idx"),
+            models.Index(fields=["entity", "entered"], name="region_visit_entity_idx"),
+        ]
+
+    def __str__(self):
+        return "{} in {} ({} - {})".format(
+            self.entity_id, self.region_id, self.entered, self.exited
+        )
+
+
+def update_region_occupancy(entity_ids=None, region_ids=None):
+    """
+    Reconcile open region visits with the latest pose store.  Visits whose region no longer
+    contains the entity's latest point (or whose trial has changed) are closed at that pose,
+    and visits are opened for regions that now contain it.  Visits of entities left with
+    no latest pose are closed now.  Limited to the given entities and/or regions when
+    provided.
+    """
+    clauses = []
+    visit_clauses = []
+    params = []
+    if entity_ids is not None:
+        entity_ids = list(entity_ids)
+        if not entity_ids:
+            return
+        clauses.append("lp.entity_id = ANY(%s)")
+        visit_clauses.append("v.entity_id = ANY(%s)")
+        params.append(entity_ids)
+    if region_ids is not None:
+        region_ids = list(region_ids)
+        if not region_ids:
+            return
+        clauses.append("r.name = ANY(%s)")
+        visit_clauses.append("v.region_id = ANY(%s)")
+        params.append(region_ids)
+    scope = "".join(" AND " + clause for clause in clauses)
+    visit_scope = "".join(" AND " + clause for clause in visit_clauses)
+
+    tables = {
+        "visit_table": RegionVisit._meta.db_table,
+        "latest_table": LatestPose._meta.db_table,
+        "region_table": Region._meta.db_table,
+    }
+    with connection.cursor() as cursor:
+        # a latest pose older than the entry (its later poses were deleted) exits at entry
+        cursor.execute(
+            "UPDATE {visit_table} AS v "
+            "SET exited = GREATEST(lp.\"timestamp\", v.entered), exit_pose_id = lp.pose_id "
+            "FROM {latest_table} AS lp, {region_table} AS r "
+            "WHERE v.exited IS NULL AND v.entity_id = lp.entity_id AND v.region_id = r.name "
+            "AND (NOT ST_Contains(r.geom, lp.point) "
+            "OR v.trial_id IS DISTINCT FROM lp.trial_id){scope}".format(scope=scope, **tables),
+            params,
+        )
+        cursor.execute(
+            "INSERT INTO {visit_table} (region_id, entity_id, trial_id, entered, entry_pose_id) "
+            "SELECT r.name, lp.entity_id, lp.trial_id, lp.\"timestamp\", lp.pose_id "
+            "FROM {latest_table} AS lp JOIN {region_table} AS r "
+            "ON ST_Contains(r.geom, lp.point) WHERE TRUE{scope} "
+            "ON CONFLICT (region_id, entity_id) WHERE exited IS NULL DO NOTHING".format(
+                scope=scope, **tables
+            ),
+            params,
+        )
+        cursor.execute(
+            "UPDATE {visit_table} AS v SET exited = now() "
+            "WHERE v.exited IS NULL AND NOT EXISTS ("
+            "SELECT 1 FROM {latest_table} AS lp WHERE lp.entity_id = v.entity_id"
+            "){scope}".format(scope=visit_scope, **tables),
+            params,
+        )
+
+
+def rebuild_region_visits():
+    """
+    Recompute the full region visit history from the pose table.  A visit is a run of an
+    entity's consecutive poses inside a region within one trial; it is exited at the
+    entity's next pose after the run.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM {}".format(RegionVisit._meta.db_table))
+        cursor.execute(
+            "WITH ordered AS ("
+            'SELECT id, entity_id, trial_id, point, "timestamp", '
+            "row_number() OVER w AS n, "
+            'lead(id) OVER w AS next_id, lead("timestamp") OVER w AS next_timestamp '
+            "FROM {pose_table} "
+            'WINDOW w AS (PARTITION BY entity_id ORDER BY "timestamp", id)'
+            "), inside AS ("
+            "SELECT o.*, r.name AS region_id, o.n - row_number() OVER ("
+            'PARTITION BY o.entity_id, r.name, o.trial_id ORDER BY o."timestamp", o.id'
+            ") AS run "
+            "FROM ordered AS o JOIN {region_table} AS r ON ST_Contains(r.geom, o.point)"
+            ") "
+            "INSERT INTO {visit_table} "
+            "(region_id, entity_id, trial_id, entered, entry_pose_id, exited, exit_pose_id) "
+            'SELECT region_id, entity_id, trial_id, min("timestamp"), '
+            "(array_agg(id ORDER BY n))[1], "
+            "(array_agg(next_timestamp ORDER BY n DESC))[1], "
+            "(array_agg(next_id ORDER BY n DESC))[1] "
+            "FROM inside GROUP BY entity_id, region_id, trial_id, run".format(
+                pose_table=Pose._meta.db_table,
+                region_table=Region._meta.db_table,
+                visit_table=RegionVisit._meta.db_table,
+            )
+        )
+
+
+def entity_positions_sql(entity_ids=None, timestamp=None, trial_id=None, interpolate=False):
+    """
+    SQL selecting (entity_id, pose_id, point, timestamp) for the given entities (or all
+    entities), and its params.  Without timestamp or trial this reads the latest pose store.
+    Otherwise each entity's last pose at or before timestamp (within trial, if given) is
+    found with one index probe per entity.  With interpolate, the point is linearly
+    interpolated toward the entity's next pose; pose_id is then the earlier pose and
+    timestamp is the requested time.
+    """
+    if timestamp is None and trial_id is None:
+        sql = "SELECT entity_id, pose_id, point, \"timestamp\" FROM {}".format(
+            LatestPose._meta.db_table
+        )
+        if entity_ids is None:
+            return sql, []
+        return sql + " WHERE entity_id = ANY(%s)", [list(entity_ids)]
+
+    conditions = ["entity_id = e.name"]
+    bound_params = []
+    if trial_id is not None:
+        conditions.append("trial_id = %s")
+        bound_params.append(trial_id)
+    conditions = " AND ".join(conditions)
+
+    before = conditions
+    params = list(bound_params)
+    if timestamp is not None:
+        before += ' AND "timestamp" <= %s'
+        params.append(timestamp)
+    lateral = (
+        "SELECT id, point, \"timestamp\" FROM {pose_table} WHERE {conditions} "
+        'ORDER BY "timestamp" {direction} LIMIT 1'
+    )
+
+    if interpolate and timestamp is not None:
+        select = (
+            "SELECT e.name AS entity_id, p.id AS pose_id, "
+            "CASE WHEN n.id IS NULL OR ST_Equals(p.point, n.point) THEN p.point "
+            "ELSE ST_LineInterpolatePoint(ST_MakeLine(p.point, n.point), "
+            'EXTRACT(EPOCH FROM (%s - p."timestamp")) / '
+            'EXTRACT(EPOCH FROM (n."timestamp" - p."timestamp"))) END AS point, '
+            'CASE WHEN n.id IS NULL THEN p."timestamp" ELSE %s END AS "timestamp" '
+        )
+        params = [timestamp, timestamp] + params
+        joins = " LEFT JOIN LATERAL ({next}) AS n ON TRUE".format(
+            next=lateral.format(
+                pose_table=Pose._meta.db_table,
+                conditions=conditions + ' AND "timestamp" > %s',
+                direction="ASC",
+            )
+        )
+        params += bound_params + [timestamp]
+    else:
+        select = 'SELECT e.name AS entity_id, p.id AS pose_id, p.point, p."timestamp" '
+        joins = ""
+
+    sql = (
+        select + "FROM {entity_table} AS e CROSS JOIN LATERAL ({previous}) AS p".format(
+            entity_table=Entity._meta.db_table,
+            previous=lateral.format(
+                pose_table=Pose._meta.db_table, conditions=before, direction="DESC"
+            ),
+        )
+        + joins
+    )
+    if entity_ids is not None:
+        sql += " WHERE e.name = ANY(%s)"
+        params.append(list(entity_ids))
+    return sql, params
+
+
+def poses_as_of(timestamp, entity_ids=None, trial_id=None, interpolate=False):
+    """
+    Return each entity's pose at timestamp: its last pose at or before that time.  With
+    interpolate, an entity between two poses gets an unsaved copy of the earlier pose
+    moved to the interpolated point and stamped with the requested time.
+    """
+    sql, params = entity_positions_sql(entity_ids, timestamp, trial_id, interpolate)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT pose_id, ST_AsEWKB(point), \"timestamp\" FROM ({}) AS positions".format(
+                sql
+            ),
+            params,
+        )
+        positions = cursor.fetchall()
+
+    poses = Pose.objects.select_related(
+        "entity__entity_type__point_style", "pose_source"
+    ).in_bulk([pose_id for pose_id, point, at in positions])
+    result = []
+    for pose_id, point, at in positions:
+        pose = poses[pose_id]
+        if at != pose.timestamp:
+            pose.pk = None
+            pose.point = GEOSGeometry(bytes(point))
+            pose.timestamp = at
+        result.append(pose)
+    result.sort(key=lambda pose: pose.entity_id)
+    return result
+
+
+def entities_within(origin, distance, entity_ids=None, **as_of):
+    """
+    Return (entity, meters) for the given entities within distance meters of the origin
+    point, closest first.  as_of takes the entity_positions_sql timestamp, trial_id and
+    interpolate arguments.
+    """
+    positions, params = entity_positions_sql(entity_ids, **as_of)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "WITH positions AS ({positions}), origin AS (SELECT ST_GeomFromEWKT(%s) AS point) "
+            "SELECT entity_id, ST_Distance(p.point::geography, o.point::geography) AS distance "
+            "FROM positions AS p, origin AS o "
+            "WHERE ST_DWithin(p.point::geography, o.point::geography, %s) "
+            "ORDER BY distance, entity_id".format(positions=positions),
+            params + [origin.ewkt, distance],
+        )
+        return cursor.fetchall()
+
+
+def entity_proximity_pairs(entity_ids, distance, **as_of):
+    """
+    Return (entity, other entity, meters) for every pair of the given entities within
+    distance meters of each other, closest first, using one spatial self-join over their
+    positions.  Each pair is listed once.  as_of is as for entities_within.
+    """
+    entity_ids = list(entity_ids)
+    if len(entity_ids) < 2:
+        return []
+
+    positions, params = entity_positions_sql(entity_ids, **as_of)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "WITH positions AS ({positions}) "
+            "SELECT a.entity_id, b.entity_id, "
+            "ST_Distance(a.point::geography, b.point::geography) AS distance "
+            "FROM positions AS a JOIN positions AS b ON a.entity_id < b.entity_id "
+            "AND ST_DWithin(a.point::geography, b.point::geography, %s) "
+            "ORDER BY distance, a.entity_id, b.entity_id".format(positions=positions),
+            params + [distance],
+        )
+        return cursor.fetchall()
+
+
+def entities_in_region(region, **as_of):
+    """
+    Return the names of entities whose position (see entity_positions_sql) lies inside the
+    region, ordered by name.
+    """
+    positions, params = entity_positions_sql(**as_of)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "WITH positions AS ({positions}) SELECT entity_id FROM positions "
+            "WHERE ST_Contains((SELECT geom FROM {region_table} WHERE name = %s), point) "
+            "ORDER BY entity_id".format(
+                positions=positions, region_table=Region._meta.db_table
+            ),
+            params + [region.pk],
+        )
+        return [entity_id for entity_id, in cursor.fetchall()]
+
+
+def pose_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created:
+        # a pose older than the latest one changes neither the store nor occupancy
+        changed = update_latest_poses([instance])
+    else:
+        # An edited pose may have moved back in time, so recompute rather than upsert.
+        refresh_latest_pose(instance.entity_id)
+        changed = [instance.entity_id]
+    update_region_occupancy(changed)
+
+
+def latest_pose_deleted(sender, instance, **kwargs):
+    # The entry goes with its pose (or entity).  Once the delete is committed, fall back
+    # to the entity's previous pose and close or move its visits to match.
+    entity_id = instance.entity_id
+
+    def refresh():
+        refresh_latest_pose(entity_id)
+        update_region_occupancy([entity_id])
+
+    transaction.on_commit(refresh)
+
+
+signals.post_save.connect(pose_saved, sender=Pose)
+signals.post_delete.connect(latest_pose_deleted, sender=LatestPose)
+
+
+def region_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    # A new or reshaped region changes who is inside it
+    update_region_occupancy(region_ids=[instance.pk])
+
+
+signals.post_save.connect(region_saved, sender=Region)
+
+
 class Note(models.Model):
     tester = models.ForeignKey(Tester, blank=True, null=False, on_delete=models.CASCADE)
     note = models.TextField(blank=False, null=False)
@@ -905,6 +1532,53 @@ class Event(models.Model):
         return super(Event, self).save(*args, **kwargs)
 
 
+def event_clock_changed(sender, instance, created=False, raw=False, **kwargs):
+    if raw:
+        return
+    if created or kwargs["signal"] is signals.post_delete:
+        clock_events_changed([instance])
+    else:
+        # the event type or start time may have changed, so always recompute
+        clock_timelines_changed([instance.trial_id])
+
+
+def trial_clock_changed(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    clock_timelines_changed([instance.id])
+
+
+signals.post_save.connect(event_clock_changed, sender=Event)
+signals.post_delete.connect(event_clock_changed, sender=Event)
+signals.post_save.connect(trial_clock_changed, sender=Trial)
+signals.post_delete.connect(trial_clock_changed, sender=Trial)
+
+
+def clock_phase_published(sender, instance, created=False, raw=False, **kwargs):
+    # Published from the model rather than the views so phases edited or deleted through the
+    # admin reach the game clock function too.  Save inside a transaction (the admin and
+    # ClockPhaseViewSet do) so the phase and its outbox message commit together.
+    if raw:
+        return
+    data = {
+        "id": instance.id,
+        "starts_with_event_type_id": instance.starts_with_event_type_id,
+        "ends_with_event_type_id": instance.ends_with_event_type_id,
+        "update": not created,
+    }
+    if kwargs["signal"] is signals.post_delete:
+        data["deleted"] = True
+    enqueue_messages("public/default/_clock_phase_log", [data])
+
+
+signals.post_save.connect(clock_phase_published, sender=ClockPhase)
+signals.post_delete.connect(clock_phase_published, sender=ClockPhase)
+for _clock_model in (ClockPhase, ClockConfig):
+    signals.post_save.connect(clock_configuration_changed, sender=_clock_model)
+    signals.post_delete.connect(clock_configuration_changed, sender=_clock_model)
+signals.m2m_changed.connect(clock_configuration_changed, sender=ClockConfig.phases.through)
+
+
 class EntityEventRole(models.Model):
     # This model defines possible Roles an Entity may have in an Event
     name = models.CharField(max_length=100, blank=False, null=False, unique=True)
@@ -1297,3 +1971,153 @@ def default_trigger():
     except Trigger.DoesNotExist:
         trigger = None
     return trigger
+
+
+class OutboxMessage(models.Model):
+    # Pulsar messages written in the same transaction as the rows they describe.  The
+    # relay_outbox management command publishes and deletes them once committed.  Messages
+    # that still fail after its --max-attempts are dead lettered: kept with
+    # dead_lettered_datetime set and skipped by the relay.  Clear it to send them again.
+    topic = models.CharField(max_length=200)
+    payload = JSONField(default=dict)
+    created_datetime = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, default="")
+    dead_lettered_datetime = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ["id"]
+
+    def __str__(self):
+        return "{} ({})".format(self.topic, self.created_datetime)
+
+
+def enqueue_messages(topic, payloads):
+    """
+    Queue JSON-serializable payloads for publishing on topic.  Call inside the transaction
+    that writes the rows they describe so nothing is published for a rollback.
+    """
+    return OutboxMessage.objects.bulk_create(
+        [OutboxMessage(topic=topic, payload=payload) for payload in payloads]
+    )
+
+
+class IngestContext:
+    """
+    Per-process cache of the configuration consulted on every event and pose create: the
+    current trial, triggers by key and scenario segments.  Entries are tagged with a version
+    number kept in the shared Django cache, so a configuration change made through any
+    gunicorn worker clears every worker's copy.  The version is checked by refresh(), once
+    at the start of each create or batch rather than on every lookup.  Field values are
+    cached rather than model instances, and every lookup builds its own instance, so no
+    instance is shared between requests or threads.
+    """
+
+    version_key = "data_collection_ingest_context_version"
+
+    def __init__(self):
+        self._version = None
+        self._values = {}
+
+    def refresh(self):
+        try:
+            version = cache.get(self.version_key)
+        except Exception:  # cache backend unavailable, load everything again
+            self.clear()
+            return
+        if version != self._version:
+            self._values = {}
+            self._version = version
+
+    def get(self, key, loader):
+        values = self._values
+        try:
+            return values[key]
+        except KeyError:
+            value = loader()
+            values[key] = value
+            return value
+
+    def clear(self):
+        self._values = {}
+
+    def invalidate(self):
+        self.clear()
+        try:
+            cache.incr(self.version_key)
+        except ValueError:
+            cache.set(self.version_key, 1, None)
+        except Exception:  # cache backend unavailable, nothing shared to invalidate
+            pass
+
+    @staticmethod
+    def instance(model, values):
+        # a new instance from cached field values, as if loaded from the database
+        return model.from_db(DEFAULT_DB_ALIAS, list(values), list(values.values()))
+
+    def current_trial(self, dt=None):
+        values = self.get(
+            "current_trial", lambda: Trial.objects.filter(current=True).values().first()
+        )
+        if values is None:
+            # the fallback marks a trial current, which invalidates this cache
+            return get_current_trial(dt=dt)
+        return self.instance(Trial, values)
+
+    def trigger(self, key):
+        values = self.get(("trigger", key), lambda: Trigger.objects.values().get(key=key))
+        return self.instance(Trigger, values)
+
+    def has_segments(self, scenario_id):
+        return self.get(
+            ("has_segments", scenario_id),
+            lambda: Scenario.objects.filter(id=scenario_id)
+            .values_list("test_method__has_segments", flat=True)
+            .first(),
+        )
+
+    def scenario_segments(self, scenario_id):
+        # ordered by id, the order segments progress in
+        segments = self.get(
+            ("segments", scenario_id),
+            lambda: list(
+                Segment.objects.filter(scenarios__id=scenario_id).order_by("id").values()
+            ),
+        )
+        return [self.instance(Segment, values) for values in segments]
+
+
+ingest_context = IngestContext()
+
+
+def ingest_configuration_changed(sender, **kwargs):
+    # drop this worker's copy now and tell the others once the change is visible to them
+    ingest_context.clear()
+    transaction.on_commit(ingest_context.invalidate)
+
+
+for _ingest_model in (Trial, Trigger, Scenario, TestMethod, Segment):
+    signals.post_save.connect(ingest_configuration_changed, sender=_ingest_model)
+    signals.post_delete.connect(ingest_configuration_changed, sender=_ingest_model)
+signals.m2m_changed.connect(ingest_configuration_changed, sender=Segment.scenarios.through)
+
+
+TRIGGER_LOG_TOPIC = "public/default/_trigger_log"
+
+
+def trigger_configuration_changed(sender, instance, raw=False, action="post", **kwargs):
+    # the event generator keeps compiled triggers and reloads them on this message
+    if raw or not action.startswith("post"):
+        return
+    enqueue_messages(
+        TRIGGER_LOG_TOPIC, [{"model": instance._meta.model_name, "id": instance.pk}]
+    )
+
+
+for _trigger_model in (Trigger, ConditionVariable, RequestedData):
+    signals.post_save.connect(trigger_configuration_changed, sender=_trigger_model)
+    signals.post_delete.connect(trigger_configuration_changed, sender=_trigger_model)
+for _trigger_relation in (Trigger.condition_variables, Trigger.requested_dataset):
+    signals.m2m_changed.connect(
+        trigger_configuration_changed, sender=_trigger_relation.through
+    )
@@ -0,0 +1,120 @@
+import logging
+import os
+import threading
+
+import pulsar
+from django.conf import settings
+
+log = logging.getLogger("mole")
+
+PULSAR_SERVICE_URL = "pulsar://pulsar:6650"
+
+
+class ProducerRegistry:
+    """
+    Per-process cache of Pulsar producers keyed by topic.
+
+    Producers are created on first use and kept open for the life of the worker so a publish
+    is a local enqueue rather than a broker round-trip.  A producer that fails to send is
+    replaced on the next publish to its topic.  The registry is disabled under TEST_DJANGO.
+    """
+
+    def __init__(self, service_url=PULSAR_SERVICE_URL, enabled=True):
+        self.service_url = service_url
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._pid = None
+        self._client = None
+        self._producers = {}
+        self._failed = set()
+
+    def get(self, topic, batching_enabled=True):
+        """
+        Return the producer for topic, creating the client and producer if needed.
+        batching_enabled only applies when the producer is created.  Raises if Pulsar is
+        disabled or unavailable.
+        """
+        if not self.enabled:
+            raise RuntimeError("Pulsar producers are disabled")
+
+        if topic in self._failed:
+            self._failed.discard(topic)
+            self.discard(topic)
+
+        with self._lock:
+            if self._pid != os.getpid():
+                # client threads do not survive a fork, start over in the child
+                self._client = None
+                self._producers = {}
+                self._pid = os.getpid()
+
+            producer = self._producers.get(topic)
+            if producer is None:
+                if self._client is None:
+                    self._client = pulsar.Client(self.service_url)
+                producer = self._client.create_producer(
+                    topic,
+                    batching_enabled=batching_enabled,
+                    batching_max_publish_delay_ms=10,
+                    block_if_queue_full=True,
+                )
+                self._producers[topic] = producer
+            return producer
+
+    def discard(self, topic):
+        with self._lock:
+            producer = self._producers.pop(topic, None)
+        if producer is not None:
+            try:
+                producer.close()
+            except Exception:  # Pulsar doesn't provide a subtype of Exception
+                pass
+
+    def send(self, topic, content):
+        """
+        Enqueue content (bytes) on topic.  Returns False if no producer could be obtained,
+        in which case the message is dropped.
+        """
+        for attempt in range(2):
+            try:
+                producer = self.get(topic)
+            except Exception:  # Pulsar doesn't provide a subtype of Exception
+                return False
+
+            def callback(result, message_id):
+                # runs on a Pulsar thread, so only flag the producer for replacement
+                if result != pulsar.Result.Ok:
+                    log.warning("Pulsar publish to %s failed: %s", topic, result)
+                    self._failed.add(topic)
+
+            try:
+                producer.send_async(content, callback)
+                return True
+            except Exception:  # producer was closed underneath us, reconnect once
+                log.warning("Pulsar producer for %s unusable, reconnecting", topic)
+                self.discard(topic)
+        return False
+
+    def close(self):
+        """
+        Flush and close every producer and the client.  Safe to call more than once.
+        """
+        with self._lock:
+            producers = list(self._producers.values())
+            client = self._client
+            self._producers = {}
+            self._client = None
+        for producer in producers:
+            try:
+                producer.flush()
+                producer.close()
+            except Exception:  # Pulsar doesn't provide a subtype of Exception
+                pass
+        if client is not None:
+            try:
+                client.close()
+            except Exception:  # Pulsar doesn't provide a subtype of Exception
+                pass
+
+
+producers = ProducerRegistry(enabled=not settings.TEST_DJANGO)
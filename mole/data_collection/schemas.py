@@ -66,6 +66,25 @@ class EntitySchema(MoleBaseSchema):
                     "description": description,
                 }
             }
+        elif method_name == "proximity":
+            return {
+                "200": {
+                    "content": {
+                        "application/json": {"schema": {
+                            "type": "array",
+                            "items": {
+                                "type": "array",
+                                "items": {
+                                    "oneOf": [{"type": "string"}, {"type": "number"}],
+                                },
+                                "minItems": 3,
+                                "maxItems": 3,
+                            },
+                        }}
+                    },
+                    "description": "list pairs of entities that are within a certain distance of each other",
+                }
+            }
         return super().get_responses(path, method)
 
 
@@ -136,6 +155,18 @@ class TrialSchema(MoleBaseSchema):
                     "description": "",
                 }
             }
+        elif method_name == "trajectory_metrics":
+            return {
+                "200": {
+                    "content": {
+                        "application/json": {"schema": {
+                            "type": "array",
+                            "items": {"type": "object"},
+                        }}
+                    },
+                    "description": "trajectory metrics per entity, or per event with events=true",
+                }
+            }
         return super().get_responses(path, method)
 
 class TestMethodSchema(MoleBaseSchema):
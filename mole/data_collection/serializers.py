@@ -4,14 +4,12 @@ import json
 import ast
 import re
 
-from numpy import array
-from django.contrib.gis.geos import LineString
-from django.db.models import Q
+from django.db.models import F, Q
 from django.contrib.auth.models import User
 from django.utils import timezone, http
 from django.contrib.gis.geos import Point
 from django.core.exceptions import ValidationError
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
 
 from rest_framework import serializers
 from rest_framework.reverse import reverse
@@ -289,23 +287,19 @@ class EntitySerializer(DynamicFieldsHyperlinkedModelSerializer):
         return campaigns_urls
 
     def get_region(self, obj):
-        request = self.context.get("request", None)
-        last_pose = dcm.Pose.objects.filter(entity=obj).order_by("timestamp").last()
-
         try:
-            pnt = last_pose.point
-            region = dcm.Region.objects.filter(geom__contains=pnt)
-
-            return [r.name for r in region]
-
-        except AttributeError:
+            pnt = obj.latest_pose_entry.point
+        except dcm.LatestPose.DoesNotExist:
             return []
 
+        region = dcm.Region.objects.filter(geom__contains=pnt)
+        return [r.name for r in region]
+
     def get_latest_pose(self, obj):
         request = self.context.get("request", None)
-        last_pose = dcm.Pose.objects.filter(entity=obj).order_by("timestamp").last()
-
-        if last_pose is None:
+        try:
+            last_pose = obj.latest_pose_entry.pose
+        except dcm.LatestPose.DoesNotExist:
             return None
 
         return PoseSerializer(
@@ -442,23 +436,45 @@ class RegionSerializer(DynamicFieldsHyperlinkedModelSerializer):
         )
 
     def get_entities(self, obj):
-
-        entities_in_region = (
-            dcm.Pose.objects.filter(point__within=obj.geom)
-            .order_by("entity__name")
-            .distinct("entity__name")
-            .values_list("entity", "entity__entity_type")
-        )
+        # Current occupants by entity type, from the region occupancy index
+        visits = getattr(obj, "current_visits", None)
+        if visits is None:
+            visits = obj.visits.filter(exited__isnull=True).select_related("entity")
 
         to_return = {}
-        for entity_name, entity_type in entities_in_region:
+        for visit in visits:
+            entity_type = visit.entity.entity_type_id
             if entity_type not in to_return:
                 to_return[entity_type] = set()
 
-            to_return[entity_type].add(entity_name)
+            to_return[entity_type].add(visit.entity_id)
         return to_return
 
 
+class RegionVisitSerializer(serializers.HyperlinkedModelSerializer):
+    region = serializers.HyperlinkedRelatedField(
+        view_name="region-detail", read_only=True
+    )
+    entity = serializers.HyperlinkedRelatedField(
+        view_name="entity-detail", read_only=True
+    )
+    trial = serializers.HyperlinkedRelatedField(view_name="trial-detail", read_only=True)
+
+    class Meta:
+        model = dcm.RegionVisit
+        fields = (
+            "url",
+            "id",
+            "region",
+            "entity",
+            "trial",
+            "entered",
+            "exited",
+            "entry_pose",
+            "exit_pose",
+        )
+
+
 class ScenarioSerializer(serializers.HyperlinkedModelSerializer):
     has_segments = serializers.BooleanField(
         source="test_method.has_segments", 
@@ -746,12 +762,16 @@ class PoseSourceSerializer(serializers.HyperlinkedModelSerializer):
 
 class BulkPoseSerializer(serializers.ListSerializer):
     def create(self, validated_data):
+        dcm.ingest_context.refresh()
         result = [self.child.create(attrs) for attrs in validated_data]
 
         try:
             self.child.Meta.model.objects.bulk_create(result)
         except IntegrityError as e:
             raise ValidationError(e)
+
+        # bulk_create skips post_save, so keep the latest pose store and occupancy current here
+        dcm.update_region_occupancy(dcm.update_latest_poses(result))
         return result
 
 
@@ -790,6 +810,9 @@ class PoseSerializer(gis_serializers.GeoModelSerializer):
     # since it is currently limited to posting a single message field to a single api field.
     # Also, do some cleanup for submissions from the browsable api (null submissions vs field omission)
     def create(self, validated_data):
+        if isinstance(self._kwargs["data"], dict):
+            # a single pose, bulk posts refresh once for the batch
+            dcm.ingest_context.refresh()
         # browsable api submits timestamp=null rather than omitting.  This causes the default not to be set.
         # The following 3 lines accommodate for this.
         ts = validated_data.get("timestamp")
@@ -813,7 +836,9 @@ class PoseSerializer(gis_serializers.GeoModelSerializer):
         # if trial is not explicitly stated, assume it goes to the trial marked current
         if "trial" not in validated_data:
             try:
-                current_trial = dcm.get_current_trial(dt=validated_data["timestamp"])
+                current_trial = dcm.ingest_context.current_trial(
+                    dt=validated_data["timestamp"]
+                )
             except dcm.Trial.DoesNotExist:
                 raise serializers.ValidationError(
                     "Unable to determine suitable trial.  No trial is marked current and there are no trials that "
@@ -1102,19 +1127,136 @@ class TriggerResponseSerializer(serializers.HyperlinkedModelSerializer):
         fields = ("url", "id", "name", "description", "method", "module", "parameters")
 
 
+def next_segment(segments, previous_segment, previous_ends_segment):
+    """
+    Segment for an event that follows one in previous_segment.  segments are the scenario's
+    segments ordered by id; progression wraps back around to the first one.
+    """
+    if not previous_ends_segment:
+        return previous_segment
+    if previous_segment is not None:
+        for segment in segments:
+            if segment.id > previous_segment.id:
+                return segment
+    return segments[0]
+
+
 class BulkEventSerializer(serializers.ListSerializer):
+    """
+    Creates a list of events with the same outcome as posting them one at a time in order,
+    but with trial, trigger, segment and entity role lookups done once per batch.
+    """
+
     def create(self, validated_data):
+        dcm.ingest_context.refresh()
         now = timezone.now()
-        result = [
-            self.child.create(dict(attrs, modified_datetime=now))
-            for attrs in validated_data
-        ]
+        current_trial = None
+
+        trigger_keys = set(attrs.get("trigger_key") for attrs in validated_data)
+        trigger_keys.discard("")
+        trigger_keys.discard(None)
+        triggers = dcm.Trigger.objects.in_bulk(trigger_keys, field_name="key")
+
+        events_by_trial = {}
+        events = []
+        for attrs in validated_data:
+            attrs = dict(attrs, modified_datetime=now)
+            dt = attrs.get("start_datetime")
+            if (dt is None) or (dt == ""):
+                attrs["start_datetime"] = now
+
+            if attrs.get("trial") is None:
+                if current_trial is None:
+                    # a fallback trial is marked current, so one lookup serves the batch
+                    try:
+                        current_trial = dcm.ingest_context.current_trial(
+                            dt=attrs["start_datetime"]
+                        )
+                    except dcm.Trial.DoesNotExist:
+                        raise serializers.ValidationError(
+                            "Unable to determine suitable trial.  No trial is marked current and there are no trials "
+                            "that overlap the start_datetime of this event ({})".format(
+                                attrs["start_datetime"].isoformat()
+                            )
+                        )
+                attrs["trial"] = current_trial
+
+            trigger_key = attrs.pop("trigger_key", None)
+            if trigger_key != "" and trigger_key is not None:
+                try:
+                    attrs["trigger"] = triggers[trigger_key]
+                except KeyError:
+                    raise serializers.ValidationError(
+                        "Unknown trigger key ({})".format(trigger_key)
+                    )
+
+            event = dcm.Event(**attrs)
+            events.append(event)
+            events_by_trial.setdefault(event.trial_id, []).append(
+                (event, attrs.get("segment") is None)
+            )
+
+        for trial_events in events_by_trial.values():
+            self.assign_segments(trial_events)
 
         try:
-            self.child.Meta.model.objects.bulk_create(result)
+            with transaction.atomic():
+                self.child.Meta.model.objects.bulk_create(events)
+
+                with_metadata = [event for event in events if event.metadata]
+                if with_metadata:
+                    resolve_event_entities(with_metadata)
+                    self.child.Meta.model.objects.bulk_update(
+                        with_metadata, ["unfound_entities", "invalid_entities"]
+                    )
+
+                # bulk_create skips post_save, so drop clock timelines these events anchor
+                dcm.clock_events_changed(events)
         except IntegrityError as e:
             raise ValidationError(e)
-        return result
+        return events
+
+    def assign_segments(self, trial_events):
+        """
+        Walk a trial's new events in submission order, carrying the most recent event forward
+        in memory the same way sequential creates would see it in the database.
+        """
+        trial = trial_events[0][0].trial
+        if not dcm.ingest_context.has_segments(trial.scenario_id):
+            for event, needs_segment in trial_events:
+                if needs_segment:
+                    event.segment = None
+            return
+
+        segments = dcm.ingest_context.scenario_segments(trial.scenario_id)
+        previous = (
+            dcm.Event.objects.filter(trial=trial)
+            .select_related("event_type", "segment")
+            .order_by("-start_datetime")
+            .first()
+        )
+        if previous is not None:
+            previous = (
+                previous.start_datetime,
+                previous.segment,
+                previous.event_type.ends_segment,
+            )
+
+        for event, needs_segment in trial_events:
+            if needs_segment:
+                if not segments:
+                    event.segment = None
+                elif previous is None:
+                    event.segment = segments[0]
+                else:
+                    event.segment = next_segment(segments, previous[1], previous[2])
+
+            if previous is None or event.start_datetime >= previous[0]:
+                previous = (
+                    event.start_datetime,
+                    event.segment,
+                    event.event_type.ends_segment,
+                )
 
 
 class EventDataSerializer(serializers.Serializer):
@@ -1152,6 +1294,130 @@ class EventDataSerializer(serializers.Serializer):
             "invalid_entities",
         )
 
+    def to_representation(self, instance):
+        # Rows from export_rows are already in their final form
+        if isinstance(instance, dict):
+            return instance
+        return super().to_representation(instance)
+
+    @classmethod
+    def export_rows(cls, queryset, chunk_size=2000):
+        """
+        Yield one dict per event, keyed and valued like this serializer's output, from a single
+        values() query.  Related entities and performers are fetched in bulk per chunk.
+        """
+        field_names = list(cls().fields.keys())
+        rows = (
+            queryset.select_related(None)
+            .prefetch_related(None)
+            .values(
+                "id",
+                "submitted_datetime",
+                "start_datetime",
+                "end_datetime",
+                "trial_id",
+                "metadata",
+                "unfound_entities",
+                "trial__id_major",
+                "trial__id_minor",
+                "trial__id_micro",
+                "trial__system_configuration_id",
+                "trial__system_configuration__name",
+                "trial__scenario__name",
+                "segment__tag",
+                "segment__name",
+                "start_pose__point",
+                "start_pose__elevation",
+                event_type_name=F("event_type__name"),
+                trigger_key=F("trigger__key"),
+            )
+            .iterator(chunk_size=chunk_size)
+        )
+
+        performers = {}
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                yield from cls._export_chunk(chunk, field_names, performers)
+                chunk = []
+        if chunk:
+            yield from cls._export_chunk(chunk, field_names, performers)
+
+    @classmethod
+    def _export_chunk(cls, chunk, field_names, performers):
+        related_entities = {}
+        for relation in (
+            dcm.EntityEventRelation.objects.filter(event_id__in=[x["id"] for x in chunk])
+            .order_by("id")
+            .values(
+                "event_id",
+                "entity_event_role__name",
+                "entity__name",
+                "entity__display_name",
+                "entity__entity_type__name",
+            )
+        ):
+            related_entities.setdefault(relation["event_id"], {}).setdefault(
+                relation["entity_event_role__name"], []
+            ).append(
+                {
+                    "name": relation["entity__name"],
+                    "display_name": relation["entity__display_name"],
+                    "entity_type": relation["entity__entity_type__name"],
+                }
+            )
+
+        # performers only depend on the trial's system configuration
+        missing = set(x["trial__system_configuration_id"] for x in chunk) - set(performers)
+        if missing:
+            names = {}
+            for configuration_id, performer in dcm.SystemConfiguration.objects.filter(
+                id__in=missing
+            ).values_list("id", "capabilities_under_test__performer__name"):
+                names.setdefault(configuration_id, [])
+                if performer is not None:
+                    names[configuration_id].append(performer)
+            for configuration_id, configuration_performers in names.items():
+                performers[configuration_id] = ", ".join(set(sorted(configuration_performers)))
+
+        for x in chunk:
+            point = x["start_pose__point"]
+            values = {
+                "id": x["id"],
+                "submitted_datetime": x["submitted_datetime"],
+                "start_datetime": x["start_datetime"],
+                "end_datetime": x["end_datetime"],
+                "event_type": x["event_type_name"],
+                "trial_id": x["trial_id"],
+                "trial_name": dcm.Trial.format_name(
+                    x["trial__id_major"],
+                    x["trial__id_minor"],
+                    x["trial__id_micro"],
+                    x["trial__system_configuration__name"],
+                    x["trial__scenario__name"],
+                ),
+                "trial_major": x["trial__id_major"],
+                "trial_minor": x["trial__id_minor"],
+                "trial_micro": x["trial__id_micro"],
+                "start_pose": "{}, {}, {}".format(
+                    point.x, point.y, x["start_pose__elevation"]
+                )
+                if point is not None
+                else None,
+                "configuration": x["trial__system_configuration__name"],
+                "performers": performers.get(x["trial__system_configuration_id"], ""),
+                "segment": "{} -- {}".format(x["segment__tag"], x["segment__name"])
+                if x["segment__name"] is not None
+                else None,
+                "scenario": x["trial__scenario__name"],
+                "trigger": x["trigger_key"],
+                "metadata": x["metadata"],
+                "related_entities": related_entities.get(x["id"], {}),
+                "unfound_entities": x["unfound_entities"],
+            }
+            yield {name: values[name] for name in field_names}
+
     def get_start_pose(self, obj):
         if obj.start_pose:
             return "{}, {}, {}".format(
@@ -1160,31 +1426,6 @@ class EventDataSerializer(serializers.Serializer):
         else:
             return
 
-    def get_length(self, obj):
-        length = 0
-        exclusive_with_list = obj.event_type.exclusive_with.all()
-        later_exclusive_with_events = dcm.Event.objects.order_by(
-            "start_datetime"
-        ).filter(
-            start_datetime__gt=obj.start_datetime,
-            event_type__in=exclusive_with_list,
-            trial__id=obj.trial.id,
-        )
-        if later_exclusive_with_events:
-            next_exclusive_with_event = later_exclusive_with_events[0]
-            obj_datetime1 = obj.start_datetime
-            obj_datetime2 = next_exclusive_with_event.start_datetime
-            poses = (
-                dcm.Pose.objects.filter(
-                    timestamp__lt=obj_datetime2, timestamp__gt=obj_datetime1
-                )
-                .transform(26945)
-                .values_list("point", flat=True)
-            )
-            lin = LineString(array(poses))
-            length = lin.length
-        return length
-
     def get_performers(self, obj):
         performers = []
         try:
@@ -1343,6 +1584,18 @@ class ClockPhaseSerializer(serializers.HyperlinkedModelSerializer):
             "ends_with_event_type",
         ]
 
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        # phases are resolved per trial, show the current trial's times when the view
+        # provides them rather than the stored ones
+        times = self.context.get("clock_times", {}).get(instance.id)
+        if times is not None:
+            for name, value in zip(("starts_with_datetime", "ends_with_datetime"), times):
+                data[name] = (
+                    self.fields[name].to_representation(value) if value else None
+                )
+        return data
+
 
 class ClockConfigSerializer(serializers.HyperlinkedModelSerializer):
     phases = ClockPhaseSerializer(read_only=True, many=True)
@@ -1518,6 +1771,9 @@ class EventSerializer(serializers.HyperlinkedModelSerializer):
 
     # Try to determine segment if appropriate. If associated entities were submitted via metadata, attach as entities.
     def create(self, validated_data):
+        if isinstance(self._kwargs["data"], dict):
+            # a single event, bulk posts go through BulkEventSerializer.create
+            dcm.ingest_context.refresh()
         # set start_datetime for case where browsable api submitted null or ''
         dt = validated_data.get("start_datetime")
         if (dt is None) or (dt == ""):
@@ -1525,7 +1781,7 @@ class EventSerializer(serializers.HyperlinkedModelSerializer):
 
         if validated_data.get("trial") is None:
             try:
-                current_trial = dcm.get_current_trial(
+                current_trial = dcm.ingest_context.current_trial(
                     dt=validated_data["start_datetime"]
                 )
             except dcm.Trial.DoesNotExist:
@@ -1538,35 +1794,35 @@ class EventSerializer(serializers.HyperlinkedModelSerializer):
             validated_data["trial"] = current_trial
         trigger_key = validated_data.get("trigger_key")
         if trigger_key != "" and trigger_key is not None:
-            validated_data["trigger"] = dcm.Trigger.objects.get(key=trigger_key)
+            try:
+                validated_data["trigger"] = dcm.ingest_context.trigger(trigger_key)
+            except dcm.Trigger.DoesNotExist:
+                raise serializers.ValidationError(
+                    "Unknown trigger key ({})".format(trigger_key)
+                )
 
         if validated_data.get("segment") is None:
             current_segment = None
-            current_scenario = validated_data["trial"].scenario
-            if current_scenario.test_method.has_segments:
+            scenario_id = validated_data["trial"].scenario_id
+            if dcm.ingest_context.has_segments(scenario_id):
                 # Get segments that correspond to this scenario
-                scenario_segments = dcm.Segment.objects.filter(
-                    scenarios__name=current_scenario.name
-                )
-                if scenario_segments.count():
-                    try:
-                        previous_event = dcm.Event.objects.filter(
-                            trial=validated_data["trial"]
-                        ).order_by("-start_datetime")[0]
-                        previous_segment = previous_event.segment
-                        if previous_event.event_type.ends_segment:
-                            try:
-                                current_segment = scenario_segments.filter(
-                                    id__gt=previous_segment.id
-                                ).order_by("id")[0]
-                            except IndexError:
-                                current_segment = scenario_segments.order_by("id")[0]
-                        else:
-                            current_segment = previous_segment
-
-                    # This is the first event for this trial. Set current_segment to first segment in list.
-                    except (dcm.Event.DoesNotExist, IndexError):
-                        current_segment = scenario_segments.order_by("id")[0]
+                scenario_segments = dcm.ingest_context.scenario_segments(scenario_id)
+                if scenario_segments:
+                    previous_event = (
+                        dcm.Event.objects.filter(trial=validated_data["trial"])
+                        .select_related("event_type", "segment")
+                        .order_by("-start_datetime")
+                        .first()
+                    )
+                    if previous_event is None:
+                        # This is the first event for this trial. Set current_segment to first segment in list.
+                        current_segment = scenario_segments[0]
+                    else:
+                        current_segment = next_segment(
+                            scenario_segments,
+                            previous_event.segment,
+                            previous_event.event_type.ends_segment,
+                        )
 
             validated_data["segment"] = current_segment
 
@@ -1576,58 +1832,7 @@ class EventSerializer(serializers.HyperlinkedModelSerializer):
             # This is a single instance rather than a list for bulk creation.
             instance.save()
             if validated_data.get("metadata"):
-                metadata = validated_data["metadata"]
-                entity_roles = dcm.EntityEventRole.objects.all()
-                unfound_entities = []
-                invalid_entities = []
-                valid_entities = []
-                for entity_role in entity_roles:
-                    try:
-                        entity_list = metadata[entity_role.metadata_key.name]
-                        if type(entity_list) is not list:
-                            entity_list = [entity_list]
-                        for entity_name in entity_list:
-                            try:
-                                entity = dcm.Entity.objects.get(name=entity_name)
-
-                                if (
-                                    (
-                                        entity.entity_type
-                                        in entity_role.valid_entity_types.all()
-                                        or len(entity_role.valid_entity_types.all())
-                                        == 0
-                                    )
-                                    and (
-                                        instance.event_type
-                                        in entity_role.valid_event_types.all()
-                                        or len(entity_role.valid_event_types.all()) == 0
-                                    )
-                                    and (
-                                        any(
-                                            group in entity.groups.all()
-                                            for group in entity_role.valid_entity_groups.all()
-                                        )
-                                        or len(entity_role.valid_entity_groups.all())
-                                        == 0
-                                    )
-                                ):
-                                    entity_event_relation = dcm.EntityEventRelation.objects.create(
-                                        entity_event_role=entity_role,
-                                        event=instance,
-                                        entity=entity,
-                                    )
-                                    valid_entities.append(entity.name)
-                                else:
-                                    invalid_entities.append(entity.name)
-
-                            except dcm.Entity.DoesNotExist:
-                                unfound_entities.append(entity_name)
-                    except KeyError:
-                        continue
-                instance.unfound_entities = list(set(unfound_entities))
-                instance.invalid_entities = list(
-                    set([x for x in invalid_entities if x not in valid_entities])
-                )
+                resolve_event_entities([instance])
                 instance.save()
         return instance
 
@@ -1708,58 +1913,7 @@ class EventSerializer(serializers.HyperlinkedModelSerializer):
         # Update entities that may have been submitted via metadata
         if validated_data.get("metadata"):
             instance.entities.clear()
-
-            metadata = validated_data["metadata"]
-            entity_roles = dcm.EntityEventRole.objects.all()
-            unfound_entities = []
-            invalid_entities = []
-            valid_entities = []
-            for entity_role in entity_roles:
-                try:
-                    entity_list = metadata[entity_role.metadata_key.name]
-                    if type(entity_list) is not list:
-                        entity_list = [entity_list]
-                    for entity_name in entity_list:
-                        try:
-                            entity = dcm.Entity.objects.get(name=entity_name)
-
-                            if (
-                                (
-                                    entity.entity_type
-                                    in entity_role.valid_entity_types.all()
-                                    or len(entity_role.valid_entity_types.all()) == 0
-                                )
-                                and (
-                                    instance.event_type
-                                    in entity_role.valid_event_types.all()
-                                    or len(entity_role.valid_event_types.all()) == 0
-                                )
-                                and (
-                                    any(
-                                        group in entity.groups.all()
-                                        for group in entity_role.valid_entity_groups.all()
-                                    )
-                                    or len(entity_role.valid_entity_groups.all()) == 0
-                                )
-                            ):
-                                entity_event_relation = dcm.EntityEventRelation.objects.create(
-                                    entity_event_role=entity_role,
-                                    event=instance,
-                                    entity=entity,
-                                )
-                                valid_entities.append(entity.name)
-                            else:
-                                invalid_entities.append(entity.name)
-
-                        except dcm.Entity.DoesNotExist:
-                            unfound_entities.append(entity_name)
-                except KeyError:
-                    continue
-
-            event.unfound_entities = list(set(unfound_entities))
-            event.invalid_entities = list(
-                set([x for x in invalid_entities if x not in valid_entities])
-            )
+            resolve_event_entities([event])
             event.save()
 
         return event
@@ -1818,6 +1972,90 @@ class EventSerializer(serializers.HyperlinkedModelSerializer):
             pass
 
 
+def resolve_event_entities(events):
+    """
+    Attach entities named in each event's metadata using the EntityEventRole metadata keys.
+    Roles and entities are fetched once for the whole batch and the resulting relations are
+    bulk created.  Sets unfound_entities and invalid_entities on each event; the caller is
+    responsible for saving the events.
+    """
+    entity_roles = []
+    for role in (
+        dcm.EntityEventRole.objects.filter(metadata_key__isnull=False)
+        .select_related("metadata_key")
+        .prefetch_related("valid_entity_types", "valid_event_types", "valid_entity_groups")
+    ):
+        entity_roles.append(
+            (
+                role,
+                set(x.pk for x in role.valid_entity_types.all()),
+                set(x.pk for x in role.valid_event_types.all()),
+                set(x.pk for x in role.valid_entity_groups.all()),
+            )
+        )
+
+    # collect (role, submitted names) per event before touching entities
+    submitted = []
+    entity_names = set()
+    for event in events:
+        event_roles = []
+        for role_entry in entity_roles:
+            try:
+                entity_list = event.metadata[role_entry[0].metadata_key.name]
+            except KeyError:
+                continue
+            if type(entity_list) is not list:
+                entity_list = [entity_list]
+            event_roles.append((role_entry, entity_list))
+            entity_names.update(str(x) for x in entity_list)
+        submitted.append((event, event_roles))
+
+    entities = {}
+    entity_groups = {}
+    if entity_names:
+        for entity in dcm.Entity.objects.filter(name__in=entity_names).prefetch_related(
+            "groups"
+        ):
+            entities[entity.name] = entity
+            entity_groups[entity.name] = set(x.pk for x in entity.groups.all())
+
+    relations = []
+    for event, event_roles in submitted:
+        unfound_entities = []
+        invalid_entities = []
+        valid_entities = []
+        for (role, entity_types, event_types, entity_groups_allowed), entity_list in event_roles:
+            for entity_name in entity_list:
+                entity = entities.get(str(entity_name))
+                if entity is None:
+                    unfound_entities.append(entity_name)
+                    continue
+
+                if (
+                    (not entity_types or entity.entity_type_id in entity_types)
+                    and (not event_types or event.event_type_id in event_types)
+                    and (
+                        not entity_groups_allowed
+                        or entity_groups[entity.name] & entity_groups_allowed
+                    )
+                ):
+                    relations.append(
+                        dcm.EntityEventRelation(
+                            entity_event_role=role, event=event, entity=entity
+                        )
+                    )
+                    valid_entities.append(entity.name)
+                else:
+                    invalid_entities.append(entity.name)
+
+        event.unfound_entities = list(set(unfound_entities))
+        event.invalid_entities = list(
+            set([x for x in invalid_entities if x not in valid_entities])
+        )
+
+    dcm.EntityEventRelation.objects.bulk_create(relations)
+
+
 def get_entity_state_point_style(request, relation):
 
     point_style = relation.entity.entity_type.point_style
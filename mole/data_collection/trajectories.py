@@ -0,0 +1,264 @@
+import numpy as np
+from django.db import connection
+
+from data_collection import models as dcm
+
+EARTH_RADIUS = 6371008.8  # mean radius in meters
+DWELL_SPEED = 0.5  # m/s, segments slower than this count as dwelling
+
+METRIC_NAMES = (
+    "pose_count",
+    "duration",
+    "path_length",
+    "average_speed",
+    "max_speed",
+    "dwell_time",
+    "heading_change",
+)
+
+
+class Track:
+    """
+    Time ordered positions of one entity as NumPy arrays (epoch seconds, degrees).
+
+    Per-segment lengths, speeds and turns are computed once and kept as prefix sums so
+    metrics over any number of time windows are a few vectorized lookups.
+    """
+
+    def __init__(self, entity, times, lon, lat, dwell_speed=DWELL_SPEED):
+        self.entity = entity
+        self.times = times
+
+        lon = np.radians(lon)
+        lat = np.radians(lat)
+        dlon = np.diff(lon)
+        dlat = np.diff(lat)
+        # haversine distance and initial bearing of each segment
+        a = (
+            np.sin(dlat / 2) ** 2
+            + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(dlon / 2) ** 2
+        )
+        length = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+        bearing = np.degrees(
+            np.arctan2(
+                np.sin(dlon) * np.cos(lat[1:]),
+                np.cos(lat[:-1]) * np.sin(lat[1:])
+                - np.sin(lat[:-1]) * np.cos(lat[1:]) * np.cos(dlon),
+            )
+        )
+
+        dt = np.diff(times)
+        speed = np.divide(length, dt, out=np.zeros_like(length), where=dt > 0)
+        moving = speed >= dwell_speed
+
+        # turn at each interior pose, only between two moving segments
+        turn = np.abs((np.diff(bearing) + 180) % 360 - 180)
+        turn[~(moving[:-1] & moving[1:])] = 0
+
+        self.speed = speed
+        self.cumulative_length = np.concatenate(([0.0], np.cumsum(length)))
+        self.cumulative_dwell = np.concatenate(([0.0], np.cumsum(np.where(moving, 0, dt))))
+        # indexed by pose, the first and last poses never turn
+        turn_at_pose = np.zeros(len(times))
+        turn_at_pose[1:-1] = turn
+        self.cumulative_turn = np.cumsum(turn_at_pose)
+
+    def window_metrics(self, starts, ends):
+        """
+        Metrics for each [start, end] window (epoch seconds), as a dict of arrays keyed by
+        METRIC_NAMES.  Windows may overlap and need not be sorted.
+        """
+        starts = np.asarray(starts, dtype=float)
+        ends = np.asarray(ends, dtype=float)
+        first = np.searchsorted(self.times, starts, side="left")
+        last = np.searchsorted(self.times, ends, side="right") - 1
+        count = np.maximum(last - first + 1, 0)
+        has_segments = count >= 2
+        first = np.where(has_segments, first, 0)
+        last = np.where(has_segments, last, 0)
+
+        duration = np.where(has_segments, self.times[last] - self.times[first], 0.0)
+        path_length = self.cumulative_length[last] - self.cumulative_length[first]
+        dwell_time = self.cumulative_dwell[last] - self.cumulative_dwell[first]
+        # turns happen at the interior poses first + 1 .. last - 1
+        heading_change = np.where(
+            count >= 3,
+            self.cumulative_turn[np.maximum(last - 1, 0)] - self.cumulative_turn[first],
+            0.0,
+        )
+        average_speed = np.divide(
+            path_length, duration, out=np.zeros_like(path_length), where=duration > 0
+        )
+        # segments first .. last - 1, padded so every reduceat index is in range
+        if len(self.speed):
+            bounds = np.column_stack((first, np.maximum(last, first + 1))).ravel()
+            max_speed = np.maximum.reduceat(np.append(self.speed, 0.0), bounds)[::2]
+            max_speed = np.where(has_segments, max_speed, 0.0)
+        else:
+            max_speed = np.zeros(len(starts))
+
+        return {
+            "pose_count": count,
+            "duration": duration,
+            "path_length": path_length,
+            "average_speed": average_speed,
+            "max_speed": max_speed,
+            "dwell_time": dwell_time,
+            "heading_change": heading_change,
+        }
+
+
+def load_tracks(trial_id, entity_ids=None, start=None, end=None, dwell_speed=DWELL_SPEED):
+    """
+    Fetch a trial's poses as columnar arrays in one query and split them into a Track per
+    entity, keyed by entity name.
+    """
+    conditions = ["trial_id = %s"]
+    params = [trial_id]
+    if entity_ids is not None:
+        conditions.append("entity_id = ANY(%s)")
+        params.append(list(entity_ids))
+    if start is not None:
+        conditions.append('"timestamp" >= %s')
+        params.append(start)
+    if end is not None:
+        conditions.append('"timestamp" <= %s')
+        params.append(end)
+
+    with connection.cursor() as cursor:
+        # a backward scan of pose_trial_entity_ts_idx yields this order
+        cursor.execute(
+            'SELECT entity_id, EXTRACT(EPOCH FROM "timestamp"), ST_X(point), ST_Y(point) '
+            "FROM {} WHERE {} "
+            'ORDER BY entity_id DESC, "timestamp" ASC'.format(
+                dcm.Pose._meta.db_table, " AND ".join(conditions)
+            ),
+            params,
+        )
+        rows = cursor.fetchall()
+
+    if not rows:
+        return {}
+    entities, times, lon, lat = zip(*rows)
+    entities = np.array(entities, dtype=object)
+    columns = np.array([times, lon, lat], dtype=float)
+    # rows are grouped by entity, so split at each change of name
+    splits = np.flatnonzero(entities[1:] != entities[:-1]) + 1
+    tracks = {}
+    for begin, finish in zip(
+        np.concatenate(([0], splits)), np.concatenate((splits, [len(rows)]))
+    ):
+        entity = entities[begin]
+        tracks[entity] = Track(
+            entity,
+            columns[0, begin:finish],
+            columns[1, begin:finish],
+            columns[2, begin:finish],
+            dwell_speed,
+        )
+    return tracks
+
+
+def _as_dicts(metrics):
+    names = METRIC_NAMES
+    return [
+        dict(zip(names, values))
+        for values in zip(*(metrics[name].tolist() for name in names))
+    ]
+
+
+def trajectory_metrics(trial_id, entity_ids=None, start=None, end=None, dwell_speed=DWELL_SPEED):
+    """
+    Metrics for each entity's track within a trial, optionally limited to a time window.
+    Returns a list of dicts with an "entity" key, ordered by entity.
+    """
+    tracks = load_tracks(trial_id, entity_ids, start, end, dwell_speed)
+    result = []
+    for entity in sorted(tracks):
+        track = tracks[entity]
+        metrics = track.window_metrics([track.times[0]], [track.times[-1]])
+        result.append(dict(entity=entity, **_as_dicts(metrics)[0]))
+    return result
+
+
+def event_windows(events):
+    """
+    The (start, end) window of each event: its end_datetime, or failing that the start of
+    the next event in the same trial of a type it is exclusive with.  Events with neither
+    are left out.  Returns a dict keyed by event id.
+    """
+    events = list(events)
+    exclusive = {}
+    for event_type, other in dcm.EventType.exclusive_with.through.objects.filter(
+        from_eventtype__in=set(event.event_type_id for event in events)
+    ).values_list("from_eventtype_id", "to_eventtype_id"):
+        exclusive.setdefault(event_type, set()).add(other)
+
+    open_events = [
+        event for event in events if event.end_datetime is None and event.event_type_id in exclusive
+    ]
+    starts = {}
+    if open_events:
+        for trial_id, event_type, start in (
+            dcm.Event.objects.filter(
+                trial__in=set(event.trial_id for event in open_events),
+                event_type__in=set().union(*exclusive.values()),
+            )
+            .order_by("start_datetime")
+            .values_list("trial_id", "event_type_id", "start_datetime")
+        ):
+            starts.setdefault((trial_id, event_type), []).append(start.timestamp())
+
+    windows = {}
+    for event in events:
+        if event.end_datetime is not None:
+            windows[event.id] = (event.start_datetime.timestamp(), event.end_datetime.timestamp())
+            continue
+        start = event.start_datetime.timestamp()
+        ends = []
+        for event_type in exclusive.get(event.event_type_id, ()):
+            later = starts.get((event.trial_id, event_type), [])
+            index = np.searchsorted(later, start, side="right")
+            if index < len(later):
+                ends.append(later[index])
+        if ends:
+            windows[event.id] = (start, min(ends))
+    return windows
+
+
+def event_metrics(events, dwell_speed=DWELL_SPEED):
+    """
+    Trajectory metrics over each event's window (see event_windows) for the event's
+    start pose entity and related entities.  Poses are loaded once per trial and each
+    entity's windows are computed together.  Returns {event id: {entity: metrics}}.
+    """
+    events = list(events)
+    windows = event_windows(events)
+    entities = {}
+    for event_id, entity in dcm.EntityEventRelation.objects.filter(
+        event__in=list(windows)
+    ).values_list("event_id", "entity_id"):
+        entities.setdefault(event_id, set()).add(entity)
+    for event_id, entity in dcm.Event.objects.filter(
+        id__in=list(windows), start_pose__isnull=False
+    ).values_list("id", "start_pose__entity_id"):
+        entities.setdefault(event_id, set()).add(entity)
+
+    by_trial = {}
+    for event in events:
+        if event.id in windows and event.id in entities:
+            by_trial.setdefault(event.trial_id, []).append(event.id)
+
+    result = {event.id: {} for event in events}
+    for trial_id, event_ids in by_trial.items():
+        wanted = set().union(*(entities[event_id] for event_id in event_ids))
+        tracks = load_tracks(trial_id, wanted, dwell_speed=dwell_speed)
+        for entity, track in tracks.items():
+            entity_events = [e for e in event_ids if entity in entities[e]]
+            metrics = track.window_metrics(
+                [windows[e][0] for e in entity_events],
+                [windows[e][1] for e in entity_events],
+            )
+            for event_id, values in zip(entity_events, _as_dicts(metrics)):
+                result[event_id][entity] = values
+    return result
@@ -1,8 +1,10 @@
+import csv
 import datetime
 import pytz
 import json
 import os.path
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 from django.conf import settings
 from rest_framework.settings import api_settings
@@ -12,7 +14,16 @@ from django.contrib.auth.models import User
 from django.contrib.gis.geos import Point
 from django.contrib.gis.measure import D
 from django.contrib.gis.db.models.functions import Distance
-from django.db.models import Count, OuterRef, Subquery, Q
+from django.db import transaction
+from django.db.models import (
+    Count,
+    Exists,
+    OuterRef,
+    Prefetch,
+    Subquery,
+    Q,
+    prefetch_related_objects,
+)
 from django.shortcuts import get_object_or_404
 from rest_framework.filters import OrderingFilter
 from rest_framework import permissions
@@ -29,6 +40,7 @@ from data_collection.permissions import IsOwnerOrReadOnly, IsTargetUserOrReadOnl
 import data_collection.models as dcm
 import data_collection.serializers as dcs
 from data_collection import schemas
+from data_collection import trajectories
 
 from ast import literal_eval
 import pandas as pd
@@ -38,9 +50,8 @@ import logging
 from django.utils.text import slugify
 
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
-from django.http import Http404
+from django.http import Http404, StreamingHttpResponse
 
-import pulsar
 import redis
 
 from automation.scenario_scripts.scenario_scripts import ScenarioScripts
@@ -49,12 +60,6 @@ ss = ScenarioScripts()
 log = logging.getLogger("mole")
 
 
-pulsar_client = None
-if not settings.TEST_DJANGO:
-    log.info("Initializing Pulsar Client")
-    pulsar_client = pulsar.Client("pulsar://pulsar:6650")
-
-
 class EventPagination(CursorPagination):
     page_size = 10
     page_size_query_param = "page_size"
@@ -78,6 +83,14 @@ class PosePagination(CursorPagination):
     cursor_query_param = "cursor"  # default value = 'cursor'
 
 
+class RegionVisitPagination(CursorPagination):
+    page_size = 100
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+    ordering = ("entered", "id")
+    cursor_query_param = "cursor"  # default value = 'cursor'
+
+
 class AllowPUTAsCreateMixin(object):
     """
     The following mixin class may be used in order to support PUT-as-create
@@ -120,6 +133,100 @@ class AllowPUTAsCreateMixin(object):
                 raise
 
 
+def parse_timestamp(value):
+    """
+    Parse an ISO 8601 querystring timestamp, treating naive values as UTC.
+    Returns None if the value is not a valid timestamp.
+    """
+    try:
+        parsed = parse_datetime(value)
+    except ValueError:
+        return None
+    if parsed is not None and timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed, pytz.utc)
+    return parsed
+
+
+def as_of_params(query_params):
+    """
+    Read the `timestamp`, `trial` and `interpolate` querystrings used by as-of position
+    queries into keyword arguments for dcm.entity_positions_sql.
+    """
+    as_of = {}
+    timestamp = query_params.get("timestamp")
+    if timestamp is not None:
+        as_of["timestamp"] = parse_timestamp(timestamp)
+        if as_of["timestamp"] is None:
+            raise exceptions.ValidationError(
+                detail=f"Invalid timestamp value: {timestamp}"
+            )
+    trial = query_params.get("trial")
+    if trial is not None:
+        try:
+            as_of["trial_id"] = int(trial)
+        except ValueError:
+            raise exceptions.ValidationError(detail=f"Invalid trial value: {trial}")
+    as_of["interpolate"] = query_params.get("interpolate", "").lower() in ("true", "1")
+    return as_of
+
+
+class EchoBuffer:
+    """
+    File-like object whose write() hands the value back, so csv.writer can feed a generator.
+    """
+
+    def write(self, value):
+        return value
+
+
+class StreamingCSVMixin(object):
+    """
+    Streams a CSV export row by row instead of building a DataFrame of the whole queryset.
+    Rows are fetched with a server side cursor and serialized in chunks of csv_chunk_size,
+    with the queryset's prefetch lookups applied to each chunk.  Serializers that provide an
+    export_rows classmethod produce the rows themselves.
+    """
+
+    csv_chunk_size = 2000
+
+    def streaming_csv_response(self, queryset, serializer_class):
+        field_names = list(serializer_class().fields.keys())
+        prefetch_lookups = queryset._prefetch_related_lookups
+        context = self.get_serializer_context()
+        writer = csv.writer(EchoBuffer())
+
+        def serialize(chunk):
+            if prefetch_lookups:
+                prefetch_related_objects(chunk, *prefetch_lookups)
+            for row in serializer_class(chunk, many=True, context=context).data:
+                yield writer.writerow([row.get(name) for name in field_names])
+
+        def rows():
+            yield writer.writerow(field_names)
+            if hasattr(serializer_class, "export_rows"):
+                # serializer builds its rows straight from values() queries
+                for row in serializer_class.export_rows(queryset, self.csv_chunk_size):
+                    yield writer.writerow([row.get(name) for name in field_names])
+                return
+
+            chunk = []
+            for obj in queryset.iterator(chunk_size=self.csv_chunk_size):
+                chunk.append(obj)
+                if len(chunk) == self.csv_chunk_size:
+                    yield from serialize(chunk)
+                    chunk = []
+            if chunk:
+                yield from serialize(chunk)
+
+        response = StreamingHttpResponse(rows(), content_type="text/csv")
+        filename = self.get_pandas_filename(self.request, "csv")
+        if filename:
+            response["Content-Disposition"] = 'attachment; filename="{}.csv"'.format(
+                filename
+            )
+        return response
+
+
 class ListFilter(django_filters.Filter):
     """
     To support comma separated list in querystrings. (e.g. ?name=foo,bar)
@@ -219,6 +326,7 @@ class EntityFilter(filters.FilterSet):
     )
 
     region = filters.CharFilter(method="region_filter")
+    region_z_layer = filters.NumberFilter(method="region_filter")
 
     class Meta:
         model = dcm.Entity
@@ -230,31 +338,30 @@ class EntityFilter(filters.FilterSet):
             "groups",
             "mods",
             "region",
+            "region_z_layer",
         ]
 
     def region_filter(self, queryset, name, value):
-        _filter = []
-        for q in queryset.iterator():
-            pose = dcm.Pose.objects.filter(entity__name=q.name).order_by("timestamp")
-
-            if "entity_type" in self.data.keys():
-                pose = pose.filter(entity__entity_type=self.data["entity_type"])
-
-            last_pose = pose.last()
-
+        # region and region_z_layer are combined into one spatial join, applied once
+        if name == "region_z_layer" and self.data.get("region"):
+            return queryset
+
+        getlist = getattr(self.data, "getlist", lambda key: [self.data.get(key)])
+        regions = dcm.Region.objects.all()
+        region_names = [x for x in getlist("region") if x]
+        if region_names:
+            regions = regions.filter(name__in=region_names)
+        z_layers = [x for x in getlist("region_z_layer") if x not in (None, "")]
+        if z_layers:
             try:
-                pnt = last_pose.point
-                region = dcm.Region.objects.filter(name=value).filter(
-                    geom__contains=pnt
-                )
-
-                if region:
-                    _filter.append(q.name)
-
-            except AttributeError:
-                pass
+                regions = regions.filter(z_layer__in=[float(x) for x in z_layers])
+            except ValueError:
+                raise exceptions.ValidationError("region_z_layer must be a number")
 
-        return queryset.filter(name__in=_filter)
+        # entities whose latest pose lies inside any of the selected regions
+        return queryset.filter(
+            Exists(regions.filter(geom__contains=OuterRef("latest_pose_entry__point")))
+        )
 
 
 class EntityStateViewSet(viewsets.ModelViewSet):
@@ -291,22 +398,39 @@ class EntityViewSet(AllowPUTAsCreateMixin, viewsets.ModelViewSet):
     *  e.g. `entities/?entity_type=uav`
     *  e.g. `entities/?entity_type=uav&entity_type=wheeled_robot`
 
-    Region can be filtered as well using the `region` querystring.
+    Region can be filtered as well using the `region` querystring, based on each entity's latest pose.
+    Querying multiple regions will return entities inside any of them. `region_z_layer` limits the regions
+    considered to the given z layers and may be used on its own.
 
     *  e.g `entities/?region=SectorA`
     *  e.g `entities/?region=SectorB&entity_type=ugv`
+    *  e.g `entities/?region=SectorA&region=SectorB`
+    *  e.g `entities/?region_z_layer=1`
 
     This viewset also provides the ability to view other entities that are near another entity or a specified location.
       e.g. entities/{target_entity}/around
       e.g. entities/{target_entity}/around?distance=5.6
       e.g. entities/radius?latitude=30&longitude=-117
       e.g. entities/radius?latitude=33.4&longitude=32.3&distance=32
+
+    All pairs of entities near each other can be listed at once.
+      e.g. entities/proximity?distance=10
+      e.g. entities/proximity?distance=10&entity_type=uav
+
+    around, radius and proximity accept `timestamp` to use each entity's last pose at or before that time,
+    `trial` to only consider poses from one trial, and `interpolate=true` to interpolate between poses.
+      e.g. entities/{target_entity}/around?distance=50&timestamp=2022-03-01T14:03:22Z
+      e.g. entities/proximity?distance=10&timestamp=2022-03-01T14:03:22Z&interpolate=true
     """
 
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
     queryset = (
         dcm.Entity.objects.all()
-        .select_related("entity_type")
+        .select_related(
+            "entity_type",
+            "latest_pose_entry__pose__entity__entity_type__point_style",
+            "latest_pose_entry__pose__pose_source",
+        )
         .prefetch_related("trials")
     )
     serializer_class = dcs.EntitySerializer
@@ -346,13 +470,20 @@ class EntityViewSet(AllowPUTAsCreateMixin, viewsets.ModelViewSet):
         # Determine point of origin
         # Check radius around this entity
         obj = get_object_or_404(dcm.Entity, pk=pk)
-        last_pose = dcm.Pose.objects.filter(entity=obj).order_by("timestamp").last()
-        if not last_pose:
+        as_of = as_of_params(self.request.query_params)
+        if as_of.get("timestamp") is not None or as_of.get("trial_id") is not None:
+            origin = dcm.poses_as_of(entity_ids=[obj.name], **as_of)
+            point_of_origin = origin[0].point if origin else None
+        else:
+            try:
+                point_of_origin = obj.latest_pose_entry.point
+            except dcm.LatestPose.DoesNotExist:
+                point_of_origin = None
+        if point_of_origin is None:
             return Response(
                 f"No pose associated with this entity: {obj.name}",
                 status=status.HTTP_404_NOT_FOUND,
             )
-        point_of_origin = last_pose.point
 
         distance = self.request.query_params.get("distance", 5.0)
         try:
@@ -366,15 +497,16 @@ class EntityViewSet(AllowPUTAsCreateMixin, viewsets.ModelViewSet):
         queryset = self.filter_queryset(self.get_queryset())
         queryset = queryset.exclude(pk=pk)
 
-        most_recent_pose = dcm.Pose.objects.filter(entity=OuterRef("pk")).order_by(
-            "-timestamp"
-        )
-        nearby = (
-            queryset.annotate(
-                most_recent_pose=Subquery(most_recent_pose.values("point")[:1])
+        if as_of.get("timestamp") is not None or as_of.get("trial_id") is not None:
+            entity_names = queryset.order_by().values_list("name", flat=True).distinct()
+            return Response(
+                dcm.entities_within(point_of_origin, distance, entity_names, **as_of)
             )
-            .filter(most_recent_pose__distance_lte=(point_of_origin, D(m=distance)))
-            .annotate(distance=Distance("most_recent_pose", point_of_origin))
+
+        nearby = (
+            queryset.annotate(geography=dcm.as_geography("latest_pose_entry__point"))
+            .filter(geography__dwithin=(point_of_origin, D(m=distance)))
+            .annotate(distance=Distance("geography", point_of_origin))
             .order_by("distance")
             .values_list("name", "distance")
         )
@@ -445,21 +577,70 @@ class EntityViewSet(AllowPUTAsCreateMixin, viewsets.ModelViewSet):
 
         queryset = self.filter_queryset(self.get_queryset())
 
-        most_recent_pose = dcm.Pose.objects.filter(entity=OuterRef("pk")).order_by(
-            "-timestamp"
-        )
-        nearby = (
-            queryset.annotate(
-                most_recent_pose=Subquery(most_recent_pose.values("point")[:1])
+        as_of = as_of_params(self.request.query_params)
+        if as_of.get("timestamp") is not None or as_of.get("trial_id") is not None:
+            entity_names = queryset.order_by().values_list("name", flat=True).distinct()
+            return Response(
+                dcm.entities_within(point_of_origin, distance, entity_names, **as_of)
             )
-            .filter(most_recent_pose__distance_lte=(point_of_origin, D(m=distance)))
-            .annotate(distance=Distance("most_recent_pose", point_of_origin))
+
+        nearby = (
+            queryset.annotate(geography=dcm.as_geography("latest_pose_entry__point"))
+            .filter(geography__dwithin=(point_of_origin, D(m=distance)))
+            .annotate(distance=Distance("geography", point_of_origin))
             .order_by("distance")
             .values_list("name", "distance")
         )
 
         return Response([(x, y.m) for x, y in nearby])
 
+    @action(detail=False)
+    def proximity(self, request):
+        """
+        This endpoint provides every pair of entities that are \
+            within <distance> meters of each other.
+        The return value is a list of tuples where the tuple \
+            contains the names of both entities and the distance \
+            between them in meters. Each pair is listed once.
+        The return value is sorted in ascending order of distance \
+            (i.e. closest pairs first).
+
+        The default value for the distance querystring is 5.0 if not specified.
+
+            entities/proximity?distance=10
+
+        Positions are each entity's latest pose. The 'timestamp' querystring \
+            uses each entity's last pose at or before that time instead, \
+            'trial' only considers poses from that trial, and 'interpolate=true' \
+            interpolates between the poses either side of the timestamp.
+
+            entities/proximity?distance=10&timestamp=2022-03-01T14:03:22Z
+            entities/proximity?distance=10&timestamp=2022-03-01T14:03:22Z&interpolate=true
+
+        The 'entity_type', 'group', 'group__in' and 'region' querystrings \
+            limit the entities considered, as on the entity list.
+
+            entities/proximity?distance=50&entity_type=uav&entity_type=ugv
+            entities/proximity?distance=50&group=red_team
+
+        """
+        distance = self.request.query_params.get("distance", 5.0)
+        try:
+            distance = float(distance)
+        except (ValueError):
+            return Response(
+                f"Invalid distance value: {distance}",
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        as_of = as_of_params(self.request.query_params)
+
+        queryset = self.filter_queryset(self.get_queryset())
+        entity_names = queryset.order_by().values_list("name", flat=True).distinct()
+        pairs = dcm.entity_proximity_pairs(entity_names, distance, **as_of)
+
+        return Response(pairs)
+
 
 class EntityTypeViewSet(viewsets.ModelViewSet):
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
@@ -704,6 +885,9 @@ class TrialViewSet(viewsets.ModelViewSet):
     Otherwise, *end_datetime* will be automatically determined based on *start_datetime* and the *time_limit* field of the *scenario*.
     Trials may also have an associated game clock state. To get the clock state for a trial,
     query trials/{id}/clock_state.
+
+    Path length, speed, dwell time and heading change of each entity's track are available from
+    trials/{id}/trajectory_metrics.
     """
 
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
@@ -717,50 +901,32 @@ class TrialViewSet(viewsets.ModelViewSet):
     schema = schemas.TrialSchema()
 
     def perform_update(self, serializer):
-        saved = serializer.save()
+        with transaction.atomic():
+            saved = serializer.save()
 
-        try:
-            trial_producer = pulsar_client.create_producer("public/default/_trial_log")
-        except Exception:  # Pulsar doesn't provide a subtype of Exception
-            # abort the pulsar message if pulsar is not available
-            return
-
-        new_payload = dict(serializer.data)
+            new_payload = dict(serializer.data)
         
-        new_payload["update"] = True
-        new_payload["name"] = str(saved)
-        new_payload["scenario"] = dcs.ScenarioSerializer(saved.scenario, context={'request': self.request}).data
-        new_payload["test_condition"] = dcs.TestConditionSerializer(saved.test_condition, context={'request': self.request}).data
-        new_payload["testers"] = [reverse("tester-detail", args=[t.id], request=self.request) for t in saved.testers.all()]
-
-        trial_producer.send_async(
-            json.dumps(new_payload).encode("utf-8"),
-            None,
-        )
-        trial_producer.close()
+            new_payload["update"] = True
+            new_payload["name"] = str(saved)
+            new_payload["scenario"] = dcs.ScenarioSerializer(saved.scenario, context={'request': self.request}).data
+            new_payload["test_condition"] = dcs.TestConditionSerializer(saved.test_condition, context={'request': self.request}).data
+            new_payload["testers"] = [reverse("tester-detail", args=[t.id], request=self.request) for t in saved.testers.all()]
 
-    def perform_create(self, serializer):
-        saved = serializer.save()
+            dcm.enqueue_messages("public/default/_trial_log", [new_payload])
 
-        try:
-            trial_producer = pulsar_client.create_producer("public/default/_trial_log")
-        except Exception:  # Pulsar doesn't provide a subtype of Exception
-            # abort the pulsar message if pulsar is not available
-            return
+    def perform_create(self, serializer):
+        with transaction.atomic():
+            saved = serializer.save()
 
-        new_payload = dict(serializer.data)
+            new_payload = dict(serializer.data)
         
-        new_payload["update"] = False
-        new_payload["name"] = str(saved)
-        new_payload["scenario"] = dcs.ScenarioSerializer(saved.scenario, context={'request': self.request}).data
-        new_payload["test_condition"] = dcs.TestConditionSerializer(saved.test_condition, context={'request': self.request}).data
-        new_payload["testers"] = [reverse("tester-detail", args=[t.id], request=self.request) for t in saved.testers.all()]
-
-        trial_producer.send_async(
-            json.dumps(new_payload).encode("utf-8"),
-            None,
-        )
-        trial_producer.close()
+            new_payload["update"] = False
+            new_payload["name"] = str(saved)
+            new_payload["scenario"] = dcs.ScenarioSerializer(saved.scenario, context={'request': self.request}).data
+            new_payload["test_condition"] = dcs.TestConditionSerializer(saved.test_condition, context={'request': self.request}).data
+            new_payload["testers"] = [reverse("tester-detail", args=[t.id], request=self.request) for t in saved.testers.all()]
+
+            dcm.enqueue_messages("public/default/_trial_log", [new_payload])
 
     @action(detail=False, schema=None)
     def latest(self, request):
@@ -814,36 +980,32 @@ class TrialViewSet(viewsets.ModelViewSet):
         """
         View to view datetimes for the specified trial as well as matching major (x.0.0), 
         minor (x,y.0), and reported trial (x.y.z where x.y.z's reported flag is True)
+
+        Phase times come from each trial's cached clock timeline, so this is read only.
         """
         # get current trial
+        trials = dcm.Trial.objects.select_related("clock_config")
         try:
-            current_trial = dcm.Trial.objects.get(id=pk)
+            current_trial = trials.get(id=pk)
         except dcm.Trial.DoesNotExist:
             current_trial = dcm.get_current_trial()
 
-        # get minor and major trials related to current trial
-        try:
-            minor_trial = dcm.Trial.objects.get(
-                Q(id_major=current_trial.id_major)
-                & Q(id_minor=current_trial.id_minor)
-                & Q(id_micro=0)
-            )
-        except dcm.Trial.DoesNotExist:
-            minor_trial = None
-
-        try:
-            major_trial = dcm.Trial.objects.get(
-                Q(id_major=current_trial.id_major) & Q(id_minor=0) & Q(id_micro=0)
+        # get minor (x.y.0), major (x.0.0) and reported trials related to current trial in one query
+        minor_trial = major_trial = reported_trial = None
+        for trial in trials.filter(
+            Q(id_major=current_trial.id_major)
+            & (
+                Q(id_minor=current_trial.id_minor, id_micro=0)
+                | Q(id_minor=0, id_micro=0)
+                | Q(id_minor=current_trial.id_minor, reported=True)
             )
-        except dcm.Trial.DoesNotExist:
-            major_trial = None
-
-        # get reported trial related to current trial
-        reported_trial = dcm.Trial.objects.filter(
-            Q(id_major=current_trial.id_major) 
-            & Q(id_minor=current_trial.id_minor) 
-            & Q(reported=True)
-        ).first()
+        ):
+            if minor_trial is None and trial.id_minor == current_trial.id_minor and trial.id_micro == 0:
+                minor_trial = trial
+            if major_trial is None and trial.id_minor == 0 and trial.id_micro == 0:
+                major_trial = trial
+            if reported_trial is None and trial.id_minor == current_trial.id_minor and trial.reported:
+                reported_trial = trial
 
         # get phases for each trial
         current_phase, current_next = dcm.get_clock_phase(current_trial)
@@ -864,6 +1026,65 @@ class TrialViewSet(viewsets.ModelViewSet):
         response = Response(content)
         return response
 
+    @action(detail=True)
+    def trajectory_metrics(self, request, pk=None):
+        """
+        Provide path length (m), duration (s), average and max speed (m/s), dwell time (s) and
+        total heading change (degrees) of each entity's track in the trial.
+
+        `entity` (repeatable), `min_datetime` and `max_datetime` limit the poses considered.
+        `dwell_speed` sets the speed in m/s below which an entity counts as dwelling (default 0.5).
+
+            trials/{id}/trajectory_metrics?entity=uav_1&min_datetime=2022-03-01T14:00:00Z
+
+        With `events=true` the metrics are instead given per event, over each event's duration
+        (or until the next event it is exclusive with), for the event's start pose entity and
+        related entities. `event_type` (repeatable) limits the events considered.
+
+            trials/{id}/trajectory_metrics?events=true&event_type=Mission%20Start
+        """
+        trial = self.get_object()
+
+        dwell_speed = self.request.query_params.get("dwell_speed", trajectories.DWELL_SPEED)
+        try:
+            dwell_speed = float(dwell_speed)
+        except ValueError:
+            return Response(
+                f"Invalid dwell_speed value: {dwell_speed}",
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        if self.request.query_params.get("events", "").lower() in ("true", "1"):
+            events = dcm.Event.objects.filter(trial=trial).order_by("start_datetime", "id")
+            event_types = self.request.query_params.getlist("event_type")
+            if event_types:
+                events = events.filter(event_type__name__in=event_types)
+            metrics = trajectories.event_metrics(events, dwell_speed)
+            return Response(
+                [{"event": event_id, "entities": entities} for event_id, entities in metrics.items()]
+            )
+
+        bounds = {}
+        for name in ("min_datetime", "max_datetime"):
+            value = self.request.query_params.get(name)
+            if value is not None:
+                bounds[name] = parse_timestamp(value)
+                if bounds[name] is None:
+                    return Response(
+                        f"Invalid {name} value: {value}",
+                        status=status.HTTP_400_BAD_REQUEST,
+                    )
+
+        return Response(
+            trajectories.trajectory_metrics(
+                trial.id,
+                entity_ids=self.request.query_params.getlist("entity") or None,
+                start=bounds.get("min_datetime"),
+                end=bounds.get("max_datetime"),
+                dwell_speed=dwell_speed,
+            )
+        )
+
 
 def buildClockState(trial, phase):
     state = {"detail": "No clock state for requested trial."}
@@ -1030,7 +1251,7 @@ class PoseFilter(filters.FilterSet):
         fields = ["max_datetime", "min_datetime", "entity_name"]
 
 
-class PoseViewSet(viewsets.ModelViewSet, rest_pandas.PandasMixin):
+class PoseViewSet(StreamingCSVMixin, viewsets.ModelViewSet, rest_pandas.PandasMixin):
     """
     This endpoint represents entity poses
 
@@ -1082,7 +1303,11 @@ class PoseViewSet(viewsets.ModelViewSet, rest_pandas.PandasMixin):
             # BrowsableAPIRenderer
             renderer = renderer.get_default_renderer(self)
 
-        if isinstance(renderer, rest_pandas.PandasBaseRenderer):
+        if isinstance(renderer, rest_pandas.PandasCSVRenderer):
+            # Stream file downloads so memory use does not grow with the export
+            queryset = self.filter_queryset(self.get_queryset())
+            return self.streaming_csv_response(queryset, dcs.PoseDataSerializer)
+        elif isinstance(renderer, rest_pandas.PandasBaseRenderer):
             queryset = self.filter_queryset(self.get_queryset())
             serializer = self.get_serializer(queryset, many=True)
             return self.update_pandas_headers(Response(serializer.data))
@@ -1115,13 +1340,27 @@ class PoseViewSet(viewsets.ModelViewSet, rest_pandas.PandasMixin):
     def latest(self, request):
         """
         This endpoint provides info about the most recent poses for all entities on a given trial.
+
+        The `timestamp` query parameter gives each entity's pose as of that time instead, and
+        `interpolate=true` places entities between their bracketing poses. Interpolated poses
+        are not stored, so they have no `id` or `url`.
+
+            poses/latest?trial=3&timestamp=2022-03-01T14:03:22Z&interpolate=true
         """
         trial_id = self.request.query_params.get("trial")
         if not trial_id:
             return Response("This endpoint expects a `trial` query parameter", status=status.HTTP_400_BAD_REQUEST)
         # retrieve queryset and filter if user requested any filtering
         queryset = self.filter_queryset(self.get_queryset())
-        poses = queryset.order_by("entity__name", "-timestamp").filter(trial=trial_id).distinct("entity__name")
+        if "timestamp" in self.request.query_params:
+            as_of = as_of_params(self.request.query_params)
+            entity_names = dcm.Entity.objects.filter(
+                Exists(queryset.filter(entity=OuterRef("pk"), trial=trial_id))
+            ).values_list("name", flat=True)
+            poses = dcm.poses_as_of(entity_ids=entity_names, **as_of)
+            return Response(dcs.PoseSerializer(poses, context={"request": request}, many=True).data)
+        # entity's primary key is its name, so this ordering is served by pose_trial_entity_ts_idx
+        poses = queryset.order_by("entity", "-timestamp").filter(trial=trial_id).distinct("entity")
         return Response(dcs.PoseSerializer(poses, context={"request": request}, many=True).data)
 
 
@@ -1303,7 +1542,7 @@ class EntityEventRoleViewSet(viewsets.ModelViewSet):
     serializer_class = dcs.EntityEventRoleSerializer
 
 
-class EventViewSet(viewsets.ModelViewSet, rest_pandas.PandasMixin):
+class EventViewSet(StreamingCSVMixin, viewsets.ModelViewSet, rest_pandas.PandasMixin):
     """
     This endpoint represents triggered events.
 
@@ -1420,9 +1659,14 @@ class EventViewSet(viewsets.ModelViewSet, rest_pandas.PandasMixin):
             # BrowsableAPIRenderer
             renderer = renderer.get_default_renderer(self)
 
-        if isinstance(renderer, rest_pandas.PandasBaseRenderer):
+        if isinstance(renderer, rest_pandas.PandasCSVRenderer):
+            # Stream file downloads so memory use does not grow with the export
             queryset = self.filter_queryset(self.get_queryset())
-            serializer = self.get_serializer(queryset, many=True)
+            return self.streaming_csv_response(queryset, dcs.EventDataSerializer)
+        elif isinstance(renderer, rest_pandas.PandasBaseRenderer):
+            queryset = self.filter_queryset(self.get_queryset())
+            rows = list(dcs.EventDataSerializer.export_rows(queryset))
+            serializer = self.get_serializer(rows, many=True)
             return self.update_pandas_headers(Response(serializer.data))
         else:
             return super().list(request, *args, *kwargs)
@@ -1450,17 +1694,7 @@ class EventViewSet(viewsets.ModelViewSet, rest_pandas.PandasMixin):
         else:
             return self.serializer_class
 
-    def perform_create(self, serializer):
-        saved = serializer.save()
-        if isinstance(saved, list):
-            return
-
-        try:
-            event_producer = pulsar_client.create_producer("public/default/_event_log")
-        except Exception:  # Pulsar doesn't provide a subtype of Exception
-            # abort the pulsar message if pulsar is not available
-            return
-
+    def event_log_payload(self, saved, update):
         point_style = dcs.PointStyleSerializer(saved.event_type.point_style, context={'request': None})
         related_entity_names = []
         for related_entity in saved.entities.all():
@@ -1483,7 +1717,7 @@ class EventViewSet(viewsets.ModelViewSet, rest_pandas.PandasMixin):
             else None,
             "provided_pk": saved.pk,
             "metadata": saved.metadata if saved.metadata else {},
-            "update": False,
+            "update": update,
             "point_style": point_style.data,
             "related_entities": related_entity_names
         }
@@ -1491,64 +1725,35 @@ class EventViewSet(viewsets.ModelViewSet, rest_pandas.PandasMixin):
             data["start_pose_x"] = saved.start_pose.point[0]
             data["start_pose_y"] = saved.start_pose.point[1]
             data["start_pose_z"] = saved.start_pose.elevation
+        return data
 
-        event_producer.send_async(
-            json.dumps(data).encode("utf-8"),
-            None,
+    def publish_events(self, events, update):
+        # Bulk posts queue one message per event so existing _event_log consumers are unchanged.
+        if len(events) > 1:
+            prefetch_related_objects(
+                events, "entities", "event_type__point_style", "trial", "start_pose"
+            )
+        dcm.enqueue_messages(
+            "public/default/_event_log",
+            [self.event_log_payload(saved, update) for saved in events],
         )
-        event_producer.close()
-        ss.schedule_events(saved)
-
-    def perform_update(self, serializer):
-        saved = serializer.save()
-        if isinstance(saved, list):
-            return
-
-        # Send event trigger messages when event is updated.
-        # This allows triggers to be created that respond to manually created events.
-        try:
-            event_producer = pulsar_client.create_producer("public/default/_event_log")
-        except Exception:  # Pulsar doesn't provide a subtype of Exception
-            # abort the pulsar message if pulsar is not available
-            return
 
-        point_style = dcs.PointStyleSerializer(saved.event_type.point_style, context={'request': None})
-        
-        related_entity_names = []
-        for related_entity in saved.entities.all():
-            related_entity_names.append(related_entity.name)
-
-        data = {
-            "url": reverse("event-detail", args=[saved.pk], request=self.request),
-            "id": saved.id,
-            "trial": saved.trial.id,
-            "event_type": saved.event_type.name,
-            "event_type_id": saved.event_type.id,
-            "submitted_datetime": saved.submitted_datetime.isoformat()
-            if saved.submitted_datetime
-            else None,
-            "start_datetime": saved.start_datetime.isoformat()
-            if saved.start_datetime
-            else None,
-            "end_datetime": saved.end_datetime.isoformat()
-            if saved.end_datetime
-            else None,
-            "provided_pk": saved.pk,
-            "metadata": saved.metadata if saved.metadata else {},
-            "update": True,
-            "point_style": point_style.data,
-            "related_entities": related_entity_names
-        }
-        if saved.start_pose:
-            data["start_pose_x"] = saved.start_pose.point[0]
-            data["start_pose_y"] = saved.start_pose.point[1]
-            data["start_pose_z"] = saved.start_pose.elevation
+    def perform_create(self, serializer):
+        with transaction.atomic():
+            saved = serializer.save()
+            events = saved if isinstance(saved, list) else [saved]
+            self.publish_events(events, update=False)
+        ss.schedule_event_batch(events)
 
-        event_producer.send_async(
-            json.dumps(data).encode("utf-8"),
-            None,
-        )
-        event_producer.close()
+    def perform_update(self, serializer):
+        with transaction.atomic():
+            saved = serializer.save()
+            if isinstance(saved, list):
+                return
+
+            # Send event trigger messages when event is updated.
+            # This allows triggers to be created that respond to manually created events.
+            self.publish_events([saved], update=True)
         ss.schedule_events(saved)
 
 
@@ -1723,51 +1928,36 @@ class ClockConfigViewSet(viewsets.ModelViewSet):
     queryset = dcm.ClockConfig.objects.all()
     serializer_class = dcs.ClockConfigSerializer
 
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context["clock_times"] = dcm.get_current_clock_times()
+        return context
+
     def perform_create(self, serializer):
-        saved = serializer.save()
+        with transaction.atomic():
+            saved = serializer.save()
+
+            data = {
+                "id": saved.id,
+                "name": saved.name,
+                "timezone": saved.timezone,
+                "update": False,
+            }
 
-        try:
-            clock_config_producer = pulsar_client.create_producer(
-                "public/default/_clock_config_log"
-            )
-        except Exception:  # Pulsar doesn't provide a subtype of Exception
-            # abort the pulsar message if pulsar is not available
-            return
-        data = {
-            "id": saved.id,
-            "name": saved.name,
-            "timezone": saved.timezone,
-            "update": False,
-        }
-
-        clock_config_producer.send_async(
-            json.dumps(data).encode("utf-8"),
-            None,
-        )
-        clock_config_producer.close()
+            dcm.enqueue_messages("public/default/_clock_config_log", [data])
 
     def perform_update(self, serializer):
-        saved = serializer.save()
+        with transaction.atomic():
+            saved = serializer.save()
+
+            data = {
+                "id": saved.id,
+                "name": saved.name,
+                "timezone": saved.timezone,
+                "update": True,
+            }
 
-        try:
-            clock_config_producer = pulsar_client.create_producer(
-                "public/default/_clock_config_log"
-            )
-        except Exception:  # Pulsar doesn't provide a subtype of Exception
-            # abort the pulsar message if pulsar is not available
-            return
-        data = {
-            "id": saved.id,
-            "name": saved.name,
-            "timezone": saved.timezone,
-            "update": True,
-        }
-
-        clock_config_producer.send_async(
-            json.dumps(data).encode("utf-8"),
-            None,
-        )
-        clock_config_producer.close()
+            dcm.enqueue_messages("public/default/_clock_config_log", [data])
 
 
 class ClockPhaseViewSet(viewsets.ModelViewSet):
@@ -1779,47 +1969,24 @@ class ClockPhaseViewSet(viewsets.ModelViewSet):
     queryset = dcm.ClockPhase.objects.all()
     serializer_class = dcs.ClockPhaseSerializer
 
-    def perform_create(self, serializer):
-        saved = serializer.save()
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context["clock_times"] = dcm.get_current_clock_times()
+        return context
 
-        try:
-            clock_phase_producer = pulsar_client.create_producer(
-                "public/default/_clock_phase_log"
-            )
-        except Exception:  # Pulsar doesn't provide a subtype of Exception
-            # abort the pulsar message if pulsar is not available
-            return
-        data = {
-            "id": saved.id,
-            "update": False,
-        }
-
-        clock_phase_producer.send_async(
-            json.dumps(data).encode("utf-8"),
-            None,
-        )
-        clock_phase_producer.close()
+    # clock_phase_published queues the _clock_phase_log message from the model signals,
+    # so the phase and its outbox message are written in one transaction
+    def perform_create(self, serializer):
+        with transaction.atomic():
+            serializer.save()
 
     def perform_update(self, serializer):
-        saved = serializer.save()
-
-        try:
-            clock_phase_producer = pulsar_client.create_producer(
-                "public/default/_clock_phase_log"
-            )
-        except Exception:  # Pulsar doesn't provide a subtype of Exception
-            # abort the pulsar message if pulsar is not available
-            return
-        data = {
-            "id": saved.id,
-            "update": True,
-        }
+        with transaction.atomic():
+            serializer.save()
 
-        clock_phase_producer.send_async(
-            json.dumps(data).encode("utf-8"),
-            None,
-        )
-        clock_phase_producer.close()
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            instance.delete()
 
 
 class RegionFilter(filters.FilterSet):
@@ -1909,14 +2076,101 @@ class RegionViewSet(viewsets.ModelViewSet):
 
     * e.g. `/api/regions?nearest_key_point_to=10,30 # latitude, longitude`
 
+    `/api/regions/{name}/occupants` lists the entities inside a region, now or as of a `timestamp`.
+
+    * e.g. `/api/regions/SectorA/occupants?timestamp=2022-03-01T14:03:22Z&interpolate=true`
+
     """
 
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
-    queryset = dcm.Region.objects.all()
+    queryset = dcm.Region.objects.prefetch_related(
+        Prefetch(
+            "visits",
+            queryset=dcm.RegionVisit.objects.filter(exited__isnull=True).select_related(
+                "entity"
+            ),
+            to_attr="current_visits",
+        )
+    )
     filterset_class = RegionFilter
     serializer_class = dcs.RegionSerializer
     schema = schemas.RegionSchema()
 
+    @action(detail=True)
+    def occupants(self, request, pk=None):
+        """
+        This endpoint provides the entities inside the region, grouped by entity type.
+
+        Without querystrings these are the current occupants. The `timestamp` querystring
+        uses each entity's pose as of that time instead, optionally limited to a `trial`,
+        and `interpolate=true` places entities between their bracketing poses.
+
+            regions/{region}/occupants?timestamp=2022-03-01T14:03:22Z
+            regions/{region}/occupants?timestamp=2022-03-01T14:03:22Z&interpolate=true
+        """
+        region = self.get_object()
+        as_of = as_of_params(self.request.query_params)
+        if as_of.get("timestamp") is None and as_of.get("trial_id") is None:
+            occupants = dcs.RegionSerializer(region).get_entities(region)
+            return Response(
+                {entity_type: sorted(names) for entity_type, names in occupants.items()}
+            )
+
+        entity_names = dcm.entities_in_region(region, **as_of)
+        to_return = {}
+        for entity_name, entity_type in (
+            dcm.Entity.objects.filter(name__in=entity_names)
+            .order_by("name")
+            .values_list("name", "entity_type")
+        ):
+            to_return.setdefault(entity_type, []).append(entity_name)
+        return Response(to_return)
+
+
+class RegionVisitFilter(filters.FilterSet):
+    region = filters.ModelMultipleChoiceFilter(
+        field_name="region", queryset=dcm.Region.objects.all()
+    )
+    entity = filters.ModelMultipleChoiceFilter(
+        field_name="entity", queryset=dcm.Entity.objects.all()
+    )
+    trial = filters.ModelChoiceFilter(
+        field_name="trial",
+        queryset=dcm.Trial.objects.all(),
+        null_label="No trial",
+    )
+    current = filters.BooleanFilter(field_name="exited", lookup_expr="isnull")
+    min_datetime = filters.IsoDateTimeFilter(method="overlap_filter")
+    max_datetime = filters.IsoDateTimeFilter(method="overlap_filter")
+
+    class Meta:
+        model = dcm.RegionVisit
+        fields = ["region", "entity", "trial", "current", "min_datetime", "max_datetime"]
+
+    def overlap_filter(self, queryset, name, value):
+        if name == "min_datetime":
+            return queryset.filter(Q(exited__isnull=True) | Q(exited__gte=value))
+        return queryset.filter(entered__lte=value)
+
+
+class RegionVisitViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    This endpoint represents region occupancy: each entry is one stay of an entity inside
+    a region during a trial, opened and closed as the entity's poses arrive.  Entries with
+    no `exited` time are the region's current occupants.
+
+    Filter by `region`, `entity` (both repeatable), `trial` and `current`, or by
+    `min_datetime` / `max_datetime` to get the visits overlapping a time window.
+
+    * e.g. `/api/region_visits/?trial=3&region=landing_zone`
+    """
+
+    permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
+    queryset = dcm.RegionVisit.objects.all()
+    filterset_class = RegionVisitFilter
+    pagination_class = RegionVisitPagination
+    serializer_class = dcs.RegionVisitSerializer
+
 
 class MetadataKeyViewSet(viewsets.ModelViewSet):
     """
@@ -0,0 +1,8 @@
+# Gunicorn settings used by build/init.sh.  Command line flags there take precedence.
+
+
+def worker_exit(server, worker):
+    # Flush queued Pulsar messages before the worker goes away
+    from data_collection.producers import producers
+
+    producers.close()
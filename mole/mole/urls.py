@@ -80,6 +80,7 @@ router.register(r"triggers", views.TriggerViewSet)
 router.register(r"condition_variables", views.ConditionVariableViewSet)
 router.register(r"requested_data", views.RequestedDataViewSet)
 router.register(r"regions", views.RegionViewSet)
+router.register(r"region_visits", views.RegionVisitViewSet)
 router.register(r"region_types", views.RegionTypeViewSet)
 router.register(r"metadata_keys", views.MetadataKeyViewSet)
 router.register(r"metadata_values", views.MetadataValueViewSet)
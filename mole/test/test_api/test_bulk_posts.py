@@ -1,10 +1,12 @@
 import datetime
 
-from rest_framework.test import APITestCase
+from rest_framework.exceptions import ValidationError
+from rest_framework.test import APITestCase, APIRequestFactory
 from rest_framework import status
 from django.urls import reverse
 
 from data_collection.factories import factories
+from data_collection import serializers as dcs
 
 
 class BulkPostTests(APITestCase):
@@ -122,3 +124,40 @@ class BulkPostTests(APITestCase):
         url = reverse("event-list")
         response = self.client.post(url, data, format="json")
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_bulk_events_entity_roles(self):
+        """
+        Ensure entities in bulk posted event metadata are related like single posts.
+        """
+        factories.EntityEventRoleFactory(
+            name="bulk_role", metadata_key=factories.MetadataKeyFactory(name="bulk_key")
+        )
+        response = self.client.get(reverse("eventtype-list"))
+        event_type_url = response.data[0]["url"]
+        lst = [
+            {"event_type": event_type_url, "metadata": {"bulk_key": "test_entity"}},
+            {"event_type": event_type_url, "metadata": {"bulk_key": "missing_entity"}},
+        ]
+        url = reverse("event-list")
+        response = self.client.post(url, lst, format="json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        related = response.data[0]["related_entities"]["bulk_role"]["entities"]
+        self.assertEqual([x["name"] for x in related], ["test_entity"])
+        self.assertEqual(response.data[1]["unfound_entities"], ["missing_entity"])
+
+    def test_unknown_trigger_key(self):
+        """
+        Ensure an unknown trigger key is rejected the same way by single and bulk creates.
+        """
+        request = APIRequestFactory().post(reverse("event-list"))
+        event_type_url = self.client.get(reverse("eventtype-list")).data[0]["url"]
+        data = {"event_type": event_type_url}
+
+        for many, payload in ((False, data), (True, [data, data])):
+            serializer = dcs.EventSerializer(
+                data=payload, many=many, context={"request": request}
+            )
+            self.assertTrue(serializer.is_valid(), serializer.errors)
+            with self.assertRaises(ValidationError):
+                serializer.save(trigger_key="missing_trigger")
@@ -0,0 +1,90 @@
+import datetime
+
+from rest_framework import serializers
+from rest_framework.test import APITestCase
+from django.db import connection
+from django.test import tag
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from data_collection.factories import factories
+from data_collection import models as dcm
+
+
+class ClockStateTests(APITestCase):
+    def setUp(self):
+        self.event_type = factories.EventTypeFactory(name="clock_anchor_type")
+        self.phase = factories.ClockPhaseFactory(
+            message="clock anchored phase",
+            countdown=False,
+            duration_seconds=600,
+            starts_with_event_type=self.event_type,
+        )
+        clock_config = factories.ClockConfigFactory(
+            name="clock_state_config", phases=[self.phase]
+        )
+        self.trial = factories.TrialFactory(
+            id_major=1,
+            id_minor=0,
+            id_micro=0,
+            current=True,
+            clock_config=clock_config,
+        )
+        self.url = reverse("trial-clock-state", args=[self.trial.id])
+
+    @tag("fast")
+    def test_clock_state_is_read_only(self):
+        """
+        Ensure clock state resolves phase times without writing to the database, and the
+        clock phase list shows the current trial's resolved times.
+        """
+        event = factories.EventFactory(
+            trial=self.trial,
+            event_type=self.event_type,
+            start_datetime=timezone.now() - datetime.timedelta(minutes=1),
+        )
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        assert response.data["message"] == "clock anchored phase"
+        writes = [
+            query["sql"]
+            for query in queries.captured_queries
+            if query["sql"].lstrip().upper().startswith(("INSERT", "UPDATE", "DELETE"))
+        ]
+        assert writes == []
+
+        self.phase.refresh_from_db()
+        assert self.phase.starts_with_datetime is None
+
+        response = self.client.get(reverse("clockphase-detail", args=[self.phase.id]))
+        field = serializers.DateTimeField()
+        assert response.data["starts_with_datetime"] == field.to_representation(
+            event.start_datetime
+        )
+        assert response.data["ends_with_datetime"] == field.to_representation(
+            event.start_datetime + datetime.timedelta(seconds=600)
+        )
+
+    @tag("fast")
+    def test_anchor_event_invalidates_timeline(self):
+        """
+        Ensure a new anchor event is reflected in the cached clock state.
+        """
+        response = self.client.get(self.url)
+        assert "message" not in response.data
+
+        event = factories.EventFactory(
+            trial=self.trial,
+            event_type=self.event_type,
+            start_datetime=timezone.now() - datetime.timedelta(minutes=1),
+        )
+        response = self.client.get(self.url)
+        assert response.data["message"] == "clock anchored phase"
+        assert response.data["base_time"] == str(event.start_datetime)
+
+        event.delete()
+        response = self.client.get(self.url)
+        assert "message" not in response.data
+        assert dcm.get_clock_phase(self.trial) == (None, None)
@@ -0,0 +1,56 @@
+from rest_framework.test import APITestCase
+from django.urls import reverse
+from django.test import tag
+
+from data_collection.factories import factories
+from data_collection import models as dcm
+from data_collection import serializers as dcs
+
+
+class CSVExportTests(APITestCase):
+    def setUp(self):
+        factories.UserFactory(username="test_user", password="test_pass")
+        factories.TrialFactory(id_major=1, id_minor=0, id_micro=0, current=True)
+        pose_source = factories.PoseSourceFactory(name="csv_pose_source")
+        entity = factories.EntityFactory(name="csv_entity")
+        for x in range(5):
+            factories.PoseFactory(
+                entity=entity, pose_source=pose_source, point="POINT({} {})".format(x, x)
+            )
+        self.client.login(username="test_user", password="test_pass")
+
+    @tag("fast")
+    def test_pose_csv_is_streamed(self):
+        """
+        Ensure the pose CSV export streams a header and one line per pose.
+        """
+        response = self.client.get(reverse("pose-list"), {"format": "csv"})
+        assert response.status_code == 200
+        assert response.streaming
+
+        lines = b"".join(response.streaming_content).decode("utf-8").splitlines()
+        assert lines[0].split(",")[0] == "id"
+        assert len(lines) == 6
+
+    @tag("fast")
+    def test_event_export_rows_match_serializer(self):
+        """
+        Ensure values() based event export rows match EventDataSerializer output.
+        """
+        entity = factories.EntityFactory(
+            name="csv_related_entity",
+            entity_type=factories.EntityTypeFactory(name="csv_entity_type"),
+        )
+        event = factories.EventFactory(trigger=factories.TriggerFactory(key="csv_trigger"))
+        dcm.EntityEventRelation.objects.create(
+            entity_event_role=factories.EntityEventRoleFactory(name="csv_role"),
+            event=event,
+            entity=entity,
+        )
+
+        expected = dict(dcs.EventDataSerializer(event).data)
+        expected["segment"] = str(expected["segment"])
+        rows = list(
+            dcs.EventDataSerializer.export_rows(dcm.Event.objects.filter(id=event.id))
+        )
+        assert rows == [expected]
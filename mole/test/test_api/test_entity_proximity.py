@@ -4,6 +4,7 @@ from rest_framework.test import APITestCase
 from rest_framework import status
 from django.urls import reverse
 from django.test import tag
+from django.utils import timezone
 
 from data_collection.factories import factories
 
@@ -105,3 +106,41 @@ class ProximalEntitiesTests(APITestCase):
         assert (
             len(response.data) == 0
         ), f"{url} filtered by group should return 0 entities"
+
+    @tag("fast")
+    def test_proximity_endpoint(self):
+        """
+        Ensure proximity returns each close pair once, now and as of an earlier time.
+        """
+        proximity_type = factories.EntityTypeFactory(name="proximity_type")
+        near = factories.EntityFactory(entity_type=proximity_type, name="near_entity")
+        far = factories.EntityFactory(entity_type=proximity_type, name="far_entity")
+        target = factories.EntityFactory(entity_type=proximity_type, name="target_entity")
+        now = timezone.now()
+        earlier = now - datetime.timedelta(minutes=1)
+        # far_entity was next to target_entity a minute ago
+        for entity, point, timestamp in (
+            (target, "POINT(-117.25 32.70)", earlier),
+            (near, "POINT(-117.25001 32.70)", now),
+            (far, "POINT(-117.25001 32.70)", earlier),
+            (far, "POINT(-117.20 32.70)", now),
+        ):
+            factories.PoseFactory(entity=entity, point=point, timestamp=timestamp)
+
+        url = reverse("entity-proximity")
+        response = self.client.get(url, {"distance": 5, "entity_type": "proximity_type"})
+        assert [pair[:2] for pair in response.data] == [("near_entity", "target_entity")]
+        assert 0.9 < response.data[0][2] < 1.0
+
+        response = self.client.get(
+            url,
+            {
+                "distance": 5,
+                "entity_type": "proximity_type",
+                "timestamp": (earlier + datetime.timedelta(seconds=1)).isoformat(),
+            },
+        )
+        assert [pair[:2] for pair in response.data] == [("far_entity", "target_entity")]
+
+        response = self.client.get(url, {"distance": "far"})
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
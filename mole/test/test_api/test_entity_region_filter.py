@@ -0,0 +1,53 @@
+import datetime
+
+from rest_framework.test import APITestCase
+from django.urls import reverse
+from django.test import tag
+from django.utils import timezone
+
+from data_collection.factories import factories
+
+
+class EntityRegionFilterTests(APITestCase):
+    def setUp(self):
+        factories.UserFactory(username="test_user", password="test_pass")
+        self.pose_source = factories.PoseSourceFactory(name="region_filter_source")
+        self.entity = factories.EntityFactory(name="latest_entity")
+        self.client.login(username="test_user", password="test_pass")
+
+    @tag("fast")
+    def test_region_filter_uses_latest_pose(self):
+        """
+        Ensure the entity region filter matches on latest pose across multiple regions.
+        """
+        factories.RegionFactory(
+            name="west_region", geom="POLYGON((0 0, 0 5, 5 5, 5 0, 0 0))", z_layer=1
+        )
+        factories.RegionFactory(
+            name="east_region", geom="POLYGON((10 0, 10 5, 15 5, 15 0, 10 0))", z_layer=2
+        )
+        other = factories.EntityFactory(name="other_entity")
+        now = timezone.now()
+        # latest_entity moved out of the west region into the east region
+        for entity, point, offset in (
+            (self.entity, "POINT(1 1)", 10),
+            (self.entity, "POINT(11 1)", 0),
+            (other, "POINT(2 2)", 0),
+        ):
+            factories.PoseFactory(
+                entity=entity,
+                pose_source=self.pose_source,
+                point=point,
+                timestamp=now - datetime.timedelta(seconds=offset),
+            )
+
+        url = reverse("entity-list")
+        response = self.client.get(url, {"region": "west_region"})
+        assert [x["name"] for x in response.data["results"]] == ["other_entity"]
+
+        response = self.client.get(url + "?region=west_region&region=east_region")
+        names = [x["name"] for x in response.data["results"]]
+        assert names == ["latest_entity", "other_entity"]
+
+        response = self.client.get(url, {"region_z_layer": 2})
+        assert [x["name"] for x in response.data["results"]] == ["latest_entity"]
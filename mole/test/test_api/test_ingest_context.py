@@ -0,0 +1,34 @@
+from rest_framework.test import APITestCase
+from django.test import tag
+
+from data_collection.factories import factories
+from data_collection import models as dcm
+
+
+class IngestContextTests(APITestCase):
+    @tag("fast")
+    def test_current_trial_follows_trial_changes(self):
+        """
+        Ensure the cached current trial is dropped when another trial is made current.
+        """
+        first = factories.TrialFactory(id_major=1, id_minor=0, id_micro=0, current=True)
+        assert dcm.ingest_context.current_trial().id == first.id
+
+        second = factories.TrialFactory(id_major=2, id_minor=0, id_micro=0, current=True)
+        assert dcm.ingest_context.current_trial().id == second.id
+
+    @tag("fast")
+    def test_lookups_return_separate_instances(self):
+        """
+        Ensure cached lookups hand each caller its own instance, and only refresh() reads
+        the shared version.
+        """
+        factories.TrialFactory(id_major=1, id_minor=0, id_micro=0, current=True)
+        dcm.ingest_context.refresh()
+        first = dcm.ingest_context.current_trial()
+        first.note = "changed by one request"
+        with self.assertNumQueries(0):
+            second = dcm.ingest_context.current_trial()
+        assert second is not first
+        assert second.id == first.id
+        assert second.note != first.note
@@ -0,0 +1,65 @@
+import datetime
+
+from rest_framework.test import APITestCase
+from rest_framework import status
+from django.urls import reverse
+from django.test import tag
+from django.utils import timezone
+
+from data_collection.factories import factories
+from data_collection import models as dcm
+
+
+class LatestPoseTests(APITestCase):
+    def setUp(self):
+        factories.UserFactory(username="test_user", password="test_pass")
+        factories.TrialFactory(id_major=1, id_minor=0, id_micro=0, current=True)
+        self.pose_source = factories.PoseSourceFactory(name="latest_pose_source")
+        self.entity = factories.EntityFactory(name="latest_entity")
+        self.client.login(username="test_user", password="test_pass")
+
+    @tag("fast")
+    def test_out_of_order_pose_does_not_replace_latest(self):
+        """
+        Ensure the latest pose store only moves forward in time.
+        """
+        now = timezone.now()
+        newer = factories.PoseFactory(
+            entity=self.entity,
+            pose_source=self.pose_source,
+            point="POINT(10 10)",
+            timestamp=now,
+        )
+        factories.PoseFactory(
+            entity=self.entity,
+            pose_source=self.pose_source,
+            point="POINT(20 20)",
+            timestamp=now - datetime.timedelta(minutes=5),
+        )
+
+        latest = dcm.LatestPose.objects.get(entity=self.entity)
+        assert latest.pose_id == newer.id
+
+    @tag("fast")
+    def test_bulk_poses_update_latest_pose(self):
+        """
+        Ensure bulk posted poses are reflected in the entity's latest_pose.
+        """
+        now = timezone.now()
+        pose_source_url = reverse("posesource-detail", args=[self.pose_source.id])
+        entity_url = reverse("entity-detail", args=[self.entity.name])
+        data = [
+            {
+                "lat": x,
+                "lon": x,
+                "entity": entity_url,
+                "pose_source": pose_source_url,
+                "timestamp": (now + datetime.timedelta(seconds=x)).isoformat(),
+            }
+            for x in range(5)
+        ]
+        response = self.client.post(reverse("pose-list"), data, format="json")
+        assert response.status_code == status.HTTP_201_CREATED
+
+        response = self.client.get(reverse("entity-detail", args=[self.entity.name]))
+        assert response.data["latest_pose"]["point"]["coordinates"] == [4.0, 4.0]
@@ -0,0 +1,69 @@
+from unittest.mock import MagicMock, patch
+
+import pulsar
+from rest_framework.test import APITestCase
+from rest_framework import status
+from django.urls import reverse
+from django.test import tag
+
+from data_collection.factories import factories
+from data_collection import models as dcm
+from data_collection.management.commands.relay_outbox import Command
+
+
+class OutboxTests(APITestCase):
+    def setUp(self):
+        factories.UserFactory(username="test_user", password="test_pass")
+        factories.TrialFactory(id_major=1, id_minor=0, id_micro=0, current=True)
+        self.event_type = factories.EventTypeFactory(name="outbox_event_type")
+        self.client.login(username="test_user", password="test_pass")
+
+    @tag("fast")
+    def test_event_create_queues_event_log_message(self):
+        """
+        Ensure creating an event queues its _event_log message in the outbox.
+        """
+        event_type_url = reverse("eventtype-detail", args=[self.event_type.id])
+        response = self.client.post(
+            reverse("event-list"), {"event_type": event_type_url}, format="json"
+        )
+        assert response.status_code == status.HTTP_201_CREATED
+
+        message = dcm.OutboxMessage.objects.get(topic="public/default/_event_log")
+        assert message.payload["id"] == response.data["id"]
+        assert message.payload["update"] is False
+
+    @tag("fast")
+    def test_relay_keeps_topic_order_and_dead_letters(self):
+        """
+        Ensure a message delivered after an earlier failure on its topic is kept, and a
+        message failing max_attempts times is dead lettered.
+        """
+        dcm.OutboxMessage.objects.all().delete()
+        first, second = dcm.enqueue_messages("public/default/relay_test", [{"n": 1}, {"n": 2}])
+        other = dcm.enqueue_messages("public/default/relay_other", [{"n": 3}])[0]
+
+        def send_async(content, callback):
+            # the first message fails, every other one is delivered
+            failed = b'"n": 1' in content
+            callback(pulsar.Result.Timeout if failed else pulsar.Result.Ok, None)
+
+        producer = MagicMock()
+        producer.send_async.side_effect = send_async
+        with patch(
+            "data_collection.management.commands.relay_outbox.producers"
+        ) as producers:
+            producers.get.return_value = producer
+            assert Command().relay_batch(10, 2) == (1, 2)
+            assert not dcm.OutboxMessage.objects.filter(id=other.id).exists()
+            second = dcm.OutboxMessage.objects.get(id=second.id)
+            assert second.attempts == 0
+
+            assert Command().relay_batch(10, 2) == (0, 2)
+            first = dcm.OutboxMessage.objects.get(id=first.id)
+            assert first.attempts == 2
+            assert first.dead_lettered_datetime is not None
+
+            # the dead letter no longer holds up its topic
+            assert Command().relay_batch(10, 2) == (1, 0)
+            assert list(dcm.OutboxMessage.objects.all()) == [first]
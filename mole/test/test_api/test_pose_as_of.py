@@ -0,0 +1,79 @@
+import datetime
+
+from rest_framework.test import APITestCase
+from django.urls import reverse
+from django.test import tag
+from django.utils import timezone
+
+from data_collection.factories import factories
+
+
+class PoseAsOfTests(APITestCase):
+    def setUp(self):
+        factories.UserFactory(username="test_user", password="test_pass")
+        self.trial = factories.TrialFactory(
+            id_major=1, id_minor=0, id_micro=0, current=True
+        )
+        self.pose_source = factories.PoseSourceFactory(name="as_of_pose_source")
+        entity_type = factories.EntityTypeFactory(name="as_of_type")
+        self.entity = factories.EntityFactory(entity_type=entity_type, name="latest_entity")
+        self.other = factories.EntityFactory(entity_type=entity_type, name="other_entity")
+        self.start = timezone.now() - datetime.timedelta(minutes=1)
+        for entity, point, seconds in (
+            (self.entity, "POINT(0 0)", 0),
+            (self.entity, "POINT(10 0)", 10),
+            (self.other, "POINT(4 0)", 0),
+        ):
+            factories.PoseFactory(
+                entity=entity,
+                pose_source=self.pose_source,
+                point=point,
+                trial=self.trial,
+                timestamp=self.start + datetime.timedelta(seconds=seconds),
+            )
+        self.at = (self.start + datetime.timedelta(seconds=4)).isoformat()
+        self.client.login(username="test_user", password="test_pass")
+
+    @tag("fast")
+    def test_positions_as_of(self):
+        """
+        Ensure as-of queries use the last pose at or before the time, or interpolate.
+        """
+        url = reverse("pose-latest")
+        response = self.client.get(url, {"trial": self.trial.id, "timestamp": self.at})
+        points = {x["entity"]["name"]: x["point"]["coordinates"] for x in response.data}
+        assert points == {"latest_entity": [0.0, 0.0], "other_entity": [4.0, 0.0]}
+
+        response = self.client.get(
+            url, {"trial": self.trial.id, "timestamp": self.at, "interpolate": "true"}
+        )
+        interpolated = response.data[0]
+        assert interpolated["id"] is None
+        assert interpolated["point"]["coordinates"] == [4.0, 0.0]
+
+        url = reverse("entity-around", args=[self.entity.name])
+        response = self.client.get(
+            url, {"distance": 1000, "timestamp": self.at, "interpolate": "true"}
+        )
+        assert [x[0] for x in response.data] == ["other_entity"]
+        response = self.client.get(url, {"distance": 1000, "timestamp": self.at})
+        assert response.data == []
+
+    @tag("fast")
+    def test_region_occupants(self):
+        """
+        Ensure region occupants are sorted name lists, both current and as of a time.
+        """
+        region = factories.RegionFactory(
+            name="as_of_region", geom="POLYGON((-1 -1, -1 1, 5 1, 5 -1, -1 -1))"
+        )
+        url = reverse("region-occupants", args=[region.name])
+
+        response = self.client.get(url)
+        assert response.data == {"as_of_type": ["other_entity"]}
+
+        response = self.client.get(url, {"timestamp": self.at})
+        assert response.data == {"as_of_type": ["latest_entity", "other_entity"]}
+
+        response = self.client.get(url, {"timestamp": self.at, "interpolate": "true"})
+        assert response.data == {"as_of_type": ["latest_entity", "other_entity"]}
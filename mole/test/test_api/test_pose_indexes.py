@@ -0,0 +1,121 @@
+import datetime
+
+from rest_framework.test import APITestCase
+from rest_framework import status
+from django.contrib.gis.geos import Point
+from django.contrib.gis.measure import D
+from django.db import connection
+from django.urls import reverse
+from django.test import tag
+from django.utils import timezone
+
+from data_collection.factories import factories
+from data_collection import models as dcm
+
+
+def plan_with_index_scans(queryset):
+    # Test tables are tiny, so make a sequential scan unattractive to see the index choice
+    with connection.cursor() as cursor:
+        cursor.execute("SET LOCAL enable_seqscan = off")
+    return queryset.explain()
+
+
+class PoseIndexTests(APITestCase):
+    def setUp(self):
+        factories.UserFactory(username="test_user", password="test_pass")
+        self.trial = factories.TrialFactory(
+            id_major=1, id_minor=0, id_micro=0, current=True
+        )
+        self.other_trial = factories.TrialFactory(id_major=2, id_minor=0, id_micro=0)
+        self.pose_source = factories.PoseSourceFactory(name="index_pose_source")
+        self.client.login(username="test_user", password="test_pass")
+
+    @tag("fast")
+    def test_indexes_exist(self):
+        """
+        Ensure the migrations create the pose time-series and latest pose geography indexes.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT indexname FROM pg_indexes WHERE tablename IN (%s, %s)",
+                [dcm.Pose._meta.db_table, dcm.LatestPose._meta.db_table],
+            )
+            names = {row[0] for row in cursor.fetchall()}
+        assert {
+            "pose_entity_ts_idx",
+            "pose_trial_ts_idx",
+            "pose_trial_entity_ts_idx",
+            "pose_ts_idx",
+            "latestpose_point_geog_idx",
+        } <= names
+
+    @tag("fast")
+    def test_latest_poses_for_trial(self):
+        """
+        Ensure poses/latest returns each entity's newest pose in the trial, by index.
+        """
+        now = timezone.now()
+        first = factories.EntityFactory(name="first_entity")
+        second = factories.EntityFactory(name="second_entity")
+        expected = {}
+        for entity, trial, seconds in (
+            (first, self.trial, 0),
+            (first, self.trial, 10),
+            (first, self.other_trial, 20),
+            (second, self.trial, 5),
+        ):
+            pose = factories.PoseFactory(
+                entity=entity,
+                pose_source=self.pose_source,
+                trial=trial,
+                timestamp=now - datetime.timedelta(seconds=60 - seconds),
+            )
+            if trial == self.trial:
+                expected[entity.name] = pose.id
+
+        url = reverse("pose-latest")
+        response = self.client.get(url)
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+        response = self.client.get(url, {"trial": self.trial.id})
+        assert {x["entity"]["name"]: x["id"] for x in response.data} == expected
+
+        queryset = (
+            dcm.Pose.objects.order_by("entity", "-timestamp")
+            .filter(trial=self.trial.id)
+            .distinct("entity")
+        )
+        assert "pose_trial_entity_ts_idx" in plan_with_index_scans(queryset)
+
+    @tag("fast")
+    def test_radius_uses_geography_index(self):
+        """
+        Ensure latest pose distance filters run on geography through its GiST index.
+        """
+        for name, point in (
+            ("origin_entity", "POINT(-117.25 32.70)"),
+            ("near_entity", "POINT(-117.2501 32.70)"),
+            ("far_entity", "POINT(-117.20 32.70)"),
+        ):
+            factories.PoseFactory(
+                entity=factories.EntityFactory(name=name),
+                pose_source=self.pose_source,
+                point=point,
+            )
+
+        response = self.client.get(
+            reverse("entity-radius"),
+            {"longitude": -117.25, "latitude": 32.70, "distance": 20},
+        )
+        assert [x[0] for x in response.data] == ["origin_entity", "near_entity"]
+        assert 9 < response.data[1][1] < 10
+
+        response = self.client.get(
+            reverse("entity-around", args=["origin_entity"]), {"distance": 20}
+        )
+        assert [x[0] for x in response.data] == ["near_entity"]
+
+        queryset = dcm.Entity.objects.annotate(
+            geography=dcm.as_geography("latest_pose_entry__point")
+        ).filter(geography__dwithin=(Point(-117.25, 32.70, srid=4326), D(m=20)))
+        assert "latestpose_point_geog_idx" in plan_with_index_scans(queryset)
@@ -0,0 +1,98 @@
+import datetime
+
+from rest_framework.test import APITestCase
+from django.urls import reverse
+from django.test import tag
+from django.utils import timezone
+
+from data_collection.factories import factories
+from data_collection import models as dcm
+
+
+class RegionOccupancyTests(APITestCase):
+    def setUp(self):
+        factories.UserFactory(username="test_user", password="test_pass")
+        self.trial = factories.TrialFactory(
+            id_major=1, id_minor=0, id_micro=0, current=True
+        )
+        self.pose_source = factories.PoseSourceFactory(name="occupancy_pose_source")
+        self.entity = factories.EntityFactory(name="occupancy_entity")
+        self.region = factories.RegionFactory(
+            name="occupancy_region", geom="POLYGON((0 0, 0 5, 5 5, 5 0, 0 0))"
+        )
+        self.client.login(username="test_user", password="test_pass")
+
+    def add_pose(self, point, seconds):
+        return factories.PoseFactory(
+            entity=self.entity,
+            pose_source=self.pose_source,
+            point=point,
+            trial=self.trial,
+            timestamp=self.start + datetime.timedelta(seconds=seconds),
+        )
+
+    @tag("fast")
+    def test_entry_and_exit_history(self):
+        """
+        Ensure visits open on entry, close at the first pose outside, and reopen on return.
+        """
+        self.start = timezone.now()
+        first = self.add_pose("POINT(1 1)", 0)
+        self.add_pose("POINT(2 2)", 1)
+        left = self.add_pose("POINT(9 9)", 2)
+
+        visit = dcm.RegionVisit.objects.get(entity=self.entity)
+        assert visit.entry_pose_id == first.id
+        assert visit.exit_pose_id == left.id
+        assert visit.exited == left.timestamp
+
+        response = self.client.get(reverse("region-detail", args=[self.region.name]))
+        assert response.data["entities"] == {}
+
+        self.add_pose("POINT(3 3)", 3)
+        response = self.client.get(
+            reverse("regionvisit-list"), {"trial": self.trial.id, "region": self.region.name}
+        )
+        assert len(response.data["results"]) == 2
+        assert response.data["results"][1]["exited"] is None
+
+        response = self.client.get(reverse("region-detail", args=[self.region.name]))
+        assert response.data["entities"] == {
+            self.entity.entity_type_id: {self.entity.name}
+        }
+
+    @tag("fast")
+    def test_rebuild_matches_incremental(self):
+        """
+        Ensure rebuilding visits from the pose table reproduces the incremental history.
+        """
+        self.start = timezone.now()
+        for seconds, point in enumerate(["POINT(1 1)", "POINT(9 9)", "POINT(2 2)"]):
+            self.add_pose(point, seconds)
+
+        fields = ("region", "entity", "trial", "entered", "exited", "entry_pose", "exit_pose")
+        incremental = list(dcm.RegionVisit.objects.values_list(*fields))
+        dcm.rebuild_region_visits()
+        assert list(dcm.RegionVisit.objects.values_list(*fields)) == incremental
+
+    @tag("fast")
+    def test_deleting_latest_pose_updates_visits(self):
+        """
+        Ensure deleting an entity's latest pose falls back to its previous pose and closes
+        visits it no longer supports.
+        """
+        self.start = timezone.now()
+        outside = self.add_pose("POINT(9 9)", 0)
+        inside = self.add_pose("POINT(1 1)", 1)
+        assert dcm.RegionVisit.objects.get(entity=self.entity).exited is None
+
+        with self.captureOnCommitCallbacks(execute=True):
+            inside.delete()
+
+        assert dcm.LatestPose.objects.get(entity=self.entity).pose_id == outside.id
+        visit = dcm.RegionVisit.objects.get(entity=self.entity)
+        assert visit.exited == visit.entered
+
+        with self.captureOnCommitCallbacks(execute=True):
+            outside.delete()
+        assert not dcm.LatestPose.objects.filter(entity=self.entity).exists()
@@ -0,0 +1,143 @@
+import json
+
+from rest_framework.test import APITestCase
+from django.test import tag
+
+from automation.factories import factories as af
+from automation.scenario_scripts.scenario_scripts import ScenarioScripts
+from data_collection.factories import factories
+
+
+class RecordingProducer:
+    def __init__(self):
+        self.sent = []
+
+    def send_async(self, content, callback, deliver_at=None):
+        self.sent.append((json.loads(content), deliver_at))
+
+
+class ScenarioScriptsTests(APITestCase):
+    def setUp(self):
+        self.start_type = factories.EventTypeFactory(name="script_start")
+        self.first_type = factories.EventTypeFactory(name="script_first")
+        self.second_type = factories.EventTypeFactory(name="script_second")
+        self.missing_type = factories.EventTypeFactory(name="script_missing")
+
+        has_start = af.ScriptConditionFactory(trial_has_event=self.start_type)
+        missing = af.ScriptConditionFactory(trial_missing_event=self.missing_type)
+        second = af.ScriptedEventFactory(
+            name="second", event_type=self.second_type, delay_seconds=5, conditions=[missing]
+        )
+        first = af.ScriptedEventFactory(
+            name="first",
+            event_type=self.first_type,
+            next_scripted_event=second,
+            add_event_metadata={"scripted": True},
+            copy_trigger_metadata=True,
+            conditions=[has_start],
+        )
+        self.script = af.ScriptFactory(
+            name="repeating_script",
+            initiating_event_types=[self.start_type],
+            scripted_event_head=first,
+            auto_repeat_count=200,
+            run_limit=5,
+        )
+        scenario = factories.ScenarioFactory(name="script_scenario", scripts=[self.script])
+        self.trial = factories.TrialFactory(
+            id_major=1, id_minor=0, id_micro=0, scenario=scenario
+        )
+        self.event = factories.EventFactory(
+            trial=self.trial,
+            event_type=self.start_type,
+            start_pose=None,
+            metadata={"source": "test"},
+        )
+
+    @tag("fast")
+    def test_repeats_scheduled_without_recursion_or_per_node_queries(self):
+        """
+        Ensure a long repeating script is scheduled from the compiled plan with two
+        condition queries and one run count update.
+        """
+        scenario_scripts = ScenarioScripts()
+        producer = RecordingProducer()
+        plan = scenario_scripts.get_plan(self.trial.scenario_id)
+        run_counts = scenario_scripts.get_run_counts(self.trial.id, plan)
+
+        with self.assertNumQueries(3):
+            scenario_scripts.schedule_trial_events(
+                producer, plan, self.trial.id, [self.event], run_counts
+            )
+
+        assert len(producer.sent) == 201 * 2
+        first, first_delay = producer.sent[0]
+        assert first == {
+            "trial": f"/api/trials/{self.trial.id}/",
+            "event_type": "script_first",
+            "metadata": {"scripted": True, "source": "test"},
+        }
+        assert first_delay is None
+        # delays accumulate across the chain and its repeats
+        last, last_delay = producer.sent[-1]
+        assert last["event_type"] == "script_second"
+        assert last_delay == last["deliver_at"]
+        start = int(self.event.modified_datetime.timestamp() + 5) * 1000
+        assert producer.sent[1][1] == start
+        assert last_delay == int(self.event.modified_datetime.timestamp() + 201 * 5) * 1000
+
+        assert self.script.script_run_count.get(trial=self.trial).count == 201
+
+    @tag("fast")
+    def test_run_limit_and_cache_invalidation(self):
+        """
+        Ensure a script at its run limit is skipped and edits recompile the plan.
+        """
+        scenario_scripts = ScenarioScripts()
+        plan = scenario_scripts.get_plan(self.trial.scenario_id)
+        assert scenario_scripts.get_plan(self.trial.scenario_id) is plan
+
+        run_counts = scenario_scripts.get_run_counts(self.trial.id, plan)
+        run_counts[self.script.id].count = 5
+        producer = RecordingProducer()
+        scenario_scripts.schedule_trial_events(
+            producer, plan, self.trial.id, [self.event], run_counts
+        )
+        assert producer.sent == []
+
+        self.script.auto_repeat_count = 0
+        self.script.save()
+        plan = scenario_scripts.get_plan(self.trial.scenario_id)
+        assert plan.scripts[0].auto_repeat_count == 0
+
+    @tag("fast")
+    def test_batch_conditions_only_see_earlier_events(self):
+        """
+        Ensure an event in a batch is scheduled as if the events after it in the batch
+        did not exist yet.
+        """
+        missing_event = factories.EventFactory(
+            trial=self.trial, event_type=self.missing_type, start_pose=None, metadata={}
+        )
+        scenario_scripts = ScenarioScripts()
+        producer = RecordingProducer()
+        plan = scenario_scripts.get_plan(self.trial.scenario_id)
+        run_counts = scenario_scripts.get_run_counts(self.trial.id, plan)
+
+        scenario_scripts.schedule_trial_events(
+            producer, plan, self.trial.id, [self.event, missing_event], run_counts
+        )
+
+        # the missing event type is only posted after the initiating event
+        sent_types = [x["event_type"] for x, _ in producer.sent]
+        assert sent_types.count("script_second") == 201
+
+        producer = RecordingProducer()
+        run_counts = scenario_scripts.get_run_counts(self.trial.id, plan)
+        run_counts[self.script.id].count = 0
+        scenario_scripts.schedule_trial_events(
+            producer, plan, self.trial.id, [missing_event, self.event], run_counts
+        )
+        sent_types = [x["event_type"] for x, _ in producer.sent]
+        assert sent_types.count("script_second") == 0
+        assert sent_types.count("script_first") == 201
@@ -0,0 +1,80 @@
+import datetime
+
+from rest_framework.test import APITestCase
+from django.urls import reverse
+from django.test import tag
+from django.utils import timezone
+
+from data_collection.factories import factories
+
+
+class TrajectoryMetricsTests(APITestCase):
+    def setUp(self):
+        factories.UserFactory(username="test_user", password="test_pass")
+        self.trial = factories.TrialFactory(
+            id_major=1, id_minor=0, id_micro=0, current=True
+        )
+        self.pose_source = factories.PoseSourceFactory(name="trajectory_pose_source")
+        self.entity = factories.EntityFactory(name="trajectory_entity")
+        self.client.login(username="test_user", password="test_pass")
+
+        # 0.001 degrees at the equator is about 111 m: east, north, then wait
+        self.start = timezone.now() - datetime.timedelta(minutes=5)
+        for seconds, point in (
+            (0, "POINT(0 0)"),
+            (10, "POINT(0.001 0)"),
+            (20, "POINT(0.001 0.001)"),
+            (30, "POINT(0.001 0.001)"),
+        ):
+            factories.PoseFactory(
+                entity=self.entity,
+                pose_source=self.pose_source,
+                point=point,
+                trial=self.trial,
+                timestamp=self.start + datetime.timedelta(seconds=seconds),
+            )
+
+    @tag("fast")
+    def test_trial_metrics(self):
+        """
+        Ensure path length, speed, dwell time and heading change are computed per entity.
+        """
+        url = reverse("trial-trajectory-metrics", args=[self.trial.id])
+        response = self.client.get(url)
+        metrics = response.data[0]
+        assert metrics["entity"] == "trajectory_entity"
+        assert metrics["pose_count"] == 4
+        assert metrics["duration"] == 30
+        assert round(metrics["path_length"]) == 222
+        assert round(metrics["max_speed"], 1) == 11.1
+        assert metrics["dwell_time"] == 10
+        assert round(metrics["heading_change"]) == 90
+
+        response = self.client.get(
+            url, {"max_datetime": (self.start + datetime.timedelta(seconds=10)).isoformat()}
+        )
+        assert round(response.data[0]["path_length"]) == 111
+        assert response.data[0]["heading_change"] == 0
+
+    @tag("fast")
+    def test_event_metrics(self):
+        """
+        Ensure per event metrics cover the event's duration for its related entities.
+        """
+        event = factories.EventFactory(
+            trial=self.trial,
+            start_pose=None,
+            start_datetime=self.start + datetime.timedelta(seconds=10),
+            end_datetime=self.start + datetime.timedelta(seconds=20),
+        )
+        role = factories.EntityEventRoleFactory(name="trajectory_role")
+        factories.EntityEventRelationFactory(
+            event=event, entity=self.entity, entity_event_role=role
+        )
+
+        url = reverse("trial-trajectory-metrics", args=[self.trial.id])
+        response = self.client.get(url, {"events": "true"})
+        entry = next(x for x in response.data if x["event"] == event.id)
+        metrics = entry["entities"]["trajectory_entity"]
+        assert round(metrics["path_length"]) == 111
+        assert metrics["duration"] == 10
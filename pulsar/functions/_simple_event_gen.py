@@ -1,5 +1,4 @@
 #!/usr/bin/env python3
-import urllib.parse
 import re
 import json
 import datetime
@@ -11,80 +10,216 @@ import redis
 import requests
 from asteval import Interpreter
 
-# This function should not be modified
+DJANGO_API = "http://django:8000/api"
+
+# Django queues a message here whenever a trigger, condition variable or requested data
+# changes, the evaluator reloads its compiled triggers on the next message
+TRIGGER_LOG_TOPIC = "_trigger_log"
+
+# Hash of topic -> most recent cached message, kept by the event generator alongside
+# the event_gen:{topic}:cache streams
+LATEST_MESSAGES_KEY = "event_gen:latest"
+
+COND_VAR_PATTERN = re.compile(r"(?P<var_name>\w+) ?: ?(?P<topic>.+)\.(?P<field>\w+)")
+
+
+class CompiledTrigger:
+    """
+    A trigger definition with its condition variables parsed into (name, topic, field)
+    bindings and its condition parsed once into an asteval AST.  Each trigger keeps its
+    own interpreter so evaluating it only assigns the bound values and runs the AST.
+    """
+
+    def __init__(self, definition):
+        self.definition = definition
+        self.key = definition["key"]
+        self.bindings = []
+        for cv in definition["cond_vars"]:
+            m = COND_VAR_PATTERN.match(cv)
+            if not m:
+                raise ValueError(f"condition variable formatted incorrectly: {cv}")
+            self.bindings.append(
+                (m.group("var_name"), m.group("topic").replace("/", "_"), m.group("field"))
+            )
+        self.topics = set(topic for _, topic, _ in self.bindings)
+        # topics read by "topic.field" requested data values
+        self.requested_topics = set()
+        for r_data in definition["req_data"]:
+            for value in r_data["payload"].values():
+                if value in ("$EVENT$", "$TIME$") or value.startswith("["):
+                    continue
+                fields = value.split(".")
+                if len(fields) == 2:
+                    self.requested_topics.add(fields[0])
+        self.interpreter = Interpreter()
+        self.condition = self.interpreter.parse(definition["condition"] or "")
+
+    def evaluate(self, messages):
+        """
+        Evaluate the condition given the latest message dict of each bound topic.
+        """
+        symtable = self.interpreter.symtable
+        symtable["msg"] = messages
+        for var_name, topic, field in self.bindings:
+            symtable[var_name] = messages[topic][field]
+        self.interpreter.error = []
+        return self.interpreter.run(self.condition, expr=self.definition["condition"])
+
+
+# Created and updated by event_generator/message_cacher.py, which sets its inputs to the
+# trigger topics and _trigger_log.  A message on _trigger_log reloads the triggers.
 class TriggerEvaluator(Function):
     def __init__(self):
         self.r = redis.Redis(host="redis", port=6379, decode_responses=True, db=2)
         self.client = pulsar.Client("pulsar://pulsar_proxy:6650")
+        # topic -> active CompiledTriggers conditioned on it, None until loaded
+        self.triggers_by_topic = None
+
+    def load_triggers(self, logger):
+        """
+        Fetch every trigger once and index the active ones by the topics their
+        condition variables read.  Returns False if the triggers could not be retrieved.
+        """
+        url = f"{DJANGO_API}/triggers/"
+        try:
+            triggers = requests.get(url).json()
+        except (requests.RequestException, ValueError) as e:
+            logger.warn(f"error retrieving triggers: {url} {e}")
+            return False
+        if not isinstance(triggers, list):
+            logger.warn(f"error retrieving triggers: {url}")
+            return False
+
+        triggers_by_topic = {}
+        for trig in triggers:
+            if not trig["is_active"]:
+                continue
+            try:
+                compiled = CompiledTrigger(trig)
+            except Exception as e:  # asteval raises its own errors for bad syntax
+                logger.warn(f"Skipping trigger key: {trig['key']}, {e}")
+                continue
+            for topic in compiled.topics:
+                triggers_by_topic.setdefault(topic, []).append(compiled)
+        self.triggers_by_topic = triggers_by_topic
+        logger.info(f"Loaded triggers for topics: {list(triggers_by_topic)}")
+        return True
+
+    def get_publish_timestamp(self, context):
+        """
+        Publish time (ms since epoch) of the message being processed.  The public Context
+        API has no publish time, so a reader is positioned on the message itself with
+        get_message_id() rather than replaying the topic.  That read is skipped when the
+        context holds the current message, as the Python function runtime's ContextImpl
+        does in its `message` attribute.  That attribute is private.  It was tested
+        against Pulsar 2.9.1 (see pulsar/Dockerfile), and is only used when it has a
+        publish_timestamp().
+        """
+        message = getattr(context, "message", None)
+        publish_timestamp = getattr(message, "publish_timestamp", None)
+        if callable(publish_timestamp):
+            return publish_timestamp()
+
+        reader = self.client.create_reader(
+            context.get_current_message_topic_name(),
+            context.get_message_id(),
+            start_message_id_inclusive=True,
+        )
+        try:
+            return reader.read_next(timeout_millis=5000).publish_timestamp()
+        finally:
+            reader.close()
+
+    def get_cached_messages(self, topics, publish_timestamp):
+        """
+        Latest cached message dict of each topic published at or before
+        publish_timestamp, topics without one are left out.  All topics are read from
+        the latest message hash in one round-trip; only topics whose latest message is
+        newer than publish_timestamp are looked up in their streams, in one pipeline.
+        """
+        topics = list(topics)
+        if not topics:
+            return {}
+
+        messages = {}
+        as_of = []
+        for topic, encoded in zip(topics, self.r.hmget(LATEST_MESSAGES_KEY, topics)):
+            if encoded is None:
+                # the hash is written with every cached message, so there are none
+                continue
+            message = json.loads(encoded)
+            if message["published_datetime_stamp"] <= publish_timestamp:
+                messages[topic] = message
+            else:
+                as_of.append(topic)
+
+        if as_of:
+            pipe = self.r.pipeline(transaction=False)
+            for topic in as_of:
+                pipe.xrevrange(
+                    name=f"event_gen:{topic}:cache", max=publish_timestamp, count=1
+                )
+            for topic, cached_msgs in zip(as_of, pipe.execute()):
+                if cached_msgs:
+                    messages[topic] = json.loads(cached_msgs[0][1]["encoded"])
+        return messages
 
     def process(self, input, context):
         logger = context.get_logger()
         topic = context.get_current_message_topic_name().split("/")[-1]
+        if topic == TRIGGER_LOG_TOPIC:
+            logger.info("Trigger configuration changed, reloading on next message")
+            self.triggers_by_topic = None
+            return
+
+        if self.triggers_by_topic is None and not self.load_triggers(logger):
+            return
+
         my_message_dict = json.loads(input)
         my_message_dict["processed_datetime"] = datetime.datetime.now(
             tz=datetime.timezone.utc
         )
 
-        reader = self.client.create_reader(
-            context.get_current_message_topic_name(), pulsar.MessageId.earliest
-        )
-        msg = reader.read_next(timeout_millis=5000)
-        while msg.message_id() != context.get_message_id():
-            msg = reader.read_next(timeout_millis=5000)
-        publish_timestamp = msg.publish_timestamp()
-        reader.close()
-
         logger.info(f"Message is: {my_message_dict}")
         logger.info(f"Topic is: {topic}")
-        keys_to_check = self.r.smembers(topic)
+        triggers = self.triggers_by_topic.get(topic, [])
         logger.info(
-            f"Trigger keys associated with this topic is: {list(keys_to_check)}"
+            f"Trigger keys associated with this topic is: {[t.key for t in triggers]}"
         )
-        if not keys_to_check:
+        if not triggers:
             logger.info("No keys associated with topic, skipping evaluation")
             return
 
-        params = urllib.parse.urlencode({"key": keys_to_check}, doseq=True)
-        url = f"http://django:8000/api/triggers/?{params}"
-        r = requests.get(url)
-        if not isinstance(r.json(), list):
-            logger.warn(f"error retrieving triggers: {url}")
-            return
+        publish_timestamp = self.get_publish_timestamp(context)
+        messages = self.get_cached_messages(
+            set().union(*(t.topics | t.requested_topics for t in triggers)),
+            publish_timestamp,
+        )
 
-        pattern = re.compile(r"(?P<var_name>\w+) ?: ?(?P<topic>.+)\.(?P<field>\w+)")
-        for trig in r.json():
+        for compiled in triggers:
+            trig = compiled.definition
             logger.info(f"Checking trigger key: {trig['key']}...")
-            trig_interpreter = Interpreter()
-            trig_interpreter.symtable["msg"] = {}
 
             error_msg = ""
-            for cv in trig["cond_vars"]:
-                m = pattern.match(cv)
-                topic = m.group("topic").replace("/", "_")
-                cached_msgs = self.r.xrevrange(
-                    name=f"event_gen:{topic}:cache", max=publish_timestamp, count=1,
-                )
-                if not cached_msgs:
-                    error_msg = f"No cached messages for topic: {topic}"
+            for var_name, cv_topic, field in compiled.bindings:
+                if cv_topic not in messages:
+                    error_msg = f"No cached messages for topic: {cv_topic}"
                     break
-                unencoded_dict = json.loads(cached_msgs[0][1]["encoded"])
-                if m.group("field") not in unencoded_dict:
-                    error_msg = (
-                        f"Message on topic: {topic} missing field: {m.group('field')}"
-                    )
+                if field not in messages[cv_topic]:
+                    error_msg = f"Message on topic: {cv_topic} missing field: {field}"
                     break
-                trig_interpreter.symtable["msg"][topic] = unencoded_dict
             if error_msg:
                 logger.warn(error_msg)
                 logger.info(
                     f"Condition check for trigger key: {trig['key']} has FAILED"
                 )
                 continue
-            for cv in trig["converted_cond_vars"]:
-                trig_interpreter(cv)
 
-            # Evaluate the condition by passing in the string to the interpreter
-            result = trig_interpreter(trig["condition"])
+            try:
+                result = compiled.evaluate(messages)
+            except Exception as e:  # errors raised by the condition itself
+                logger.warn(f"Condition for trigger key: {trig['key']} raised: {e!r}")
+                result = False
             if not result:
                 logger.info(
                     f"Condition check for trigger key: {trig['key']} has FAILED"
@@ -105,8 +240,8 @@ class TriggerEvaluator(Function):
                         "event_gen:event_type_id_map", event_type_name
                     )
                     if not event_type_id:
-                        event_type_url = f"http://django:8000/api/event_types/"
-                        r = requests.get(url)
+                        event_type_url = f"{DJANGO_API}/event_types/"
+                        r = requests.get(event_type_url)
                         if isinstance(r.json(), list):
                             for entry in r.json():
                                 self.r.hset(
@@ -123,7 +258,7 @@ class TriggerEvaluator(Function):
                                 )
                                 continue
                         else:
-                            logger.warn(f"error retrieving event types: {url}")
+                            logger.warn(f"error retrieving event types: {event_type_url}")
                     event_type_url = (
                         f"http://localhost:8000/api/event_types/{event_type_id}/"
                     )
@@ -186,16 +321,11 @@ class TriggerEvaluator(Function):
                             )
                             continue
 
-                        cached_msgs = self.r.xrevrange(
-                            name=f"event_gen:{fields[0]}:cache",
-                            max=publish_timestamp,
-                            count=1,
-                        )
-                        if not cached_msgs:
+                        if fields[0] not in messages:
                             logger.warn(f"No cached messages for topic: {fields[0]}")
                             payload_to_apply.pop(key, None)
                             continue
-                        unencoded_dict = json.loads(cached_msgs[0][1]["encoded"])
+                        unencoded_dict = messages[fields[0]]
                         if fields[1] not in unencoded_dict:
                             logger.warn(
                                 f"Message on topic: {topic} missing field: {fields[1]}"
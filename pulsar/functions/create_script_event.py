@@ -2,6 +2,7 @@
 import json
 import datetime
 import os
+import threading
 
 import pulsar
 import redis
@@ -16,10 +17,18 @@ body = {
     "inputs": [
         "persistent://public/default/_create_script_event",
     ],
+    # messages are acknowledged once their event is posted, see CreateScriptEvent.flush
+    "autoAck": False,
     # "output": "persistent://public/default/output",
     "logTopic": "persistent://public/default/create_script_event_log",
 }
 
+# Events that arrive within this many seconds of each other are posted together
+COALESCE_SECONDS = 0.05
+
+# Seconds to wait before posting again when django can't be reached
+RETRY_SECONDS = 5.0
+
 # Listen to log:
 # bin/pulsar-client consume persistent://public/default/create_script_event_log -n 0 -s create_script_event_log
 
@@ -33,46 +42,156 @@ class CreateScriptEvent(pulsar.Function):
         self.ip = os.environ.get("DJANGO_IP", "django")
         self.port = os.environ.get("DJANGO_PORT", "8000")
 
-    def post_event(self, logger, input_dict):
+        # keep connections to django open between posts
+        self.session = requests.Session()
+        self.session.auth = ("auto", "auto")
+        # event type name -> id, refreshed when a name is missing
+        self.event_type_ids = {}
+
+        self.coalesce_seconds = COALESCE_SECONDS
+        self.pending = []
+        self.lock = threading.Lock()
+        self.flush_timer = None
+
+    def get_event_type_id(self, logger, name):
+        """
+        Id of the named event type from the local map.  On a miss the map is reloaded from
+        the shared redis map, and then from django if redis doesn't have it either.
+        """
+        if name in self.event_type_ids:
+            return self.event_type_ids[name]
+
+        self.event_type_ids = {
+            k.decode("utf-8"): v.decode("utf-8")
+            for k, v in self.redis_client.hgetall("event_type_map").items()
+        }
+        if name not in self.event_type_ids:
+            self.load_event_type_ids(logger)
+        return self.event_type_ids.get(name)
+
+    def load_event_type_ids(self, logger):
+        # Reload the map from django and share it through redis
+        url = f"http://{self.ip}:{self.port}/api/event_types/"
+        r = self.session.get(url)
+        if r.status_code > 200:
+            error_string = f"{url} - {r.status_code} - {r.content}"
+            logger.warn(error_string)
+            raise Exception(error_string)
+
+        self.event_type_ids = {x["name"]: str(x["id"]) for x in r.json()}
+        if self.event_type_ids:
+            self.redis_client.hset("event_type_map", mapping=self.event_type_ids)
+
+    def post_event(self, context, input_dict, message_id, topic):
+        """
+        Queue the event to be posted with any others arriving within coalesce_seconds.
+        Its message is acknowledged by flush once the event is posted.
+        """
+        logger = context.get_logger()
         logger.info('Create event request received, creating event.')
-        event_type_id = self.redis_client.hget("event_type_map", input_dict["event_type"])
-        event_type_id = event_type_id.decode("utf-8")
+        name = input_dict["event_type"]
+        event_type_id = self.get_event_type_id(logger, name)
 
         if event_type_id:
             input_dict["event_type"] = f"/api/event_types/{event_type_id}/"
         else:
+            logger.warn(f"No id found for event type: {name}")
+            context.ack(message_id, topic)
+            return
+
+        entry = {"name": name, "data": input_dict, "message_id": message_id, "topic": topic}
+        with self.lock:
+            self.pending.append(entry)
+            flush_now = self.flush_timer is None and self.coalesce_seconds <= 0
+            if self.flush_timer is None and not flush_now:
+                self.start_flush_timer(context, self.coalesce_seconds)
+        if flush_now:
+            self.flush(context)
+
+    def start_flush_timer(self, context, delay):
+        # call with self.lock held
+        self.flush_timer = threading.Timer(delay, self.flush, args=(context,))
+        self.flush_timer.daemon = True
+        self.flush_timer.start()
+
+    def flush(self, context):
+        """
+        Post every pending event as one list.  If django rejects the list, the events are
+        posted one at a time so a single bad event doesn't drop the rest.  Messages are
+        acknowledged once their event is posted or rejected.  Events django couldn't be
+        reached for are kept and posted again after RETRY_SECONDS, and their messages
+        stay unacknowledged so Pulsar redelivers them if the function stops first.
+        """
+        logger = context.get_logger()
+        with self.lock:
+            entries, self.pending = self.pending, []
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+            self.flush_timer = None
+        if not entries:
             return
 
-        logger.info('Posting event')
-        r = requests.post(
-            f"http://{self.ip}:{self.port}/api/events/",
-            auth=("auto", "auto"),
-            json=input_dict,
-        )
+        logger.info(f'Posting {len(entries)} events')
+        if len(entries) > 1:
+            r = self.post_events(logger, [x["data"] for x in entries])
+            if r is not None and r.status_code <= 201:
+                logger.info(f"{r.status_code} - {[x['url'] for x in r.json()]}")
+                self.ack(context, entries)
+                return
+            if r is None or r.status_code >= 500:
+                self.retry_later(context, entries)
+                return
+
+        retry = []
+        reloaded = False
+        for entry in entries:
+            r = self.post_events(logger, entry["data"])
+            if r is not None and r.status_code == 400 and not reloaded:
+                # the event type may have been deleted and created again under a new id
+                reloaded = True
+                try:
+                    self.load_event_type_ids(logger)
+                except Exception:  # django unreachable, post again later
+                    retry.append(entry)
+                    continue
+                event_type_id = self.event_type_ids.get(entry["name"])
+                event_type = f"/api/event_types/{event_type_id}/"
+                if event_type_id and event_type != entry["data"]["event_type"]:
+                    entry["data"]["event_type"] = event_type
+                    r = self.post_events(logger, entry["data"])
+            if r is None or r.status_code >= 500:
+                retry.append(entry)
+                continue
+            if r.status_code <= 201:
+                logger.info(f"{r.status_code} - {r.json()['url']}")
+            # a rejected event won't be accepted later, post_events has logged it
+            self.ack(context, [entry])
+        if retry:
+            self.retry_later(context, retry)
+
+    def retry_later(self, context, entries):
+        with self.lock:
+            self.pending = entries + self.pending
+            if self.flush_timer is None:
+                self.start_flush_timer(context, RETRY_SECONDS)
+
+    def ack(self, context, entries):
+        for entry in entries:
+            context.ack(entry["message_id"], entry["topic"])
+
+    def post_events(self, logger, data):
+        try:
+            r = self.session.post(
+                f"http://{self.ip}:{self.port}/api/events/", json=data,
+            )
+        except requests.RequestException as e:
+            logger.warn(f"Was not able to post event, {e} - {data}")
+            return None
         if r.status_code > 201:
-            logger.warn(f"{r.status_code} - {r.content} - {input_dict}")
-            raise Exception(f"Was not able to post event, {r.status_code} - {r.content} - {input_dict}")
-        url = r.json()["url"]
-        to_return = f"{r.status_code} - {url}"
-        logger.info(to_return)
-
-    def test_event_type_map(self):
-        event_type_test = self.redis_client.hgetall("event_type_map")
-        if not event_type_test:
-            url = f"http://{self.ip}:{self.port}/api/event_types/"
-            r = requests.get(url)
-            if r.status_code > 200:
-                error_string = f"{url} - {r.status_code} - {r.content}"
-                logger.warn(error_string)
-                raise Exception(error_string)
-
-            for event_type in r.json():
-                self.redis_client.hset("event_type_map", event_type["name"], event_type["id"])
-        
+            logger.warn(f"Was not able to post event, {r.status_code} - {r.content} - {data}")
+        return r
 
     def process(self, input, context):
-        self.test_event_type_map()
-
         logger = context.get_logger()
         topic = context.get_current_message_topic_name()
         message_id = context.get_message_id()
@@ -82,6 +201,8 @@ class CreateScriptEvent(pulsar.Function):
             logger.info('Beginning cancel event process')
             # scheduled_events = self.redis_client.hgetall("scheduled_message_map")
 
+            # events received before the cancel go out first
+            self.flush(context)
             while self.redis_client.llen('scheduled_message_keys') != 0:
                 key = self.redis_client.lpop('scheduled_message_keys')
                 scheduled_event = self.redis_client.hget("scheduled_message_map", key)
@@ -93,7 +214,9 @@ class CreateScriptEvent(pulsar.Function):
 
         if "event_type" in input_dict.keys():
             logger.info('Beginning create event process')
-            self.post_event(logger, input_dict)
+            self.post_event(context, input_dict, message_id, topic)
 
             # remove scheduled message from redis because it was processed
-            self.redis_client.hdel("scheduled_message_map", *[str(message_id)])
\ No newline at end of file
+            self.redis_client.hdel("scheduled_message_map", *[str(message_id)])
+        else:
+            context.ack(message_id, topic)
@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
 
+import pulsar
 from pulsar import Function
 
+import datetime
+import hashlib
 import requests
 import json
+import threading
 import time
 
 ### FUNCTION DESCRIPTION: This function receives messages from django topics that the
@@ -40,28 +44,194 @@ body = {
 }
 
 
+DJANGO_API = "http://django:8000/api"
+PULSAR_URL = "pulsar://pulsar_proxy:6650"
+GAME_CLOCK_TOPIC = "persistent://public/default/game_clock"
+
+# seconds to wait for further relevant messages before refreshing the clock state
+COALESCE_SECONDS = 0.25
+
+# The cached current trial and phase anchors are checked against the API at least this
+# often, and the clock state is refreshed then even without messages.  Trials can become
+# current, or be deleted, without a _trial_log message (admin edits, the current trial
+# fallback), so the cache can't rely on messages alone.
+RECHECK_SECONDS = 30
+
+EVENT_TOPIC = "persistent://public/default/_event_log"
+TRIAL_TOPIC = "persistent://public/default/_trial_log"
+CLOCK_CONFIG_TOPIC = "persistent://public/default/_clock_config_log"
+CLOCK_PHASE_TOPIC = "persistent://public/default/_clock_phase_log"
+
+
+def id_from_url(url):
+    # hyperlinked objects look like http://django:8000/api/event_types/3/
+    if not url:
+        return None
+    try:
+        return int(url.rstrip("/").rsplit("/", 1)[-1])
+    except ValueError:
+        return None
+
+
 class GameClock(Function):
     def __init__(self):
         # Any one-off initialization can be done here
-        self.error_output = '{\
-            "detail": "No clock state for current trial.",\
-            "minor": {"detail": "No clock state for minor trial."},\
-            "major": {"detail": "No clock state for major trial."},\
-        }'
+        self.error_output = json.dumps(
+            {
+                "detail": "No clock state for current trial.",
+                "minor": {"detail": "No clock state for minor trial."},
+                "major": {"detail": "No clock state for major trial."},
+            }
+        )
         self.calltime = 0
-        pass
 
-    def publish(self, context, data):
+        # local index of the event types each clock phase is anchored to, loaded on first
+        # use and kept current from the clock phase topic
+        self.phase_anchors = None
+        # id of the current trial, kept current from the trial topic
+        self.current_trial_id = None
+
+        # bursts of messages within coalesce_seconds share one clock state refresh
+        self.coalesce_seconds = COALESCE_SECONDS
+        self.lock = threading.RLock()
+        self.refresh_timer = None
+        self.next_time_timer = None
+        self.last_state_hash = None
+
+        self.recheck_seconds = RECHECK_SECONDS
+        self.last_recheck = time.monotonic()
+
+        # Refreshes run on timer threads after process() has returned, where the Context
+        # must not be used, so states go out through the function's own producer and
+        # are logged with the logger kept from the last process() call
+        self.client = None
+        self.producer = None
+        self.logger = None
+
+    def get_producer(self):
+        if self.producer is None:
+            self.client = pulsar.Client(PULSAR_URL)
+            self.producer = self.client.create_producer(GAME_CLOCK_TOPIC)
+        return self.producer
+
+    def publish(self, data):
         data_obj = json.loads(data)
+
+        # skip states identical to the last one published
+        state_hash = hashlib.sha1(
+            json.dumps(data_obj, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+        if state_hash == self.last_state_hash:
+            return
+        self.last_state_hash = state_hash
+
         data_obj["calltime"] = str(self.calltime)
         data = json.dumps(data_obj)
-        context.get_logger().info(data)
-        context.publish(
-            "persistent://public/default/game_clock", data
-        )
+        self.logger.info(data)
+        self.get_producer().send(data.encode("utf-8"))
+
+    def request_refresh(self):
+        """
+        Refresh the clock state now, or once the coalescing window closes if one is set.
+        Requests made while a refresh is pending are folded into it.
+        """
+        if self.coalesce_seconds <= 0:
+            self.refresh()
+            return
+        with self.lock:
+            if self.refresh_timer is None:
+                self.refresh_timer = threading.Timer(self.coalesce_seconds, self.refresh)
+                self.refresh_timer.daemon = True
+                self.refresh_timer.start()
+
+    def refresh(self):
+        with self.lock:
+            self.refresh_timer = None
+            if time.monotonic() - self.last_recheck >= self.recheck_seconds:
+                # look the current trial and phases up again
+                self.last_recheck = time.monotonic()
+                self.current_trial_id = None
+                self.phase_anchors = None
+
+            clock_state = None
+            try:
+                trial_id = self.get_current_trial_id()
+                if trial_id:
+                    clock_state_request = requests.get(
+                        f"{DJANGO_API}/trials/{trial_id}/clock_state"
+                    )
+                    clock_state = clock_state_request.text
+                    self.publish(clock_state)
+            except (requests.exceptions.RequestException, ValueError) as e:
+                # django unreachable or answering with something other than json
+                self.logger.warn(f"Failed to refresh the clock state - {e}")
+                self.publish(self.error_output)
+            except Exception as e:  # Pulsar doesn't provide a subtype of Exception
+                self.logger.error(f"Failed to publish the clock state - {e}")
+            finally:
+                # a failed refresh must not end the chain of timed refreshes
+                self.schedule_next_time(clock_state)
+
+    def get_next_time_delay(self, clock_state):
+        # seconds until the clock state's next_time, or None if it has none ahead
+        if clock_state is None:
+            return None
+        try:
+            next_time = json.loads(clock_state).get("next_time")
+        except ValueError:
+            return None
+        if not next_time:
+            return None
+        delay = (
+            datetime.datetime.fromisoformat(next_time)
+            - datetime.datetime.now(datetime.timezone.utc)
+        ).total_seconds()
+        return delay if delay >= 0 else None
+
+    def schedule_next_time(self, clock_state):
+        # The clock changes phase at next_time without any message arriving, so refresh
+        # then.  Refresh after recheck_seconds at the latest to recheck the cached trial.
+        if self.next_time_timer is not None:
+            self.next_time_timer.cancel()
+            self.next_time_timer = None
+
+        delay = self.get_next_time_delay(clock_state)
+        at_next_time = delay is not None and delay <= self.recheck_seconds
+        if not at_next_time:
+            delay = self.recheck_seconds
+
+        def on_next_time():
+            if at_next_time:
+                self.calltime = int(time.time() * 1000.0)
+            self.refresh()
+
+        self.next_time_timer = threading.Timer(delay, on_next_time)
+        self.next_time_timer.daemon = True
+        self.next_time_timer.start()
+
+    def load_phase_anchors(self):
+        clock_phases = requests.get(f"{DJANGO_API}/clock_phases").json()
+        self.phase_anchors = {}
+        for phase in clock_phases:
+            self.phase_anchors[id_from_url(phase["url"])] = {
+                id_from_url(phase.get("starts_with_event_type")),
+                id_from_url(phase.get("ends_with_event_type")),
+            } - {None}
+
+    def is_anchor_event_type(self, event_type_id):
+        if self.phase_anchors is None:
+            self.load_phase_anchors()
+        return any(event_type_id in anchors for anchors in self.phase_anchors.values())
+
+    def get_current_trial_id(self):
+        if self.current_trial_id is None:
+            current_trial = requests.get(f"{DJANGO_API}/trials/current").json()
+            self.current_trial_id = current_trial.get("id")
+        return self.current_trial_id
 
     def process(self, input, context):
         logger = context.get_logger()
+        self.logger = logger
 
         self.calltime = int(time.time() * 1000.0)
 
@@ -76,62 +246,46 @@ class GameClock(Function):
         topic = context.get_current_message_topic_name()
 
         # message received due to event create or update
-        if topic == "persistent://public/default/_event_log":
+        if topic == EVENT_TOPIC:
 
             if data["event_type_id"]:
 
                 try:
-                    # put all clock phases in a string for quick check for event type
-                    clock_phases_request = requests.get(
-                        "http://django:8000/api/clock_phases"
-                    )
-                    clock_phases = clock_phases_request.text
-                    clock_phases_str = "".join(clock_phases)
-
-                    # only push clock state update if event is referenced in a clock phase
-                    if data["update"]:
+                    # only push clock state update if event is referenced in a clock phase.
+                    # An update may have changed the event type, so always push for those.
+                    if data["update"] or self.is_anchor_event_type(data["event_type_id"]):
                         update_clock_state = True
-                    else:
-                        event_type_url = f"/api/event_types/{data['event_type_id']}"
-                        if event_type_url in clock_phases_str:
-                            update_clock_state = True
 
-                except requests.exceptions.RequestException as e:
-                    self.publish(context, self.error_output)
+                except (requests.exceptions.RequestException, ValueError) as e:
+                    with self.lock:
+                        self.publish(self.error_output)
                     return
 
         # message received due to trial create or update
-        if topic == "persistent://public/default/_trial_log":
+        if topic == TRIAL_TOPIC:
+            if data.get("current"):
+                self.current_trial_id = data["id"]
+            elif data.get("id") == self.current_trial_id:
+                # no longer current, look the current trial up again when needed
+                self.current_trial_id = None
             update_clock_state = True
 
         # message received due to game clock config/phase create or update
-        if (
-            topic == "persistent://public/default/_clock_config_log"
-            or topic == "persistent://public/default/_clock_phase_log"
-        ):
+        if topic == CLOCK_PHASE_TOPIC:
+            if self.phase_anchors is not None and data.get("deleted"):
+                self.phase_anchors.pop(data["id"], None)
+            elif self.phase_anchors is not None:
+                self.phase_anchors[data["id"]] = {
+                    data.get("starts_with_event_type_id"),
+                    data.get("ends_with_event_type_id"),
+                } - {None}
+            update_clock_state = True
+
+        if topic == CLOCK_CONFIG_TOPIC:
             update_clock_state = True
 
         # perform clock state update
         if update_clock_state:
-            try:
-                current_trial_request = requests.get(
-                    "http://django:8000/api/trials/current"
-                )
-                current_trial = json.loads(current_trial_request.text)
-                trial_id = current_trial["id"]
-
-            except requests.exceptions.RequestException as e:
-                self.publish(context, self.error_output)
-                return
-
-            if trial_id:
-                try:
-                    clock_state_request = requests.get(
-                        f"http://django:8000/api/trials/{trial_id}/clock_state"
-                    )
-                    clock_state = clock_state_request.text
-                    self.publish(context, clock_state)
-                except requests.exceptions.RequestException as e:
-                    self.publish(context, self.error_output)
+            self.request_refresh()
 
         return update_clock_state
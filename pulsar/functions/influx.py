@@ -1,9 +1,10 @@
-
 #!/usr/bin/env python3
 import math
 import json
 from datetime import datetime, timezone
 import os
+import threading
+import time
 
 from pulsar import Function
 import requests
@@ -13,44 +14,157 @@ from influxdb_client.client.write_api import SYNCHRONOUS
 body = {
     "fqfn": "public/default/influx",
     "py": "/pulsar/functions/influx.py",
-    "className": "influx.Breadcrumb",    
+    "className": "influx.Breadcrumb",
     "topicsPattern": "persistent://public/default/node_.*",
     "logTopic": "persistent://public/default/influx_log",
+    # messages are acknowledged once their points are written, see Breadcrumb.flush
+    "autoAck": False,
 }
 
+# Points are buffered and written together once INFLUX_BATCH_SIZE are pending or every
+# INFLUX_FLUSH_INTERVAL seconds.  While writes fail, at most INFLUX_MAX_PENDING points are
+# kept; further messages are refused until a write succeeds, so Pulsar redelivers them.
+INFLUX_BATCH_SIZE = int(os.environ.get("INFLUX_BATCH_SIZE", 1000))
+INFLUX_FLUSH_INTERVAL = float(os.environ.get("INFLUX_FLUSH_INTERVAL", 1.0))
+INFLUX_MAX_PENDING = int(os.environ.get("INFLUX_MAX_PENDING", 50000))
+
+# Message keys written as tags, so they are indexed and can be grouped on; everything
+# else is a field.  Opt-in, since moving a key from field to tag changes the schema of
+# existing measurements.  Only list stable identifiers such as
+# INFLUX_TAG_KEYS=node,entity_name,platform; per-message ids make a series per message.
+INFLUX_TAG_KEYS = set(x for x in os.environ.get("INFLUX_TAG_KEYS", "").split(",") if x)
+
+
+def to_line_protocol(node, message, timestamp_ns):
+    """
+    Line protocol for one message dict, or "" if it has nothing writable.  Identifier keys
+    with string or integer values become tags.  Raises ValueError for values that can't be
+    written, such as nested objects.
+    """
+    point = Point(node).time(timestamp_ns)
+    for k, v in message.items():
+        if k in INFLUX_TAG_KEYS and isinstance(v, (str, int)) and not isinstance(v, bool):
+            point.tag(k, v)
+        else:
+            point.field(k, v)
+    return point.to_line_protocol()
+
 
 class Breadcrumb(Function):
     def __init__(self):
-        pass
-
-    def process(self, input, context):
-        logger = context.get_logger()
-        node = context.get_current_message_topic_name().split("/")[-1]
-        logger.info(f"Received msg from {node}")
+        self.influx_client = None
+        self.write_api = None
+        self.bucket = None
+        # line protocol strings waiting to be written and the (message id, topic) of the
+        # messages they came from, guarded by pending_lock
+        self.pending = []
+        self.pending_messages = []
+        self.pending_lock = threading.Lock()
+        # one write at a time, whether from process or the flush thread
+        self.write_lock = threading.Lock()
+        self.flush_thread = None
 
+    def connect(self):
+        """
+        Create the client and write api once per function instance.
+        """
+        if self.write_api is not None:
+            return
         influx_ip = os.environ.get("INFLUXDB_IP", "influxdb")
         influx_port = os.environ.get("INFLUXDB_PORT", 8086)
         org = os.environ.get("INFLUX_ORG", "influx_org")
         token = os.environ.get("INFLUX_TOKEN", "CZ97TbfV4jn9HjpKGrJEDbib7xlzPGE4PtNPyYNn9zp3VJZr3-BwhBGj10Wr7DufX41xjwizHwGOr9F0v0EVKw==")
-        bucket = os.environ.get("INFLUX_BUCKET", "influx_bucket")
-
-        with InfluxDBClient(url=f"http://{influx_ip}:{influx_port}", token=token, org=org) as influx_client:
-            with influx_client.write_api(write_options=SYNCHRONOUS) as write_api:
-                logger.info("Connected to Influxdb...")
-                input_dict = json.loads(input)
-
-                if not isinstance(input_dict,list):
-                    list_of_dict = [input_dict]
-                else:
-                    list_of_dict = input_dict
-
-                for single_dict in list_of_dict:
-                    point = Point(node)
-                    # point = point.tag()
-                    for k,v in single_dict.items():
-                        point.field(k,v)
-                    try:
-                        write_api.write(bucket=bucket, record=point)
-                        logger.info(f"Wrote {point}")
-                    except Exception as e:
-                        logger.warn(f"Failed to write to {node} - {e}")
+        self.bucket = os.environ.get("INFLUX_BUCKET", "influx_bucket")
+
+        self.influx_client = InfluxDBClient(
+            url=f"http://{influx_ip}:{influx_port}", token=token, org=org
+        )
+        self.write_api = self.influx_client.write_api(write_options=SYNCHRONOUS)
+
+    def start_flush_thread(self, context):
+        if self.flush_thread is not None:
+            return
+
+        def flush_periodically():
+            while True:
+                time.sleep(INFLUX_FLUSH_INTERVAL)
+                self.flush(context)
+
+        self.flush_thread = threading.Thread(target=flush_periodically, daemon=True)
+        self.flush_thread.start()
+
+    def flush(self, context):
+        """
+        Write every pending point in one request, then acknowledge the messages they came
+        from.  Points from a failed write are put back to be retried with the next flush,
+        and their messages stay unacknowledged so Pulsar redelivers them if the instance
+        stops first.  Returns False if the write failed.
+        """
+        logger = context.get_logger()
+        with self.write_lock:
+            with self.pending_lock:
+                lines, self.pending = self.pending, []
+                messages, self.pending_messages = self.pending_messages, []
+            if lines:
+                try:
+                    self.write_api.write(bucket=self.bucket, record=lines)
+                except Exception as e:  # influxdb_client raises several unrelated types
+                    logger.warn(f"Failed to write {len(lines)} points to influx - {e}")
+                    context.record_metric("influx_write_errors", 1)
+                    with self.pending_lock:
+                        self.pending = lines + self.pending
+                        self.pending_messages = messages + self.pending_messages
+                    return False
+                context.record_metric("influx_points_written", len(lines))
+
+        for message_id, topic in messages:
+            context.ack(message_id, topic)
+        return True
+
+    def process(self, input, context):
+        logger = context.get_logger()
+        node = context.get_current_message_topic_name().split("/")[-1]
+        logger.debug(f"Received msg from {node}")
+
+        self.connect()
+        self.start_flush_thread(context)
+
+        with self.pending_lock:
+            full = len(self.pending) >= INFLUX_MAX_PENDING
+        if full and not self.flush(context):
+            # refuse the message rather than dropping points, Pulsar redelivers it later
+            context.record_metric("influx_messages_refused", 1)
+            raise Exception(f"Influx is behind, {INFLUX_MAX_PENDING} points pending")
+
+        input_dict = json.loads(input)
+        if not isinstance(input_dict, list):
+            list_of_dict = [input_dict]
+        else:
+            list_of_dict = input_dict
+
+        # points are timestamped on receipt, not when their batch is written.  Each point
+        # gets its own nanosecond so points with the same tags don't overwrite each other.
+        timestamp_ns = time.time_ns()
+        lines = []
+        for i, single_dict in enumerate(list_of_dict):
+            try:
+                line = to_line_protocol(node, single_dict, timestamp_ns + i)
+            except ValueError:
+                logger.warn(f"Failed to convert message from {node} - {single_dict}")
+                context.record_metric("influx_points_invalid", 1)
+                continue
+            if line:
+                lines.append(line)
+
+        with self.pending_lock:
+            self.pending.extend(lines)
+            self.pending_messages.append(
+                (context.get_message_id(), context.get_current_message_topic_name())
+            )
+            pending = len(self.pending)
+        context.record_metric("influx_points_pending", pending)
+
+        if pending >= INFLUX_BATCH_SIZE:
+            # write in line rather than waiting for the flush thread, so a slow influx
+            # slows down consumption instead of growing the buffer
+            self.flush(context)
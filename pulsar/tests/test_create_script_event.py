@@ -0,0 +1,135 @@
+from unittest.mock import patch, MagicMock
+
+from functions import create_script_event
+
+import json
+import requests
+
+### BUILD CONTAINER FOR CHANGES TO BE REFLECTED: docker compose build pulsar
+### RUN TESTS: docker compose -f docker-compose-tests.yml up
+
+events_url = "http://django:8000/api/events/"
+
+
+class MockResponse:
+    def __init__(self, json_data, status_code):
+        self.json_data = json_data
+        self.content = json.dumps(json_data)
+        self.status_code = status_code
+
+    def json(self):
+        return self.json_data
+
+
+def mocked_post(url, json=None):
+    if isinstance(json, list):
+        return MockResponse([{"url": f"{url}{i}/"} for i, _ in enumerate(json)], 201)
+    return MockResponse({"url": f"{url}1/"}, 201)
+
+
+def make_function():
+    with patch("redis.Redis"):
+        pulsar_function = create_script_event.CreateScriptEvent()
+    pulsar_function.redis_client.hgetall.return_value = {b"scripted": b"7"}
+    pulsar_function.session = MagicMock()
+    pulsar_function.session.post.side_effect = mocked_post
+    return pulsar_function
+
+
+def process_events(pulsar_function, count):
+    context = MagicMock()
+    for x in range(count):
+        event = {"trial": "/api/trials/1/", "event_type": "scripted", "metadata": {"x": x}}
+        pulsar_function.process(json.dumps(event), context)
+
+
+def test_burst_posted_as_one_list():
+    pulsar_function = make_function()
+    # a long window, flushed below as the timer would
+    pulsar_function.coalesce_seconds = 1000
+    process_events(pulsar_function, 5)
+    pulsar_function.flush_timer.cancel()
+    pulsar_function.flush(MagicMock())
+
+    pulsar_function.session.post.assert_called_once()
+    posted = pulsar_function.session.post.call_args.kwargs["json"]
+    assert [x["metadata"]["x"] for x in posted] == list(range(5))
+    assert all(x["event_type"] == "/api/event_types/7/" for x in posted)
+    # the event type map is read once, not before every message
+    pulsar_function.redis_client.hgetall.assert_called_once()
+
+
+def test_rejected_list_posted_one_at_a_time():
+    pulsar_function = make_function()
+    pulsar_function.coalesce_seconds = 1000
+    pulsar_function.session.post.side_effect = lambda url, json=None: (
+        MockResponse({"detail": "bad"}, 400) if isinstance(json, list) else mocked_post(url, json)
+    )
+    process_events(pulsar_function, 3)
+    pulsar_function.flush_timer.cancel()
+    pulsar_function.flush(MagicMock())
+
+    assert pulsar_function.session.post.call_count == 4
+
+
+def test_unknown_event_type_refreshed_from_django():
+    pulsar_function = make_function()
+    pulsar_function.coalesce_seconds = 0
+    pulsar_function.redis_client.hgetall.return_value = {}
+    pulsar_function.session.get.return_value = MockResponse(
+        [{"name": "scripted", "id": 3}], 200
+    )
+    process_events(pulsar_function, 2)
+
+    pulsar_function.session.get.assert_called_once()
+    assert pulsar_function.session.post.call_count == 2
+    posted = pulsar_function.session.post.call_args.kwargs["json"]
+    assert posted["event_type"] == "/api/event_types/3/"
+
+
+def test_messages_acked_only_once_posted():
+    pulsar_function = make_function()
+    pulsar_function.coalesce_seconds = 1000
+    pulsar_function.session.post.side_effect = requests.ConnectionError("refused")
+    context = MagicMock()
+    for x in range(2):
+        context.get_message_id.return_value = f"message_{x}"
+        event = {"trial": "/api/trials/1/", "event_type": "scripted", "metadata": {"x": x}}
+        pulsar_function.process(json.dumps(event), context)
+    pulsar_function.flush_timer.cancel()
+
+    with patch("functions.create_script_event.RETRY_SECONDS", 1000):
+        pulsar_function.flush(context)
+    context.ack.assert_not_called()
+    assert len(pulsar_function.pending) == 2
+
+    # posted on the retry, then acknowledged
+    pulsar_function.flush_timer.cancel()
+    pulsar_function.session.post.side_effect = mocked_post
+    pulsar_function.flush(context)
+    acked = [x.args[0] for x in context.ack.call_args_list]
+    assert acked == ["message_0", "message_1"]
+    assert pulsar_function.pending == []
+
+
+def test_rejected_event_type_refreshed_and_posted_again():
+    pulsar_function = make_function()
+    pulsar_function.coalesce_seconds = 0
+    # redis still has the id of a deleted event type
+    pulsar_function.session.post.side_effect = lambda url, json=None: (
+        MockResponse({"event_type": ["Invalid hyperlink"]}, 400)
+        if json["event_type"] == "/api/event_types/7/"
+        else mocked_post(url, json)
+    )
+    pulsar_function.session.get.return_value = MockResponse(
+        [{"name": "scripted", "id": 8}], 200
+    )
+    context = MagicMock()
+    event = {"trial": "/api/trials/1/", "event_type": "scripted", "metadata": {}}
+    pulsar_function.process(json.dumps(event), context)
+
+    assert pulsar_function.session.post.call_count == 2
+    posted = pulsar_function.session.post.call_args.kwargs["json"]
+    assert posted["event_type"] == "/api/event_types/8/"
+    assert pulsar_function.event_type_ids == {"scripted": "8"}
+    context.ack.assert_called_once()
@@ -3,7 +3,9 @@ from unittest import mock
 
 from functions import game_clock_function
 
+import datetime
 import json
+import time
 
 ### BUILD CONTAINER FOR CHANGES TO BE REFLECTED: docker compose build pulsar
 ### RUN TESTS: docker compose -f docker-compose-tests.yml up
@@ -24,15 +26,27 @@ clock_state_url = "http://django:8000/api/trials/1/clock_state"
 def mocked_requests_get(*args, **kwargs):
     class MockResponse:
         def __init__(self, json_data, status_code):
-            self.json = json_data
+            self.json_data = json_data
             self.text = json.dumps(json_data)
             self.status_code = status_code
 
+        def json(self):
+            return self.json_data
+
     if args[0] == clock_phases_url:
-        return MockResponse({"starts_with_event_type": "/api/event_types/1"}, 200)
+        return MockResponse(
+            [
+                {
+                    "url": "http://django:8000/api/clock_phases/1/",
+                    "starts_with_event_type": "http://django:8000/api/event_types/1/",
+                    "ends_with_event_type": None,
+                }
+            ],
+            200,
+        )
 
     elif args[0] == current_trial_url:
-        return MockResponse({"id": "1"}, 200)
+        return MockResponse({"id": 1}, 200)
 
     elif args[0] == clock_state_url:
         return MockResponse(test_game_clock_state, 200)
@@ -40,6 +54,13 @@ def mocked_requests_get(*args, **kwargs):
     return MockResponse(None, 404)
 
 
+def make_clock():
+    pulsar_function = game_clock_function.GameClock()
+    # states are published through the function's own producer
+    pulsar_function.producer = MagicMock()
+    return pulsar_function
+
+
 def mock_context_topic(topic_name):
     return "persistent://public/default/" + topic_name
 
@@ -49,7 +70,8 @@ def mock_context_topic(topic_name):
 # be true.
 @mock.patch("requests.get", side_effect=mocked_requests_get)
 def test_game_clock_event_topic_truthy_route(mock_get):
-    pulsar_function = game_clock_function.GameClock()
+    pulsar_function = make_clock()
+    pulsar_function.coalesce_seconds = 0
 
     # verify route of event topic
     truthy_event_test_input = json.dumps({"event_type_id": 1, "update": False}).encode(
@@ -72,13 +94,20 @@ def test_game_clock_event_topic_truthy_route(mock_get):
         # ensure a game clock message is sent
         assert truthy_event_result == True
 
+        # the anchor index and current trial are kept locally, so another anchor
+        # event only needs the clock state
+        mock_get.reset_mock()
+        pulsar_function.process(truthy_event_test_input, mock_context)
+        mock_get.assert_called_once_with(clock_state_url)
+
 
 # Test route on receipt of message from event topic
 # The mock message contains an event type the clock doesn't care about, so the result
 # should be false.
 @mock.patch("requests.get", side_effect=mocked_requests_get)
 def test_game_clock_event_topic_falsey_route(mock_get):
-    pulsar_function = game_clock_function.GameClock()
+    pulsar_function = make_clock()
+    pulsar_function.coalesce_seconds = 0
 
     # verify route of event topic
     falsey_event_test_input = json.dumps({"event_type_id": 99, "update": False}).encode(
@@ -103,7 +132,8 @@ def test_game_clock_event_topic_falsey_route(mock_get):
 # Any message coming from the clock_phase topic should result in true
 @mock.patch("requests.get", side_effect=mocked_requests_get)
 def test_game_clock_clock_phase_topic_route(mock_get):
-    pulsar_function = game_clock_function.GameClock()
+    pulsar_function = make_clock()
+    pulsar_function.coalesce_seconds = 0
     # verify route of event topic
     clock_phase_test_input = json.dumps({"id": 1, "update": False}).encode("utf-8")
 
@@ -122,10 +152,40 @@ def test_game_clock_clock_phase_topic_route(mock_get):
         assert clock_phase_result == True
 
 
+# Clock phase messages update the local anchor index without fetching every phase
+@mock.patch("requests.get", side_effect=mocked_requests_get)
+def test_game_clock_clock_phase_updates_anchor_index(mock_get):
+    pulsar_function = make_clock()
+    pulsar_function.coalesce_seconds = 0
+    event_input = json.dumps({"event_type_id": 5, "update": False}).encode("utf-8")
+    phase_input = json.dumps(
+        {"id": 2, "starts_with_event_type_id": 5, "ends_with_event_type_id": None, "update": False}
+    ).encode("utf-8")
+
+    with MagicMock() as mock_context:
+        mock_context.get_current_message_topic_name.return_value = mock_context_topic(
+            "_event_log"
+        )
+        assert pulsar_function.process(event_input, mock_context) == False
+
+        mock_context.get_current_message_topic_name.return_value = mock_context_topic(
+            "_clock_phase_log"
+        )
+        pulsar_function.process(phase_input, mock_context)
+
+        mock_get.reset_mock()
+        mock_context.get_current_message_topic_name.return_value = mock_context_topic(
+            "_event_log"
+        )
+        assert pulsar_function.process(event_input, mock_context) == True
+        mock_get.assert_called_once_with(clock_state_url)
+
+
 # Any message coming from the clock_config topic should result in true
 @mock.patch("requests.get", side_effect=mocked_requests_get)
 def test_game_clock_clock_config_topic_route(mock_get):
-    pulsar_function = game_clock_function.GameClock()
+    pulsar_function = make_clock()
+    pulsar_function.coalesce_seconds = 0
     # verify route of event topic
     clock_config_test_input = json.dumps({"id": 1, "update": False}).encode("utf-8")
 
@@ -147,9 +207,12 @@ def test_game_clock_clock_config_topic_route(mock_get):
 # Any message coming from the trial topic should result in true
 @mock.patch("requests.get", side_effect=mocked_requests_get)
 def test_game_clock_trial_topic_route(mock_get):
-    pulsar_function = game_clock_function.GameClock()
+    pulsar_function = make_clock()
+    pulsar_function.coalesce_seconds = 0
     # verify route of event topic
-    trial_test_input = json.dumps({"id": 1, "update": False}).encode("utf-8")
+    trial_test_input = json.dumps({"id": 1, "current": True, "update": False}).encode(
+        "utf-8"
+    )
 
     with MagicMock() as mock_context:
         mock_context.get_current_message_topic_name.return_value = mock_context_topic(
@@ -157,8 +220,8 @@ def test_game_clock_trial_topic_route(mock_get):
         )
         trial_result = pulsar_function.process(trial_test_input, mock_context)
 
-        # ensure appropriate API calls happen
-        mock_get.assert_has_calls([call(current_trial_url), call(clock_state_url)])
+        # the message says which trial is current, so only the clock state is requested
+        mock_get.assert_called_once_with(clock_state_url)
 
         # ensure a game clock message is sent
         assert trial_result == True
@@ -167,7 +230,8 @@ def test_game_clock_trial_topic_route(mock_get):
 # A topic coming from anything outside of what has a handler should result in false
 @mock.patch("requests.get", side_effect=mocked_requests_get)
 def test_game_clock_falsey_topic_route(mock_get):
-    pulsar_function = game_clock_function.GameClock()
+    pulsar_function = make_clock()
+    pulsar_function.coalesce_seconds = 0
     # verify route of event topic
     falsey_test_input = json.dumps({"id": 7, "update": False}).encode("utf-8")
 
@@ -182,3 +246,148 @@ def test_game_clock_falsey_topic_route(mock_get):
 
         # ensure no message posted to the game clock
         assert falsey_result == False
+
+
+# A burst of relevant messages is folded into one clock state request, and a state
+# identical to the last one is not published again
+@mock.patch("requests.get", side_effect=mocked_requests_get)
+def test_game_clock_coalesces_bursts(mock_get):
+    pulsar_function = make_clock()
+    pulsar_function.coalesce_seconds = 0.05
+    event_input = json.dumps({"event_type_id": 1, "update": False}).encode("utf-8")
+
+    with MagicMock() as mock_context:
+        mock_context.get_current_message_topic_name.return_value = mock_context_topic(
+            "_event_log"
+        )
+        for _ in range(5):
+            assert pulsar_function.process(event_input, mock_context) == True
+        time.sleep(0.3)
+
+        assert mock_get.call_args_list.count(call(clock_state_url)) == 1
+        assert pulsar_function.producer.send.call_count == 1
+
+        # same state again, nothing new to publish
+        pulsar_function.process(event_input, mock_context)
+        time.sleep(0.3)
+        assert mock_get.call_args_list.count(call(clock_state_url)) == 2
+        assert pulsar_function.producer.send.call_count == 1
+
+
+# The clock state is refreshed at next_time without waiting for another message
+def test_game_clock_refreshes_at_next_time():
+    next_time = (
+        datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=0.1)
+    ).isoformat()
+    states = [dict(test_game_clock_state, next_time=next_time), test_game_clock_state]
+
+    def side_effect(url):
+        if url == clock_state_url:
+            response = mocked_requests_get(url)
+            response.text = json.dumps(states.pop(0) if states else test_game_clock_state)
+            return response
+        return mocked_requests_get(url)
+
+    with mock.patch("requests.get", side_effect=side_effect) as mock_get:
+        pulsar_function = make_clock()
+        pulsar_function.coalesce_seconds = 0
+        trial_input = json.dumps({"id": 1, "current": True, "update": True}).encode("utf-8")
+
+        with MagicMock() as mock_context:
+            mock_context.get_current_message_topic_name.return_value = mock_context_topic(
+                "_trial_log"
+            )
+            pulsar_function.process(trial_input, mock_context)
+            time.sleep(0.4)
+
+            assert mock_get.call_args_list.count(call(clock_state_url)) == 2
+            assert pulsar_function.producer.send.call_count == 2
+
+
+# The cached current trial is looked up again once recheck_seconds have passed, so a trial
+# made current without a _trial_log message is still picked up
+def test_game_clock_rechecks_current_trial():
+    def side_effect(url):
+        if url == current_trial_url:
+            response = mocked_requests_get(url)
+            response.json_data = {"id": 2}
+            return response
+        return mocked_requests_get(url.replace("/trials/2/", "/trials/1/"))
+
+    with mock.patch("requests.get", side_effect=side_effect) as mock_get:
+        pulsar_function = make_clock()
+        pulsar_function.coalesce_seconds = 0
+        trial_input = json.dumps({"id": 1, "current": True, "update": True}).encode("utf-8")
+
+        with MagicMock() as mock_context:
+            mock_context.get_current_message_topic_name.return_value = mock_context_topic(
+                "_trial_log"
+            )
+            pulsar_function.process(trial_input, mock_context)
+            mock_get.assert_called_once_with(clock_state_url)
+
+            mock_get.reset_mock()
+            pulsar_function.recheck_seconds = 0
+            pulsar_function.refresh()
+            mock_get.assert_has_calls(
+                [
+                    call(current_trial_url),
+                    call("http://django:8000/api/trials/2/clock_state"),
+                ]
+            )
+            assert pulsar_function.current_trial_id == 2
+            pulsar_function.next_time_timer.cancel()
+
+
+# A deleted clock phase no longer anchors the clock
+@mock.patch("requests.get", side_effect=mocked_requests_get)
+def test_game_clock_clock_phase_deleted(mock_get):
+    pulsar_function = make_clock()
+    pulsar_function.coalesce_seconds = 0
+    event_input = json.dumps({"event_type_id": 1, "update": False}).encode("utf-8")
+    phase_input = json.dumps(
+        {
+            "id": 1,
+            "starts_with_event_type_id": 1,
+            "ends_with_event_type_id": None,
+            "update": True,
+            "deleted": True,
+        }
+    ).encode("utf-8")
+
+    with MagicMock() as mock_context:
+        mock_context.get_current_message_topic_name.return_value = mock_context_topic(
+            "_event_log"
+        )
+        assert pulsar_function.process(event_input, mock_context) == True
+
+        mock_context.get_current_message_topic_name.return_value = mock_context_topic(
+            "_clock_phase_log"
+        )
+        pulsar_function.process(phase_input, mock_context)
+
+        mock_context.get_current_message_topic_name.return_value = mock_context_topic(
+            "_event_log"
+        )
+        assert pulsar_function.process(event_input, mock_context) == False
+
+
+# A refresh that fails unexpectedly still schedules the next one
+def test_game_clock_reschedules_after_failed_refresh():
+    def side_effect(url):
+        if url == current_trial_url:
+            response = mocked_requests_get(url)
+            response.json = mock.Mock(side_effect=ValueError("not json"))
+            return response
+        return mocked_requests_get(url)
+
+    with mock.patch("requests.get", side_effect=side_effect):
+        pulsar_function = make_clock()
+        pulsar_function.logger = MagicMock()
+        pulsar_function.refresh()
+
+        assert pulsar_function.next_time_timer is not None
+        pulsar_function.next_time_timer.cancel()
+        # the error state went out through the function's producer
+        sent = json.loads(pulsar_function.producer.send.call_args.args[0])
+        assert sent["detail"] == "No clock state for current trial."
@@ -0,0 +1,102 @@
+from unittest.mock import patch, MagicMock
+
+import pytest
+
+from functions import influx
+
+import json
+
+### BUILD CONTAINER FOR CHANGES TO BE REFLECTED: docker compose build pulsar
+### RUN TESTS: docker compose -f docker-compose-tests.yml up
+
+
+def make_context():
+    context = MagicMock()
+    context.get_current_message_topic_name.return_value = (
+        "persistent://public/default/node_1"
+    )
+    return context
+
+
+def make_breadcrumb():
+    pulsar_function = influx.Breadcrumb()
+    # no periodic flushing, tests flush explicitly
+    pulsar_function.flush_thread = MagicMock()
+    return pulsar_function
+
+
+def test_line_protocol_tags():
+    message = {"entity_name": "alpha", "battery": 0.5, "id": 3, "ok": True}
+    # no tags unless configured
+    line = influx.to_line_protocol("node_1", message, 1000)
+    assert line.startswith("node_1 ")
+
+    with patch("functions.influx.INFLUX_TAG_KEYS", {"entity_name", "platform"}):
+        line = influx.to_line_protocol("node_1", message, 1000)
+    assert line == "node_1,entity_name=alpha battery=0.5,id=3i,ok=true 1000"
+
+
+@patch("functions.influx.InfluxDBClient")
+def test_points_batched_on_one_client(mock_client):
+    pulsar_function = make_breadcrumb()
+    context = make_context()
+    write = mock_client.return_value.write_api.return_value.write
+
+    with patch("functions.influx.INFLUX_BATCH_SIZE", 3):
+        pulsar_function.process(json.dumps({"entity_name": "alpha", "x": 1}), context)
+        pulsar_function.process(
+            json.dumps([{"entity_name": "alpha", "x": 2}, {"nested": {"a": 1}}]), context
+        )
+        write.assert_not_called()
+        pulsar_function.process(json.dumps({"entity_name": "alpha", "x": 3}), context)
+
+    mock_client.assert_called_once()
+    write.assert_called_once()
+    lines = write.call_args.kwargs["record"]
+    assert [line.split(" ")[1] for line in lines] == [
+        'entity_name="alpha",x=1i',
+        'entity_name="alpha",x=2i',
+        'entity_name="alpha",x=3i',
+    ]
+    context.record_metric.assert_any_call("influx_points_invalid", 1)
+    context.record_metric.assert_any_call("influx_points_written", 3)
+
+
+@patch("functions.influx.InfluxDBClient")
+def test_list_points_have_distinct_timestamps(mock_client):
+    pulsar_function = make_breadcrumb()
+    context = make_context()
+    pulsar_function.process(
+        json.dumps([{"entity_name": "alpha", "x": 1}, {"entity_name": "alpha", "x": 2}]),
+        context,
+    )
+
+    timestamps = [line.split(" ")[-1] for line in pulsar_function.pending]
+    assert len(timestamps) == 2
+    assert timestamps[0] != timestamps[1]
+
+
+@patch("functions.influx.InfluxDBClient")
+def test_failed_writes_kept_and_bounded(mock_client):
+    pulsar_function = make_breadcrumb()
+    context = make_context()
+    write = mock_client.return_value.write_api.return_value.write
+    write.side_effect = Exception("connection refused")
+
+    with patch("functions.influx.INFLUX_MAX_PENDING", 2):
+        for x in range(2):
+            context.get_message_id.return_value = f"message_{x}"
+            pulsar_function.process(json.dumps({"x": x}), context)
+            pulsar_function.flush(context)
+        # full, so the next message is refused for redelivery rather than dropped
+        with pytest.raises(Exception):
+            pulsar_function.process(json.dumps({"x": 2}), context)
+
+    assert [line.split(" ")[1] for line in pulsar_function.pending] == ["x=0i", "x=1i"]
+    context.ack.assert_not_called()
+
+    write.side_effect = None
+    assert pulsar_function.flush(context)
+    assert pulsar_function.pending == []
+    acked = [x.args[0] for x in context.ack.call_args_list]
+    assert acked == ["message_0", "message_1"]
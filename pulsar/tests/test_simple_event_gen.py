@@ -0,0 +1,224 @@
+from unittest import mock
+from types import SimpleNamespace
+
+from functions import _simple_event_gen
+
+import json
+import time
+
+### BUILD CONTAINER FOR CHANGES TO BE REFLECTED: docker compose build pulsar
+### RUN TESTS: docker compose -f docker-compose-tests.yml up
+
+topic_name = "persistent://public/default/test_topic"
+
+# Publish timestamps are synthetic, message n was published at base + n ms
+base_timestamp = 1614772301122
+
+
+class FakeMessage:
+    def __init__(self, index):
+        self.index = index
+
+    def message_id(self):
+        return self.index
+
+    def publish_timestamp(self):
+        return base_timestamp + self.index
+
+
+class FakeReader:
+    """
+    Reads a topic of `length` messages from `start`, or from the beginning for any
+    non integer start id such as MessageId.earliest.
+    """
+
+    def __init__(self, length, start, inclusive):
+        if not isinstance(start, int):
+            start = 0
+        elif not inclusive:
+            start += 1
+        self.length = length
+        self.position = start
+        self.reads = 0
+
+    def read_next(self, timeout_millis=None):
+        if self.position >= self.length:
+            raise Exception("Pulsar error: TimeOut")
+        self.reads += 1
+        message = FakeMessage(self.position)
+        self.position += 1
+        return message
+
+    def close(self):
+        pass
+
+
+class FakeClient:
+    def __init__(self, length):
+        self.length = length
+        self.readers = []
+
+    def create_reader(self, topic, start_message_id, start_message_id_inclusive=False):
+        reader = FakeReader(self.length, start_message_id, start_message_id_inclusive)
+        self.readers.append(reader)
+        return reader
+
+
+def make_context(index, with_message=True):
+    context = SimpleNamespace(
+        get_logger=mock.MagicMock,
+        get_current_message_topic_name=lambda: topic_name,
+        get_message_id=lambda: index,
+    )
+    if with_message:
+        context.message = FakeMessage(index)
+    return context
+
+
+def make_trigger(key="test_key", cond_vars=("x: test_topic.value",), condition="x > 3"):
+    return {
+        "url": f"http://django:8000/api/triggers/{key}/",
+        "key": key,
+        "is_active": True,
+        "creates_event": False,
+        "cond_vars": list(cond_vars),
+        "condition": condition,
+        "req_data": [],
+    }
+
+
+class MockResponse:
+    def __init__(self, json_data):
+        self.json_data = json_data
+
+    def json(self):
+        return self.json_data
+
+
+def make_evaluator(length, triggers=None):
+    with mock.patch("redis.Redis"), mock.patch(
+        "pulsar.Client", return_value=FakeClient(length)
+    ):
+        evaluator = _simple_event_gen.TriggerEvaluator()
+    with mock.patch(
+        "requests.get", return_value=MockResponse(triggers or [make_trigger()])
+    ):
+        evaluator.load_triggers(mock.MagicMock())
+    # nothing is cached, so process stops after the publish timestamp lookup
+    cache_latest(evaluator, {})
+    return evaluator
+
+
+def cache_latest(evaluator, latest):
+    # latest message dicts by topic, as the event generator stores them
+    def hmget(name, topics):
+        return [
+            json.dumps(latest[topic]) if topic in latest else None for topic in topics
+        ]
+
+    evaluator.r.hmget.side_effect = hmget
+
+
+def mean_latency(length, with_message, samples=200):
+    evaluator = make_evaluator(length)
+    message_input = json.dumps({"test": "value"})
+    start = time.perf_counter()
+    for index in range(length - samples, length):
+        evaluator.process(message_input, make_context(index, with_message))
+    return (time.perf_counter() - start) / samples, evaluator
+
+
+def test_publish_timestamp_lookup():
+    for with_message in (True, False):
+        evaluator = make_evaluator(10)
+        timestamp = evaluator.get_publish_timestamp(make_context(7, with_message))
+        assert timestamp == base_timestamp + 7
+
+    # a runtime keeping something else in context.message falls back to the reader
+    evaluator = make_evaluator(10)
+    context = make_context(7, with_message=False)
+    context.message = object()
+    assert evaluator.get_publish_timestamp(context) == base_timestamp + 7
+    assert len(evaluator.client.readers) == 1
+
+
+# Regression benchmark, the per message cost of finding the publish timestamp must not
+# depend on how many messages came before it on the topic.
+def test_publish_timestamp_latency_is_flat():
+    for with_message in (True, False):
+        latencies = {}
+        for length in (1000, 1000000):
+            latencies[length], evaluator = mean_latency(length, with_message)
+            # at most one message is read per processed message
+            assert all(reader.reads <= 1 for reader in evaluator.client.readers)
+        # generous bound for noisy machines, a replay would be ~1000x slower
+        assert latencies[1000000] < 10 * latencies[1000] + 0.001, (
+            f"context message: {with_message}, mean latency per message: "
+            + ", ".join(f"{n} messages {t * 1e6:.1f}us" for n, t in latencies.items())
+        )
+
+
+def test_triggers_compiled_once():
+    evaluator = make_evaluator(10)
+    cache_latest(
+        evaluator, {"test_topic": {"value": 5, "published_datetime_stamp": base_timestamp}}
+    )
+    (compiled,) = evaluator.triggers_by_topic["test_topic"]
+    assert compiled.bindings == [("x", "test_topic", "value")]
+
+    message_input = json.dumps({"test": "value"})
+    with mock.patch("requests.get") as mock_get:
+        result = evaluator.process(message_input, make_context(3))
+        # evaluating a trigger does not refetch definitions
+        mock_get.assert_not_called()
+    assert json.loads(result) == {"event_id": None}
+
+    cache_latest(
+        evaluator, {"test_topic": {"value": 1, "published_datetime_stamp": base_timestamp}}
+    )
+    assert evaluator.process(message_input, make_context(4)) is None
+
+
+def test_cached_messages_as_of():
+    evaluator = make_evaluator(10)
+    cache_latest(
+        evaluator,
+        {
+            "old_topic": {"value": 1, "published_datetime_stamp": base_timestamp},
+            "new_topic": {"value": 3, "published_datetime_stamp": base_timestamp + 9},
+        },
+    )
+    pipe = evaluator.r.pipeline.return_value
+    pipe.execute.return_value = [[("1-0", {"encoded": json.dumps({"value": 2})})]]
+
+    messages = evaluator.get_cached_messages(
+        ["old_topic", "new_topic", "missing_topic"], base_timestamp + 5
+    )
+    assert {topic: m["value"] for topic, m in messages.items()} == {
+        "old_topic": 1,
+        "new_topic": 2,
+    }
+    # only the topic with a message newer than the as-of time reads its stream
+    pipe.xrevrange.assert_called_once_with(
+        name="event_gen:new_topic:cache", max=base_timestamp + 5, count=1
+    )
+    evaluator.r.xrevrange.assert_not_called()
+
+
+def test_triggers_reload_on_change():
+    evaluator = make_evaluator(10)
+    context = make_context(1)
+    context.get_current_message_topic_name = lambda: "persistent://public/default/_trigger_log"
+    evaluator.process(json.dumps({"model": "trigger", "id": 1}), context)
+    assert evaluator.triggers_by_topic is None
+
+    triggers = [
+        make_trigger("other_key", ["y: other_topic.value"], "y == 1"),
+        make_trigger("bad_key", ["z: test_topic.value"], "z >"),
+        dict(make_trigger("inactive_key"), is_active=False),
+    ]
+    with mock.patch("requests.get", return_value=MockResponse(triggers)) as mock_get:
+        evaluator.process(json.dumps({"test": "value"}), make_context(2))
+        evaluator.process(json.dumps({"test": "value"}), make_context(3))
+        mock_get.assert_called_once()
+    assert list(evaluator.triggers_by_topic) == ["other_topic"]